@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Disk layer throughput benchmarks
+
+Times format, write_rom, listing, dump_rom, dump_savegame, write_savegame
+and delete_rom with synthetic Card1/Card2 roms on sdcard images, both on
+disk and on a RAM backend (/dev/shm), and writes the results as json so
+they can be compared across commits.
+
+    python3 benchmarks/disk_io.py [--sizes 128 512 4096] [--backends file ram] [--output results.json]
+
+Roms and images are sparse, but writing a rom really stores it: the RAM
+backend needs as much free memory as the biggest rom.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+sys.path.append(os.path.join(root, "third_party/appdirs"))
+
+from sky3ds import catalog, disk, fixtures
+
+cpu_time = time.process_time if hasattr(time, 'process_time') else time.clock
+
+def backend_dir(backend, directory):
+    if backend == 'ram':
+        if not os.path.isdir("/dev/shm"):
+            return None
+        return tempfile.mkdtemp(dir="/dev/shm")
+    return tempfile.mkdtemp(dir=directory)
+
+def measure(results, backend, operation, function, size=0, card_type=None):
+    started_wall = time.time()
+    started_cpu = cpu_time()
+    function()
+    wall = time.time() - started_wall
+    cpu = cpu_time() - started_cpu
+
+    result = {
+        'backend': backend,
+        'operation': operation,
+        'card_type': card_type,
+        'size': size,
+        'wall': wall,
+        'cpu': cpu,
+        'mb_per_s': size / wall / 1024 / 1024 if size and wall else None,
+        }
+    results.append(result)
+    print("%-5s %-15s %-6s %6d MB %8.3f s wall %8.3f s cpu %s" % (backend, operation, card_type or "", size / 1024 / 1024, wall, cpu, "%8.1f MB/s" % result['mb_per_s'] if result['mb_per_s'] else ""))
+
+def run_backend(backend, work_dir, sizes, results):
+    roms = []
+    for size in sizes:
+        for card_type in [1, 2]:
+            rom = os.path.join(work_dir, "%d_card%d.3ds" % (size, card_type))
+            fixtures.make_rom(rom, size * 1024 * 1024, fixtures.product_code(len(roms)), card_type)
+            roms.append((rom, size * 1024 * 1024, "Card%d" % card_type))
+
+    image = os.path.join(work_dir, "sdcard.img")
+    fixtures.make_image(image, 0x2000000 + sum(size for rom, size, card_type in roms) + 0x2000000)
+    sky3ds_disk = disk.Sky3DS_Disk(image)
+
+    measure(results, backend, 'format', sky3ds_disk.format, 0x2000000)
+
+    for rom, size, card_type in roms:
+        measure(results, backend, 'write_rom', lambda: sky3ds_disk.write_rom(rom, silent=True), size, card_type)
+
+    measure(results, backend, 'listing', lambda: catalog.read_card(sky3ds_disk))
+
+    output = os.path.join(work_dir, "dump.3ds")
+    for slot, (rom, size, card_type) in enumerate(roms):
+        measure(results, backend, 'dump_rom', lambda: sky3ds_disk.dump_rom(slot, output, silent=True), size, card_type)
+        os.remove(output)
+
+    savegame = os.path.join(work_dir, "save.sav")
+    for slot, (rom, size, card_type) in enumerate(roms[:2]):
+        save_size = 0x100000 if card_type == 'Card1' else 0xa00000
+        measure(results, backend, 'dump_savegame', lambda: sky3ds_disk.dump_savegame(slot, savegame), save_size, card_type)
+        measure(results, backend, 'write_savegame', lambda: sky3ds_disk.write_savegame(savegame), save_size, card_type)
+
+    for rom, size, card_type in roms:
+        measure(results, backend, 'delete_rom', lambda: sky3ds_disk.delete_rom(0), 0, card_type)
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root, stderr=subprocess.STDOUT).decode('ascii').strip()
+    except:
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', help='rom sizes in MB (default: 128 512)', type=int, nargs='+', default=[128, 512])
+    parser.add_argument('--backends', help='file and/or ram (default: both)', nargs='+', choices=['file', 'ram'], default=['file', 'ram'])
+    parser.add_argument('--dir', help='directory for the file backend (default: temp directory)')
+    parser.add_argument('--output', help='write results to this json file')
+    args = parser.parse_args()
+
+    results = []
+    for backend in args.backends:
+        work_dir = backend_dir(backend, args.dir)
+        if not work_dir:
+            print("No RAM backend (/dev/shm) on this system, skipping.")
+            continue
+        try:
+            run_backend(backend, work_dir, args.sizes, results)
+        finally:
+            shutil.rmtree(work_dir)
+
+    report = {
+        'commit': git_commit(),
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sizes': args.sizes,
+        'results': results,
+        }
+    if args.output:
+        outputfp = open(args.output, "w")
+        outputfp.write(json.dumps(report, indent=2))
+        outputfp.close()
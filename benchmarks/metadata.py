@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""Metadata micro-benchmarks
+
+Measures the CPU-bound paths behind listings and rom writes (crc16, NCSD
+header parsing, template and title lookups, template.txt conversion and
+title database parsing) on synthetic data: a template.txt and a 3dsdb.com
+style xml feed are generated in a temp directory, nothing in the data
+directory is touched.
+
+Every call is timed on its own, the results are latency distributions
+(microseconds) per benchmark. With --baseline the medians are compared to a
+previous run (saved with --output) and the script exits with 1 if any of
+them got slower than --threshold times the baseline.
+
+    python3 benchmarks/metadata.py [--templates 20000] [--releases 5000] [--output results.json] [--baseline results.json] [--threshold 1.5]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+sys.path.append(os.path.join(root, "third_party/appdirs"))
+
+from sky3ds import fixtures, gamecard, titles
+
+timer = time.perf_counter if hasattr(time, 'perf_counter') else time.time
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+def measure(function, args_list):
+    """Call function once for every args in args_list
+
+    Returns the latency distribution in microseconds"""
+
+    latencies = []
+    for args in args_list:
+        started = timer()
+        function(*args)
+        latencies.append((timer() - started) * 1000000)
+    latencies.sort()
+    return {
+        'calls': len(latencies),
+        'min': latencies[0],
+        'median': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1],
+        'mean': sum(latencies) / len(latencies),
+        }
+
+def run(work_dir, template_count, release_count, calls):
+    titles.template_txt = os.path.join(work_dir, 'template.txt')
+    titles.template_json = os.path.join(work_dir, 'template.json')
+    titles.titles_json = os.path.join(work_dir, 'titles.json')
+
+    fixtures.make_template_txt(titles.template_txt, template_count)
+    xml_data = fixtures.make_title_xml(release_count)
+    random.seed(0)
+
+    benchmarks = {}
+
+    benchmarks['convert_template_to_json'] = measure(titles.convert_template_to_json, [()] * 5)
+    benchmarks['parse_title_db'] = measure(titles.parse_title_db, [(xml_data,)] * 5)
+
+    releases = titles.parse_title_db(xml_data)[0]
+    titles_json_fp = open(titles.titles_json, "w")
+    titles_json_fp.write(json.dumps(releases))
+    titles_json_fp.close()
+
+    crc_data = [(bytearray(os.urandom(0x1fe)),) for i in range(calls)]
+    benchmarks['crc16'] = measure(titles.crc16, crc_data)
+
+    headers = []
+    for i in range(calls):
+        card_type = random.choice([1, 2])
+        headers.append((bytes(fixtures.ncsd_header(0x8000000 * card_type, fixtures.product_code(i), card_type, 0x0004000000123400 + i * 0x100)),))
+    benchmarks['ncsd_header'] = measure(gamecard.ncsd_header, headers)
+
+    # half of the lookups are for roms that aren't in the templates/titles
+    templates = json.load(open(titles.template_json))
+    lookups = []
+    for i in range(calls):
+        template = random.choice(templates)
+        lookups.append((template['serial'], template['sha1'] if i % 2 else "0" * 40))
+    titles.get_template(*lookups[0])
+    benchmarks['get_template'] = measure(titles.get_template, lookups)
+
+    lookups = []
+    for i in range(calls):
+        index = random.randrange(release_count * 2)
+        lookups.append((fixtures.product_code(index), fixtures.media_id(index)))
+    titles.rom_info(*lookups[0])
+    benchmarks['rom_info'] = measure(titles.rom_info, lookups)
+
+    return benchmarks
+
+def compare(benchmarks, baseline, threshold):
+    """Names of the benchmarks that got slower than threshold times the baseline"""
+    regressions = []
+    for name, result in sorted(benchmarks.items()):
+        if not name in baseline:
+            continue
+        ratio = result['median'] / baseline[name]['median']
+        print("%-25s %8.1f us -> %8.1f us (%.2fx)%s" % (name, baseline[name]['median'], result['median'], ratio, " REGRESSION" if ratio > threshold else ""))
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--templates', help='number of templates in template.txt (default: 20000)', type=int, default=20000)
+    parser.add_argument('--releases', help='number of releases in the xml feed (default: 5000)', type=int, default=5000)
+    parser.add_argument('--calls', help='calls per lookup benchmark (default: 1000)', type=int, default=1000)
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('--baseline', help='compare with the results of a previous run')
+    parser.add_argument('--threshold', help='maximum slowdown of the median against the baseline (default: 1.5)', type=float, default=1.5)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        benchmarks = run(work_dir, args.templates, args.releases, args.calls)
+    finally:
+        shutil.rmtree(work_dir)
+
+    print("%-25s %8s %12s %12s %12s %12s" % ("", "calls", "median", "p90", "p99", "max"))
+    for name, result in sorted(benchmarks.items()):
+        print("%-25s %8d %9.1f us %9.1f us %9.1f us %9.1f us" % (name, result['calls'], result['median'], result['p90'], result['p99'], result['max']))
+
+    if args.output:
+        outputfp = open(args.output, "w")
+        outputfp.write(json.dumps({
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'templates': args.templates,
+            'releases': args.releases,
+            'benchmarks': benchmarks,
+            }, indent=2))
+        outputfp.close()
+
+    if args.baseline:
+        baseline_fp = open(args.baseline)
+        baseline = json.load(baseline_fp)['benchmarks']
+        baseline_fp.close()
+        print("")
+        regressions = compare(benchmarks, baseline, args.threshold)
+        if regressions:
+            print("\n%d benchmark(s) slower than %.2fx the baseline: %s" % (len(regressions), args.threshold, ", ".join(regressions)))
+            sys.exit(1)
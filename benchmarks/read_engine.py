@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Compare sequential reads with the parallel read engine
+
+Without arguments a RAM-backed image (/dev/shm if available) is used,
+otherwise the given sdcard is read (nothing is written to it). Every run on
+a real sdcard reads a different region, so the page cache doesn't make later
+runs look faster than they are.
+
+    python3 benchmarks/read_engine.py [--size MB] [sdcard]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+sys.path.append(os.path.join(root, "third_party/appdirs"))
+
+from sky3ds import disk
+
+chunk_sizes = [0x10000, 0x100000, 0x400000]
+queue_depths = [1, 2, 4, 8]
+
+def create_image(size):
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    fd, path = tempfile.mkstemp(suffix=".img", dir=directory)
+    while size > 0:
+        size -= os.write(fd, os.urandom(min(size, 0x1000000)))
+    os.close(fd)
+    return path
+
+def run(sky3ds_disk, start, length, chunk_size, queue_depth):
+    started = time.time()
+    read = 0
+    for chunk in sky3ds_disk.read_extent(start, length, chunk_size, queue_depth):
+        read += len(chunk)
+    return read / (time.time() - started) / 1024 / 1024
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('disk', nargs='?', help='sdcard to read from (default: RAM-backed image)')
+    parser.add_argument('--size', help='MB read per run (default: 256)', type=int, default=256)
+    args = parser.parse_args()
+
+    length = args.size * 1024 * 1024
+    image = None
+    if args.disk:
+        disk_path = args.disk
+    else:
+        image = disk_path = create_image(length + 0x2000000)
+
+    try:
+        sky3ds_disk = disk.Sky3DS_Disk(disk_path)
+        runs = len(chunk_sizes) * len(queue_depths)
+        fresh_regions = not image and sky3ds_disk.disk_size >= runs * length
+
+        print("%s (%d MB per run%s)\n" % (disk_path, args.size, "" if image or fresh_regions else ", disk too small for uncached runs"))
+        print("| Chunk size | " + " | ".join("QD %d" % i for i in queue_depths) + " |")
+
+        run_count = 0
+        for chunk_size in chunk_sizes:
+            line = []
+            for queue_depth in queue_depths:
+                start = run_count * length if fresh_regions else 0
+                line.append("%6.1f MB/s" % run(sky3ds_disk, start, length, chunk_size, queue_depth))
+                run_count += 1
+            print("| %7d KB | " % (chunk_size / 1024) + " | ".join(line) + " |")
+    finally:
+        if image:
+            os.remove(image)
@@ -13,7 +13,7 @@ import tkFileDialog
 from Tkinter import _setit
 from ttk import *
 
-import os, sys, ttk, subprocess, plistlib, tkMessageBox, traceback
+import os, sys, ttk, subprocess, plistlib, tkMessageBox, traceback, threading, Queue
 
 # if we aren't sudoing this
 if os.getuid() != 0:
@@ -37,10 +37,12 @@ os.chdir(os.path.dirname(os.path.realpath(__file__)))
 # import the backend stuff
 sys.path.append("sky3ds")
 sys.path.append("third_party/appdirs")
-sys.path.append("third_party/progressbar")
 import sky3ds
 from sky3ds import disk as disk_functions # 'disk' is too generic a name to avoid confusion
-from sky3ds import titles, gamecard
+from sky3ds import catalog, devices, titles, gamecard, source
+from sky3ds.romtable import RomTable
+from sky3ds.sync import slot_at
+from sky3ds.progress import CancelToken, Cancelled
 from appdirs import user_data_dir
 
 
@@ -86,19 +88,32 @@ class View(Frame):
 
         frame_top_row.pack(fill=BOTH, expand=1, pady = 3)
 
+        frame_filter = Frame(frame_master)
+
+        label_filter = Label(frame_filter, text = "Filter:")
+        label_filter.pack(side=LEFT)
+
+        # filtering only works on the rows already in memory, see RomTable
+        self.rom_filter = StringVar()
+        self.rom_filter.trace('w', lambda *args: controller.show_roms())
+        entry_filter = Entry(frame_filter, textvariable = self.rom_filter)
+        entry_filter.pack(side=LEFT, fill=BOTH, expand=1)
+
+        frame_filter.pack(fill=BOTH, expand=1, pady = 3)
+
         frame_rom_list = Frame(frame_master)
 
         rom_table_columns = ["Slot", "Start", "Size", "Type", "Code", "Title", "Save Crypto"]
         self.tree_rom_table = ttk.Treeview(frame_rom_list, height = 10, columns = rom_table_columns, selectmode="extended")
         self.tree_rom_table.pack()
 
-        self.tree_rom_table.heading('#1', text='Slot', anchor=W)
-        self.tree_rom_table.heading('#2', text='Start', anchor=W)
-        self.tree_rom_table.heading('#3', text='Size', anchor=W)
-        self.tree_rom_table.heading('#4', text='Type', anchor=W)
-        self.tree_rom_table.heading('#5', text='Code', anchor=W)
-        self.tree_rom_table.heading('#6', text='Title', anchor=W)
-        self.tree_rom_table.heading('#7', text='Save Crypto', anchor=W)
+        self.tree_rom_table.heading('#1', text='Slot', anchor=W, command = lambda: controller.sort_roms('slot'))
+        self.tree_rom_table.heading('#2', text='Start', anchor=W, command = lambda: controller.sort_roms('start'))
+        self.tree_rom_table.heading('#3', text='Size', anchor=W, command = lambda: controller.sort_roms('size'))
+        self.tree_rom_table.heading('#4', text='Type', anchor=W, command = lambda: controller.sort_roms('card_type'))
+        self.tree_rom_table.heading('#5', text='Code', anchor=W, command = lambda: controller.sort_roms('product_code'))
+        self.tree_rom_table.heading('#6', text='Title', anchor=W, command = lambda: controller.sort_roms('title'))
+        self.tree_rom_table.heading('#7', text='Save Crypto', anchor=W, command = lambda: controller.sort_roms('save_crypto'))
 
         self.tree_rom_table.column('#1', stretch=False, minwidth=40, width=40)
         self.tree_rom_table.column('#2', stretch=NO, minwidth=72, width=72)
@@ -150,6 +165,24 @@ class View(Frame):
 
         frame_write_buttons.pack(fill = BOTH, expand = 1, pady = 5)
 
+        frame_jobs = Frame(frame_master)
+
+        job_table_columns = ["Job", "Status"]
+        self.tree_job_table = ttk.Treeview(frame_jobs, height = 4, columns = job_table_columns, selectmode="browse")
+        self.tree_job_table.pack(side=LEFT)
+
+        self.tree_job_table.heading('#1', text='Job', anchor=W)
+        self.tree_job_table.heading('#2', text='Status', anchor=W)
+
+        self.tree_job_table.column('#1', stretch=NO, minwidth=250, width=250)
+        self.tree_job_table.column('#2', stretch=NO, minwidth=300, width=300)
+        self.tree_job_table.column('#0', stretch=NO, minwidth=0, width=0) #width 0 to not display it
+
+        button_cancel_job = Button(frame_jobs, text = "Cancel Job", command = controller.cancel_job )
+        button_cancel_job.pack(side=RIGHT)
+
+        frame_jobs.pack(fill = BOTH, expand = 1, pady = 3)
+
         frame_master.pack()
 
     def update_disk_optionmenu(self):
@@ -161,16 +194,30 @@ class View(Frame):
         if not disk_list:
             raise Exception("No Acceptable disks found")
         else:
+            choice = self.disk_choice.get()
             for disk in disk_list:
                 menu.add_command(label=disk, command=_setit(self.disk_choice,disk))
-                self.disk_choice.set(disk)
+            # keep the choice if that disk is still there
+            if not choice in [str(disk) for disk in disk_list]:
+                self.disk_choice.set(disk_list[0])
+
+    def poll_devices(self, state):
+        # refresh the disk list when sdcards are plugged in or removed
+        changed, state = devices.poll(state)
+        if changed:
+            try:
+                self.update_disk_optionmenu()
+            except Exception:
+                self.menu_choose_disk['menu'].delete(0, 'end')
+                self.disk_choice.set('')
+        root.after(2000, self.poll_devices, state)
 
     def create_menus(self):
         menu_bar = Menu(root)
 
         menu_file = Menu(menu_bar, tearoff=0)
         menu_bar.add_cascade(label="File", menu=menu_file)
-        menu_file.add_command(label="Exit", command=root.quit)
+        menu_file.add_command(label="Exit", command=lambda: worker.quit())
 
         menu_tools = Menu(menu_bar, tearoff=0)
         menu_bar.add_cascade(label="Tools", menu=menu_tools)
@@ -220,7 +267,28 @@ class View(Frame):
 class Controller:
 
     def __init__(self):
-        pass
+        # rows of the rom table by slot, see fill_rom_table
+        self.rom_table = RomTable()
+        self.listing = 0
+
+    def cancel_job(self):
+        index = view.tree_job_table.focus()
+        if index:
+            worker.cancel(index)
+        else:
+            raise Exception("Please select a job to cancel.")
+
+    def refresh_rom_table(self, card = None):
+        # the table only shows the disk that is open right now
+        current = globals().get('sd_card')
+        if not current or (card and card.disk_path != current.disk_path):
+            return
+        if card and card is not current:
+            # changed through another Sky3DS_Disk (i.e. formatted)
+            current.check_if_sky3ds_disk()
+            if current.is_sky3ds_disk:
+                current.update_rom_list()
+        self.fill_rom_table()
 
     def get_disk_list(self):
         disk_size_list = []
@@ -253,21 +321,13 @@ class Controller:
                 disk_size_list.append( (disk_path, size, "MB") )
 
         else:
-            disk_size_list = []
-            #get list of disks using lsblk
-            list_command =  ["lsblk", "-d", "-n", "-o", "NAME,SIZE,TYPE"]
-            try:
-                output = subprocess.check_output(list_command)
-            except subprocess.CalledProcessError as err:
-                raise Exception( "Could not get list of disks. Make sure you have 'lsblk' installed. \nError: %s" % err )
-
-            disk_list =  output.splitlines()
-
+            # straight from sysfs, sky3ds disks come first
+            disk_list = sorted(devices.list_devices(), key = lambda x: not x['is_sky3ds_disk'])
             for disk in disk_list:
-                disk_info = disk.split()
-                disk_path = "/dev/" + disk_info[0]
-                if disk_info[2] == "disk":
-                    disk_size_list.append( (disk_path, disk_info[1]) )
+                label = "%d MB %s" % (self.bytes_to_mb(disk['size']), disk['model'])
+                if disk['is_sky3ds_disk']:
+                    label += " (sky3ds)"
+                disk_size_list.append( (disk['disk_path'], label.strip()) )
 
         return disk_size_list
 
@@ -282,6 +342,7 @@ class Controller:
 
         global sd_card
         sd_card = disk_functions.Sky3DS_Disk(sd)
+        self.fingerprint = None
         self.fill_rom_table()
 
     def get_rom_info(self, rom_list):
@@ -310,60 +371,130 @@ class Controller:
         return rom_data
 
     def fill_rom_table(self):
-        # clear it out first
-        rom_table = view.tree_rom_table
-
-        rom_table.delete(*rom_table.get_children());
-
-        rom_data = self.get_rom_info(sd_card.rom_list)
-
-        for rom in rom_data:
-            rom_table.insert("", "end", "", values=(rom) )
+        # slot, start and size are known right away, everything else is read
+        # (or taken from the catalog) in the background, see load_rom_table
+        self.rom_table.fill(sd_card.rom_list)
+        self.show_roms()
 
         total_free_blocks = sum(512*i[1] for i in sd_card.free_blocks)/1024/1024
         view.disk_free_space.set("Free space: %d MB" % total_free_blocks)
 
-        cont_space = 512 * sd_card.free_blocks[0][1]/1024/1024
+        cont_space = 512 * sd_card.free_blocks[0][1]/1024/1024 if sd_card.free_blocks else 0
         view.disk_continuous_space.set("Largest Continuous Space: %d MB" % cont_space)
 
         view.disk_name.set("Disk: %s " % sd_card.disk_path)
 
+        self.load_rom_table()
+
+    def load_rom_table(self):
+        # a newer listing (i.e. after a job finished) replaces this one
+        self.listing += 1
+        listing = self.listing
+        card = sd_card
+        replaces = getattr(self, 'fingerprint', None)
+        results = Queue.Queue()
+
+        def load():
+            try:
+                # known cards are listed from the catalog without reading all headers
+                listed = catalog.card_listing(card, replaces = replaces, on_rom = lambda rom: results.put(('rom', dict(rom))))
+                results.put(('done', listed['fingerprint']))
+            except Exception as e:
+                results.put(('error', e))
+
+        thread = threading.Thread(target = load)
+        thread.daemon = True
+        thread.start()
+
+        root.after(50, self.poll_rom_table, listing, results)
+
+    def poll_rom_table(self, listing, results):
+        if listing != self.listing:
+            return
+
+        changed = False
+        finished = False
+        try:
+            while True:
+                kind, payload = results.get_nowait()
+                if kind == 'rom':
+                    if self.rom_table.update(payload):
+                        changed = True
+                elif kind == 'done':
+                    self.fingerprint = payload
+                    finished = True
+                else:
+                    finished = True
+                    tkMessageBox.showerror("Something broke.", "Couldn't read rom headers:\n%s" % payload)
+        except Queue.Empty:
+            pass
+
+        if changed:
+            self.show_roms()
+        if not finished:
+            root.after(50, self.poll_rom_table, listing, results)
+
+    def show_roms(self):
+        # (re)draw the rom table from self.rom_table, never touches the disk
+        rom_table = view.tree_rom_table
+        focus = rom_table.focus()
+        selection = rom_table.selection()
+        rom_table.delete(*rom_table.get_children())
+
+        for rom in self.rom_table.rows(view.rom_filter.get()):
+            rom_table.insert("", "end", str(rom['slot']), values=[
+                rom['slot'],
+                "%d MB" % int(rom['start'] / 1024 / 1024),
+                "%d MB" % int(rom['size'] / 1024 / 1024),
+                rom['card_type'],
+                rom['product_code'],
+                rom['title'],
+                rom['save_crypto'].rjust(12),
+                ] )
+
+        # keep the selection if the rows are still shown
+        if focus and rom_table.exists(focus):
+            rom_table.focus(focus)
+        rom_table.selection_set([x for x in selection if rom_table.exists(x)])
+
+    def sort_roms(self, key):
+        # clicking the same heading again reverses the order
+        self.rom_table.sort(key)
+        self.show_roms()
+
     def write_rom(self):
         try:
             disk = sd_card.disk_path
         except:
             raise Exception("Please open a disk before attempting to write a rom.")
 
-        file_path = tkFileDialog.askopenfilename( initialdir = os.path.expanduser('~/Desktop'), filetypes=[ ("3DS Rom","*.3ds")] )
+        file_path = tkFileDialog.askopenfilename( initialdir = os.path.expanduser('~/Desktop'), filetypes=[ ("3DS Rom","*.3ds"), ("Compressed 3DS Rom", "*.zip *.gz *.xz *.bz2 *.s3z")] )
 
         if file_path:
             # follow symlink
             file_path = os.path.realpath(file_path)
 
-            # if the template data doesn't exist we might as well just shut it down right here. If the progress window shows up the exception will stop the process so I can't destrot that toplevel.
-            if not self.get_rom_template_data(file_path):
-                tkMessageBox.showinfo("Missing Template Data", "Template entry not found.")
-                return None
-
-            # get rom size and calculate block count
-            rom_size = os.path.getsize(file_path)
-
-            self.message = "Writing %s" % os.path.basename(file_path)
-            progress_bar = progress_bar_window("Writing Rom", self.message, mode = "determinate", maximum = rom_size, task = "write")
+            card = sd_card
+            def write(progress, cancel):
+                # opening the rom (compressed ones are decompressed) and looking
+                # up its template takes a while, keep it off the Tk thread too.
+                # if the template data doesn't exist we might as well just shut it down right here.
+                if not self.get_rom_template_data(file_path):
+                    raise Exception("Template entry not found.")
+                card.write_rom(file_path, progress=progress, cancel=cancel)
 
-            root.wait_visibility(progress_bar.window)
-
-            sd_card.write_rom(file_path, progress=progress_bar)
-
-            controller.fill_rom_table()
+            worker.submit("Write %s" % os.path.basename(file_path), write,
+                          on_done = lambda result: self.refresh_rom_table(card))
 
         else:
             return
 
     def get_rom_template_data(self, rom_path):
 
-        # open rom file
-        romfp = open(rom_path, "rb")
+        # only the rom header is needed
+        rom_source = source.open_rom(rom_path)
+        romfp = rom_source.header_fp()
+        rom_source.close()
 
         # get card specific data from template.txt
         serial = gamecard.ncsd_serial(romfp)
@@ -402,20 +533,12 @@ class Controller:
         confirm = tkMessageBox.askokcancel("Confirm Delete", message)
 
         if confirm == True:
-            message = "Deleting %s." % title
-            task_text = "delete"
-
-            progress_bar = progress_bar_window("Deleting Rom", message, mode = "indeterminate", maximum = 100, task = task_text)
-
-            root.wait_visibility(progress_bar.progress)
-
-            progress_bar.start_indeterminate()
-
-            sd_card.delete_rom(slot)
-
-            progress_bar.progress_complete()
-
-            controller.fill_rom_table()
+            # slots change when earlier jobs delete roms, the position doesn't
+            card = sd_card
+            start = rom_list[slot][1]
+            worker.submit("Delete %s" % title,
+                          lambda progress, cancel: card.delete_rom(slot_at(card, start)),
+                          on_done = lambda result: self.refresh_rom_table(card))
 
         else:
             return
@@ -441,7 +564,6 @@ class Controller:
             rom_code = rom_info[4]
             index = rom_info[0] # Instead of relying on the treeview and sd_card to be identical I just pull all of the info out of the sd_card
             slot = rom_list[index][0]
-            rom_size = rom_list[index][2]
 
         else:
             raise Exception("Please select a rom to dump.")
@@ -458,13 +580,10 @@ class Controller:
         if confirm == True:
             destination_file = destination_folder + "/" + rom_code + ".3ds"
 
-            message = "Dumping %s to %s" % (rom_code, destination_folder)
-            task_text = "%s backup" % title
-
-            progress_bar = progress_bar_window("Dumping Rom", message, mode = "determinate", maximum = rom_size, task = task_text)
-            root.wait_visibility(progress_bar.window)
-
-            sd_card.dump_rom( slot, destination_file, progress=progress_bar)
+            card = sd_card
+            start = rom_list[slot][1]
+            worker.submit("Backup %s" % title,
+                          lambda progress, cancel: card.dump_rom(slot_at(card, start), destination_file, progress=progress, cancel=cancel))
         else:
             return
 
@@ -505,18 +624,10 @@ class Controller:
         if confirm == True:
             destination_file = destination_folder + "/" + rom_code + ".sav"
 
-            message = "Dumping save from %s to %s" % (rom_code, destination_folder)
-            task_text = "%s save backup" % title
-
-            progress_bar = progress_bar_window("Dumping Save", message, mode = "indeterminate", maximum = 100, task = task_text)
-
-            root.wait_visibility(progress_bar.progress)
-
-            progress_bar.start_indeterminate()
-
-            sd_card.dump_savegame( slot, destination_file )
-
-            progress_bar.progress_complete()
+            card = sd_card
+            start = rom_list[slot][1]
+            worker.submit("Backup save of %s" % title,
+                          lambda progress, cancel: card.dump_savegame(slot_at(card, start), destination_file))
 
         else:
             return
@@ -534,19 +645,10 @@ class Controller:
             # follow symlink
             file_path = os.path.realpath(file_path)
 
-            self.message = "Writing %s" % os.path.basename(file_path)
-
-            progress_bar = progress_bar_window("Writing Save", self.message, mode = "indeterminate", maximum = 100, task = "write save")
-
-            root.wait_visibility(progress_bar.progress)
-
-            progress_bar.start_indeterminate()
-
-            sd_card.write_savegame(file_path)
-
-            progress_bar.progress_complete()
-
-            controller.fill_rom_table()
+            card = sd_card
+            worker.submit("Write save %s" % os.path.basename(file_path),
+                          lambda progress, cancel: card.write_savegame(file_path),
+                          on_done = lambda result: self.refresh_rom_table(card))
 
         else:
             return
@@ -565,69 +667,134 @@ class Controller:
             pass
 
 
-class progress_bar_window:
-    def __init__(self, title, message, mode, maximum, task):
-        self.message = message
-        self.mode = mode
-        self.maximum = maximum
-        self.task = task
-
-        self.window = Toplevel(background = "#e2e2e2")
-        self.window.wm_attributes("-topmost", 1)
-        self.window.resizable(0,0) # stops user from resizing window
-        self.window.title(title)
-        self.window.grab_set()
-
-        self.create_widgets()
-
-        self.window.protocol('WM_DELETE_WINDOW', self.on_progress_bar_close )
-
-        self.bar_position = 0
-
-        self.start_indeterminate()
-
-    def create_widgets(self):
-
-        frame_master = Frame(self.window, padding = 5)
-
-        label_message = Label(frame_master, text = self.message)
-        label_message.pack()
-
-        self.progress = ttk.Progressbar(frame_master, mode = self.mode, orient="horizontal", length = 300)
-        self.progress.pack()
-        self.progress['maximum'] = self.maximum
-
-        frame_master.pack()
-
-    def start_indeterminate(self):
-        if self.mode == "indeterminate":
-            self.progress.start(50)
-            root.update_idletasks()
-        else:
+class Job:
+    def __init__(self, title, function, on_done, error):
+        self.title = title
+        self.function = function
+        self.on_done = on_done
+        self.error = error
+        self.cancel = CancelToken()
+        self.status = "Waiting"
+
+class Worker:
+    """Runs disk and network operations in a background thread
+
+    Jobs are queued and run one after another, so the window never freezes
+    and several operations can be lined up. The worker thread never touches
+    Tk: progress events and results go through a queue, which is polled
+    from the Tk main loop with root.after. Waiting jobs can be cancelled,
+    running rom writes and dumps stop at the next chunk."""
+
+    def __init__(self, job_table, poll_interval = 100):
+        self.job_table = job_table
+        self.poll_interval = poll_interval
+        self.jobs = Queue.Queue()
+        self.results = Queue.Queue()
+        self.pending = {}
+        self.running = None
+        self.next_id = 0
+        self.quitting = False
+
+        thread = threading.Thread(target = self.run)
+        thread.daemon = True
+        thread.start()
+
+        root.after(self.poll_interval, self.poll)
+
+    def submit(self, title, function, on_done = None, error = None):
+        """Queue function(progress, cancel) to run in the background
+
+        on_done(result) is called in the Tk main loop when it finished, a
+        failed job shows error (or its exception)."""
+
+        job = Job(title, function, on_done, error)
+        self.next_id += 1
+        job.id = str(self.next_id)
+        self.pending[job.id] = job
+        self.job_table.insert("", "end", job.id, values = [job.title, job.status])
+        self.jobs.put(job)
+        return job
+
+    def cancel(self, job_id):
+        if job_id in self.pending:
+            job = self.pending[job_id]
+            if job is self.running:
+                job.status = "Cancelling..."
+            else:
+                job.status = "Cancelled"
+            job.cancel.cancel()
+            self.job_table.set(job.id, '#2', job.status)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job.cancel.is_cancelled():
+                self.results.put((job, 'cancelled', None))
+                continue
+
+            self.results.put((job, 'started', None))
+            try:
+                result = job.function(lambda event: self.results.put((job, 'progress', event)), job.cancel)
+                self.results.put((job, 'done', result))
+            except Cancelled:
+                self.results.put((job, 'cancelled', None))
+            except Exception as e:
+                self.results.put((job, 'error', e))
+
+    def poll(self):
+        try:
+            while True:
+                job, kind, payload = self.results.get_nowait()
+                self.handle(job, kind, payload)
+        except Queue.Empty:
             pass
 
-    def update(self, total_written):
-        amount = total_written - self.bar_position
-
-        self.bar_position = self.bar_position + amount
-
-        if total_written == self.maximum:
-            self.progress_complete()
+        if self.quitting and not self.running and not self.pending:
+            root.quit()
         else:
-            self.progress["value"] = total_written
-            self.progress.update_idletasks()
-
-    def progress_complete(self):
-        capital_task = self.task.capitalize()
-        message = "%s successful." % capital_task
-        self.window.grab_release()
-        self.window.wm_attributes("-topmost", 0)
-        done = tkMessageBox.showinfo("Complete", message)
-        self.window.destroy()
+            root.after(self.poll_interval, self.poll)
+
+    def handle(self, job, kind, payload):
+        if kind == 'started':
+            self.running = job
+            if not job.cancel.is_cancelled():
+                job.status = "Running"
+        elif kind == 'progress':
+            if not job.cancel.is_cancelled():
+                job.status = self.format_progress(payload)
+        else:
+            if self.running is job:
+                self.running = None
+            del self.pending[job.id]
+            self.job_table.delete(job.id)
+
+            if kind == 'done':
+                if job.on_done:
+                    job.on_done(payload)
+            elif kind == 'error':
+                tkMessageBox.showerror("Something broke.", "%s failed:\n%s" % (job.title, job.error or payload))
+            return
 
-    def on_progress_bar_close(self):
-        message = "Please wait for %s to complete." % self.task
-        tkMessageBox.showinfo("Cannot Close", message)
+        self.job_table.set(job.id, '#2', job.status)
+
+    def format_progress(self, event):
+        status = "%d%% (%d of %d MB)" % (100 * event.fraction(), event.done / 1024 / 1024, event.total / 1024 / 1024)
+        if event.average_rate:
+            status += ", %.1f MB/s" % (event.average_rate / 1024 / 1024)
+        if event.eta != None and not event.finished:
+            status += ", %d:%02d left" % (event.eta / 60, event.eta % 60)
+        return status
+
+    def quit(self):
+        if self.pending:
+            if not tkMessageBox.askyesno("Quit", "There are unfinished jobs. Cancel them and quit?"):
+                return
+            for job_id in list(self.pending):
+                self.cancel(job_id)
+            # wait for the running job to stop, see poll
+            self.quitting = True
+        else:
+            root.quit()
 
 
 class update_template:
@@ -660,21 +827,10 @@ class update_template:
 
 class update_titles:
     def __init__(self):
-        try:
-            message = "Update Titles database"
-
-            progress_bar = progress_bar_window("Updating Titles", message, mode="indeterminate", maximum = 100, task = "Titles update")
-
-            root.wait_visibility(progress_bar.progress)
-
-            progress_bar.start_indeterminate()
-
-            titles.update_title_db()
-
-            progress_bar.progress_complete()
-
-        except:
-            raise Exception("Titles database could not be updated.")
+        worker.submit("Update titles database",
+                      lambda progress, cancel: titles.update_title_db(),
+                      on_done = lambda result: controller.refresh_rom_table(),
+                      error = "Titles database could not be updated.")
 
 
 class format_disk:
@@ -774,17 +930,11 @@ class format_disk:
         # pass it along to disk class
         disk_to_format = disk_functions.Sky3DS_Disk(sd)
 
-        message = "Formatting %s" % sd
-
-        progress_bar = progress_bar_window("Formatting Disk", message, mode="indeterminate", maximum = 100, task = "format")
-
-        root.wait_visibility(progress_bar.progress)
-
-        progress_bar.start_indeterminate()
-
-        disk_to_format.format()
+        worker.submit("Format %s" % sd,
+                      lambda progress, cancel: disk_to_format.format(),
+                      on_done = lambda result: controller.refresh_rom_table(disk_to_format))
 
-        progress_bar.progress_complete()
+        self.on_format_window_close()
 
     def on_format_window_close(self):
         view.update_disk_optionmenu()
@@ -840,4 +990,8 @@ class help_window:
 if __name__ == '__main__':
     controller = Controller()
     view = View(root)
+    worker = Worker(view.tree_job_table)
+    if sys.platform.startswith('linux'):
+        root.after(2000, view.poll_devices, devices.poll()[1])
+    root.protocol('WM_DELETE_WINDOW', worker.quit)
     root.mainloop()
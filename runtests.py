@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 import sys
 sys.path.append("third_party/appdirs")
-sys.path.append("third_party/progressbar")
 import unittest
 import sky3ds.test_disk
+import sky3ds.test_container
+import sky3ds.test_devices
+import sky3ds.test_transfer
+import sky3ds.test_catalog
+import sky3ds.test_library
+import sky3ds.test_pipeline
+import sky3ds.test_metrics
+import sky3ds.test_romtable
+import sky3ds.test_aio
 
-suite = unittest.TestLoader()
-suite = suite.loadTestsFromModule(sky3ds.test_disk)
+loader = unittest.TestLoader()
+suite = unittest.TestSuite()
+for module in [sky3ds.test_disk, sky3ds.test_container, sky3ds.test_devices, sky3ds.test_transfer, sky3ds.test_catalog, sky3ds.test_library, sky3ds.test_pipeline, sky3ds.test_metrics, sky3ds.test_romtable, sky3ds.test_aio]:
+    suite.addTests(loader.loadTestsFromModule(module))
 
 unittest.TextTestRunner().run(suite)
-
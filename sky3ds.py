@@ -2,35 +2,92 @@
 import os
 import sys
 import json
-import time
 import argparse
 import datetime
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-if not os.path.exists("third_party/appdirs/appdirs.py") or not os.path.exists("third_party/progressbar/progressbar"):
-    print("Uuuh!1 Can't find appdirs or progressbar module, did you load git submodules?!")
+if not os.path.exists("third_party/appdirs/appdirs.py"):
+    print("Uuuh!1 Can't find appdirs module, did you load git submodules?!")
     sys.exit(1)
 
 sys.path.append("third_party/appdirs")
-sys.path.append("third_party/progressbar")
 from appdirs import user_data_dir
 
-from sky3ds import disk, gamecard, titles
+# everything else is imported by the commands that need it, so short
+# commands (i.e. --list) start fast
+from sky3ds import catalog, container, disk, metrics, titles
+from sky3ds.disk import Sky3DS_Disk
+
+def print_table(table):
+    col_width = [max(len(str(x)) for x in col) for col in zip(*table)]
+    for line in table:
+        print("| " + " | ".join("{:{}}".format(x, col_width[i]) for i, x in enumerate(line)) + " |")
+
+def print_rom_table(card, verbose=False):
+    rom_table = [['Slot', 'Start', 'Size', 'Type', 'Code', 'Title']]
+    if verbose:
+        rom_table[0] += ['Sav-Crypt', 'Firm', 'Card ID', 'Unique ID']
+
+    for rom in card['roms']:
+        rom_table += [[
+            rom['slot'],
+            "%d MB" % int(rom['start'] / 1024 / 1024),
+            "%d MB" % int(rom['size'] / 1024 / 1024),
+            rom['card_type'],
+            rom['product_code'],
+            rom['title'],
+            ]]
+        if verbose:
+            rom_table[-1] += [
+                rom['save_crypto'].rjust(9),
+                rom['firmware'],
+                rom['card_id'],
+                rom['unique_id'],
+            ]
+
+    print_table(rom_table)
+
+    print("")
+    total_free_blocks = sum(512*i[1] for i in card['free_blocks'])
+    largest_free_blocks = 512 * card['free_blocks'][0][1] if card['free_blocks'] else 0
+
+    print("Disk Size: %d MB | Free space: %d MB | Largest free continous space: %d MB" % (card['disk_size']/1024/1024, total_free_blocks/1024/1024, largest_free_blocks/1024/1024))
+
+def print_inventory(results, verbose=False):
+    inventory_table = [['Disk', 'Size', 'Roms', 'Free', 'Largest free', 'Free extents', 'Fragmentation', 'Status']]
+    for result in results:
+        if result['is_sky3ds_disk']:
+            inventory_table += [[
+                result['disk_path'],
+                "%d MB" % int(result['disk_size'] / 1024 / 1024),
+                len(result['roms']),
+                "%d MB" % int(result['free'] / 1024 / 1024),
+                "%d MB" % int(result['largest_free'] / 1024 / 1024),
+                result['free_extents'],
+                "%d%%" % int(100 * result['fragmentation']),
+                "OK",
+                ]]
+        else:
+            inventory_table += [[result['disk_path'], "%d MB" % int(result['disk_size'] / 1024 / 1024) if 'disk_size' in result else "", "", "", "", "", "", result['error'] or "not a sky3ds disk"]]
+    print_table(inventory_table)
+
+    if verbose:
+        for result in results:
+            if result['is_sky3ds_disk']:
+                print("\n%s" % result['disk_path'])
+                print_table([['Slot', 'Code', 'Size', 'Title']] + [[rom['slot'], rom['product_code'], "%d MB" % int(rom['size'] / 1024 / 1024), rom['title']] for rom in result['roms']])
 
 try:
     data_dir = user_data_dir('sky3ds', 'Aperture Laboratories')
     template_txt = os.path.join(data_dir, 'template.txt')
-    template_json = os.path.join(data_dir, 'template.json')
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
+    # template.txt is converted when templates are needed, see titles.load_templates
     if not os.path.exists(template_txt):
         print("Please put template.txt in %s" % data_dir)
         sys.exit(1)
-    if not os.path.exists(template_json) or time.ctime(os.path.getmtime(template_txt)) > time.ctime(os.path.getmtime(template_json)):
-        print("Found updated template.txt. Converting...")
-        titles.convert_template_to_json()
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--disk', help='Sky3DS disk')
@@ -38,30 +95,210 @@ try:
     parser.add_argument('-l', '--list', help='List roms on disk (default operation)', action='store_true')
     parser.add_argument('-v', '--verbose', help='More details', action='store_true')
     parser.add_argument('-w', '--write', help='Write rom to disk')
+    parser.add_argument('-F', '--fanout', help='Write rom (--write) to all these disks at once', nargs='+')
     parser.add_argument('-H', '--do-not-use-header-bin', help='Ignore header.bin', action='store_true')
+    parser.add_argument('--rom-size', help='Size of a .gz/.xz/.bz2 rom (--write) in bytes, if the compressed file doesn\'t store it', type=int)
     parser.add_argument('-b', '--backup', help='Backup rom from disk')
     parser.add_argument('-r', '--remove', help='Remove rom from disk')
+    parser.add_argument('--resume', help='Continue an interrupted --write or --backup', action='store_true')
 
     parser.add_argument('-W', '--write-savegame', help='Write savegame to disk')
+    parser.add_argument('-S', '--write-savegames', help='Write all savegames from directory to disk')
     parser.add_argument('-B', '--backup-savegame', help='Backup savegame from disk')
 #    parser.add_argument('-R', '--erase-savegame', help='Erase savegame from disk')
     parser.add_argument('-Z', '--backup-all-savegames', help='Backup all savegames', action='store_true')
 
+    parser.add_argument('-z', '--compress', help='Compress rom/savegame backups', choices=container.codec_names()[1:])
+
+    parser.add_argument('--queue-depth', help='Number of reads in flight when reading from disk (default: from device profile)', type=int)
+    parser.add_argument('--daemon', help='Keep disks open and serve requests on --socket (default: daemon.sock next to template.txt)', action='store_true')
+    parser.add_argument('--socket', help='Send --list, --write, --backup, --remove, savegame, --inventory and --update requests to the daemon on this socket', nargs='?', const='')
+    parser.add_argument('--stats', help='Record timings of all operations: log (default), file.jsonl or file.prom (Prometheus textfile)', nargs='?', const='log')
+    parser.add_argument('-P', '--profile-device', help='Measure the sdcard reader and store the best chunk sizes for it', action='store_true')
+
     parser.add_argument('-s', '--slot', help='Slot ID for --backup and --backup-savegame')
 
     parser.add_argument('-f', '--format', help='Format disk', action="store_true")
     parser.add_argument('-c', '--confirm-format', action="store_true")
 
+    parser.add_argument('-k', '--clone', help='Copy roms and savegames to another disk (will be overwritten!)')
+    parser.add_argument('--repack', help='Store roms without gaps when cloning', action='store_true')
+    parser.add_argument('-x', '--export-image', help='Save used parts of disk to a compact image file (compress with -z)')
+    parser.add_argument('-X', '--import-image', help='Restore image file to disk (will be overwritten!)')
+    parser.add_argument('-t', '--transfer', help='Copy rom and savegame in --slot to another disk')
+    parser.add_argument('--move', help='Remove rom from disk after --transfer', action='store_true')
+
+    parser.add_argument('-y', '--sync', help='Plan how to get exactly these roms (serials or paths) on disk', nargs='+')
+    parser.add_argument('-e', '--execute', help='Execute the plan from --sync', action='store_true')
+
     parser.add_argument('-u', '--update', help='Update title database', action='store_true')
+    parser.add_argument('-D', '--devices', help='List sdcards and other block devices (Linux only)', action='store_true')
+    parser.add_argument('-I', '--inventory', help='List many disks at once (all disks if none are given, Linux only)', nargs='*')
+    parser.add_argument('--export', help='Export --inventory to .json or .csv file')
+    parser.add_argument('-C', '--catalog', help='List all known cards (they don\'t have to be plugged in)', action='store_true')
+
+    parser.add_argument('-i', '--index-library', help='Index all roms in a directory')
+    parser.add_argument('-q', '--query-library', help='Search indexed roms (use with --serial, --title, --with-template, --fits)', action='store_true')
+    parser.add_argument('--serial', help='Serial to search for')
+    parser.add_argument('--title', help='Title to search for')
+    parser.add_argument('--with-template', help='Only roms with template data', action='store_true')
+    parser.add_argument('--fits', help='Only roms that fit on disk (requires --disk)', action='store_true')
     args = parser.parse_args()
 
-    if not args.disk and not args.update:
+    if args.stats:
+        metrics.add_sink(metrics.open_sink(args.stats))
+
+    if args.daemon:
+        from sky3ds import daemon
+
+        daemon.serve(args.socket or None)
+        sys.exit(0)
+
+    if args.socket != None:
+        from sky3ds import daemon
+        from sky3ds.progress import TextBar
+
+        client = daemon.Client(args.socket or None)
+
+        if args.inventory != None:
+            results = client.request('inventory', disks=[os.path.abspath(i) for i in args.inventory])
+            print_inventory(results, args.verbose)
+            if args.export:
+                from sky3ds import inventory
+                inventory.export_inventory(results, args.export)
+            sys.exit(0)
+
+        if args.update and not args.disk:
+            client.request('update')
+            sys.exit(0)
+
+        if not args.disk:
+            print("No disk specified.")
+            sys.exit(1)
+        disk_path = os.path.abspath(args.disk)
+
+        if args.fanout or args.format or args.import_image or args.export_image or args.clone or args.transfer or args.sync or args.write_savegames or args.backup_all_savegames or args.profile_device:
+            print("This operation can't be sent to the daemon.")
+            sys.exit(1)
+
+        if (args.backup != None or args.backup_savegame != None) and args.slot == None:
+            print("Please specify slot")
+            sys.exit(1)
+
+        if args.update:
+            client.request('update')
+        if args.remove != None:
+            client.request('delete', disk=disk_path, slot=int(args.remove))
+            print("Removed rom from slot %d" % int(args.remove))
+        if args.backup != None:
+            client.request('dump', TextBar(), disk=disk_path, slot=int(args.slot), output=os.path.abspath(args.backup), compression=args.compress, queue_depth=args.queue_depth, resume=args.resume)
+        if args.backup_savegame != None:
+            client.request('dump_savegame', disk=disk_path, slot=int(args.slot), output=os.path.abspath(args.backup_savegame), compression=args.compress)
+        if args.write_savegame != None:
+            client.request('write_savegame', disk=disk_path, savegame=os.path.abspath(args.write_savegame))
+        if args.write != None:
+            client.request('write', TextBar(), disk=disk_path, rom=os.path.abspath(args.write), use_header_bin=not args.do_not_use_header_bin, resume=args.resume, rom_size=args.rom_size)
+
+        print_rom_table(client.request('list', disk=disk_path), args.verbose)
+        sys.exit(0)
+
+    if args.fanout:
+        from sky3ds import fanout
+
+        if args.write == None:
+            print("Please specify rom with --write.")
+            sys.exit(1)
+
+        fanout_status = {}
+        def fanout_progress(event):
+            fanout_status[event.target] = 100 * event.fraction()
+            sys.stdout.write("\r" + " | ".join("%s: %3d%%" % (i, fanout_status.get(i, 0)) for i in args.fanout))
+            sys.stdout.flush()
+
+        results = fanout.fanout_write_rom(args.fanout, args.write, use_header_bin=not args.do_not_use_header_bin, progress=fanout_progress, rom_size=args.rom_size)
+        print("")
+        for disk_path, error in results:
+            print("%s: %s" % (disk_path, error if error else "OK"))
+        sys.exit(0 if not [i for i in results if i[1]] else 1)
+
+    if args.index_library:
+        from sky3ds import library
+
+        scanned, failed = library.index_library(args.index_library)
+        print("Indexed %d roms (%d failed)" % (scanned, failed))
+        sys.exit(0)
+
+    if args.query_library:
+        from sky3ds import library
+
+        max_size = None
+        if args.fits:
+            if not args.disk:
+                print("No disk specified.")
+                sys.exit(1)
+            fits_disk = disk.Sky3DS_Disk(args.disk)
+            fits_disk.fail_on_non_sky3ds()
+            max_size = 512 * fits_disk.free_blocks[0][1] if fits_disk.free_blocks else 0
+
+        rom_table = [['Serial', 'Size', 'Type', 'Template', 'Title', 'Path']]
+        for entry in library.query(args.serial, args.title, True if args.with_template else None, max_size):
+            rom_table += [[
+                entry['serial'],
+                "%d MB" % int(entry['size'] / 1024 / 1024),
+                entry['card_type'],
+                "yes" if entry['has_template'] else "no",
+                entry['title'],
+                entry['path'],
+                ]]
+        print_table(rom_table)
+        sys.exit(0)
+
+    if args.devices:
+        from sky3ds import devices
+
+        device_table = [['Device', 'Size', 'Removable', 'Block size', 'Vendor', 'Model', 'Sky3DS']]
+        for device in devices.list_devices(include_empty=True):
+            device_table += [[
+                device['disk_path'],
+                "%d MB" % int(device['size'] / 1024 / 1024) if device['size'] else "no media",
+                "yes" if device['removable'] else "no",
+                "%d/%d" % (device['logical_block_size'], device['physical_block_size']),
+                device['vendor'],
+                device['model'],
+                {True: "yes", False: "no", None: "?"}[device['is_sky3ds_disk']],
+                ]]
+        print_table(device_table)
+        sys.exit(0)
+
+    if args.inventory != None:
+        from sky3ds import inventory
+
+        results = inventory.inventory(args.inventory or None)
+        print_inventory(results, args.verbose)
+
+        if args.export:
+            inventory.export_inventory(results, args.export)
+        sys.exit(0)
+
+    if args.catalog:
+        for card in catalog.known_cards():
+            print("Card %s (last seen %s at %s)" % (card['fingerprint'][:12], datetime.datetime.fromtimestamp(card['last_seen']).strftime("%Y-%m-%d %H:%M"), card['disk_path']))
+            print_rom_table(card, args.verbose)
+            print("")
+        sys.exit(0)
+
+    if args.update and not args.disk:
+        titles.update_title_db()
+        sys.exit(0)
+
+    if not args.disk:
         print("No disk specified.")
         sys.exit(1)
 
     disk = disk.Sky3DS_Disk(args.disk)
+    fingerprint = disk.fingerprint() if disk.is_sky3ds_disk else None
 
-    if (args.backup != None) + (args.write != None) + (args.remove != None) + (args.backup_savegame != None) + (args.write_savegame != None) + args.format + args.backup_all_savegames + args.update > 1:
+    if (args.backup != None) + (args.write != None) + (args.remove != None) + (args.backup_savegame != None) + (args.write_savegame != None) + (args.write_savegames != None) + (args.sync != None) + (args.clone != None) + (args.transfer != None) + (args.export_image != None) + (args.import_image != None) + args.profile_device + args.format + args.backup_all_savegames + args.update > 1:
         print("Please specify only one operation.")
         sys.exit(1)
 
@@ -71,10 +308,29 @@ try:
             sys.exit(1)
         disk.format()
 
+    if args.import_image != None:
+        if not args.confirm_format:
+            print("Importing an image overwrites %s, please confirm with '-c'." % args.disk)
+            sys.exit(1)
+        disk.import_image(args.import_image)
+
     if not args.update and not disk.is_sky3ds_disk:
         print("This is not a sky3ds disk. Aborting.")
         sys.exit(1)
 
+    if args.profile_device:
+        from sky3ds import tuning
+
+        def profile_progress(description):
+            sys.stdout.write("\rMeasuring %s...".ljust(60) % description)
+            sys.stdout.flush()
+        profile = tuning.profile_device(disk, progress=profile_progress)
+        print("\n\nProfile for %s\n" % profile['identity'])
+        print_table([['Read chunk size', 'Queue depth', 'Aligned', 'Throughput']] + [["%d KB" % (i['chunk_size'] / 1024), i['queue_depth'], "yes" if i['aligned'] else "no", "%.1f MB/s" % (i['throughput'] / 1024 / 1024)] for i in profile['reads']])
+        print("")
+        print_table([['Write chunk size', 'Throughput', 'fsync latency']] + [["%d KB" % (i['chunk_size'] / 1024), "%.1f MB/s" % (i['throughput'] / 1024 / 1024), "%.1f ms" % (i['fsync_latency'] * 1000)] for i in profile['writes']])
+        print("\nUsing %d KB reads (queue depth %d), %d KB writes, fsync after %s\n" % (profile['tuning']['read_chunk_size'] / 1024, profile['tuning']['queue_depth'], profile['tuning']['write_chunk_size'] / 1024, "every chunk" if profile['tuning']['fsync'] == 'chunk' else "the last chunk"))
+
     if args.remove != None:
         args.remove = int(args.remove)
         if args.remove in [i[0] for i in disk.rom_list]:
@@ -88,81 +344,91 @@ try:
         print("Please specify slot")
         sys.exit(1)
     elif args.backup != None and args.slot != None:
-        disk.dump_rom(int(args.slot), args.backup)
+        disk.dump_rom(int(args.slot), args.backup, compression=args.compress, queue_depth=args.queue_depth, resume=args.resume)
 
     if args.backup_savegame != None and args.slot == None:
         print("Please specify slot")
         sys.exit(1)
     elif args.backup_savegame != None and args.slot != None:
-        disk.dump_savegame(int(args.slot), args.backup_savegame)
+        disk.dump_savegame(int(args.slot), args.backup_savegame, compression=args.compress)
 
     if args.write_savegame != None:
         disk.write_savegame(args.write_savegame)
 
+    if args.write_savegames != None:
+        for savefile, result in disk.write_savegames(args.write_savegames):
+            print("%s: %s" % (savefile, result))
+
     if args.write != None:
-        disk.write_rom(args.write, use_header_bin=not args.do_not_use_header_bin, verbose=args.verbose)
+        disk.write_rom(args.write, use_header_bin=not args.do_not_use_header_bin, verbose=args.verbose, resume=args.resume, rom_size=args.rom_size)
 
-    rom_table = [['Slot', 'Start', 'Size', 'Type', 'Code', 'Title']]
-    if args.verbose:
-        rom_table[0] += ['Sav-Crypt', 'Firm', 'Card ID', 'Unique ID']
+    if args.clone != None:
+        from sky3ds import transfer
+
+        if not args.confirm_format:
+            print("Cloning overwrites %s, please confirm with '-c'." % args.clone)
+            sys.exit(1)
+        transfer.clone(disk, Sky3DS_Disk(args.clone), repack=args.repack, queue_depth=args.queue_depth)
+
+    if args.export_image != None:
+        disk.export_image(args.export_image, compression=args.compress, queue_depth=args.queue_depth)
+
+    if args.transfer != None and args.slot == None:
+        print("Please specify slot")
+        sys.exit(1)
+    elif args.transfer != None:
+        from sky3ds import transfer
+
+        target_disk = Sky3DS_Disk(args.transfer)
+        target_fingerprint = target_disk.fingerprint() if target_disk.is_sky3ds_disk else None
+        transfer.transfer_slot(disk, int(args.slot), target_disk, delete_source=args.move, queue_depth=args.queue_depth)
+        catalog.card_listing(target_disk, replaces=target_fingerprint)
+
+    if args.sync != None:
+        from sky3ds import sync
+
+        plan = sync.plan_sync(disk, args.sync)
+        plan_table = [['Operation', 'Code', 'Size', 'From', 'To', 'Rom']]
+        for op in plan:
+            plan_table += [[
+                op['op'],
+                op['product_code'],
+                "%d MB" % int(op['size'] / 1024 / 1024),
+                "%d MB" % int(op.get('from', op.get('start', 0)) / 1024 / 1024) if op['op'] != 'write' else "",
+                "%d MB" % int(op['to'] / 1024 / 1024) if 'to' in op else "",
+                op.get('path', ""),
+                ]]
+        print_table(plan_table)
+        print("\n%d MB to write\n" % int(sum(op['bytes'] for op in plan) / 1024 / 1024))
+
+        if args.execute:
+            sync.execute_sync(disk, plan, use_header_bin=not args.do_not_use_header_bin)
+        else:
+            print("Use --execute to apply this plan.\n")
+
+    # operations that change rom position headers or sky3ds headers
+    changed = args.format or args.import_image != None or args.remove != None or args.write != None or args.write_savegame != None or args.write_savegames != None or (args.sync != None and args.execute) or (args.transfer != None and args.move)
+    card = catalog.card_listing(disk, replaces=fingerprint, fingerprint=None if changed else fingerprint)
 
     if args.backup_all_savegames:
-        for rom in disk.rom_list:
-            slot = rom[0]
-            rom_header = disk.ncsd_header(slot)
-            rom_info = titles.rom_info(rom_header['product_code'], rom_header['media_id'])
+        for rom in card['roms']:
+            slot = rom['slot']
 
             savegames_dir = os.path.join(data_dir, 'savegames')
 
             if not os.path.exists(savegames_dir):
                 os.mkdir(savegames_dir)
 
-            savegame_dir = os.path.join(savegames_dir, ''.join(filter(lambda x: x in '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-+& ', rom_info['name'])))
+            savegame_dir = os.path.join(savegames_dir, ''.join(filter(lambda x: x in '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-+& ', rom['title'])))
 
             if not os.path.exists(savegame_dir):
                 os.mkdir(savegame_dir)
 
-            savegame_file = os.path.join(savegame_dir, "%s_%s.sav" % (rom_header['product_code'], datetime.datetime.now().strftime("%Y_%m_%d__%H_%M")))
-            disk.dump_savegame(slot, savegame_file)
-
-    for rom in disk.rom_list:
-        slot = rom[0]
-        start = rom[1]
-        size = rom[2]
-        rom_header = disk.ncsd_header(slot)
-        sky3ds_header = disk.sky3ds_header(slot)
-        card_id = " ".join("%.2x" % x for x in sky3ds_header[0x04:0x08]).upper()
-        unique_id = " ".join("%.2x" % x for x in sky3ds_header[0x40:0x50]).upper()
-        rom_info = titles.rom_info(rom_header['product_code'], rom_header['media_id'])
-        if rom_info:
-            title = rom_info['name']
-            firmware = rom_info['firmware']
-        else:
-            title = "???"
-            firmware = "???"
-        rom_table += [[
-            slot,
-            "%d MB" % int(rom[1] / 1024 / 1024),
-            "%d MB" % int(rom[2] / 1024 / 1024),
-            rom_header['card_type'],
-            rom_header['product_code'],
-            title,
-            ]]
-        if args.verbose:
-            rom_table[-1] += [
-                rom_header['save_crypto'].rjust(9),
-                firmware,
-                card_id,
-                unique_id,
-            ]
-
-    col_width = [max(len(str(x)) for x in col) for col in zip(*rom_table)]
-    for line in rom_table:
-        print("| " + " | ".join("{:{}}".format(x, col_width[i]) for i, x in enumerate(line)) + " |")
-
-    print("")
-    total_free_blocks = sum(512*i[1] for i in disk.free_blocks)
+            savegame_file = os.path.join(savegame_dir, "%s_%s.sav" % (rom['product_code'], datetime.datetime.now().strftime("%Y_%m_%d__%H_%M")))
+            if args.compress:
+                savegame_file += container.EXTENSION
+            disk.dump_savegame(slot, savegame_file, compression=args.compress)
 
-    print("Disk Size: %d MB | Free space: %d MB | Largest free continous space: %d MB" % (disk.disk_size/1024/1024, total_free_blocks/1024/1024, 512 * disk.free_blocks[0][1]/1024/1024))
+    print_rom_table(card, args.verbose)
 except Exception as e:
     logging.error(e)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""asyncio interface for Sky3DS_Disk (Python 3.5+)
+
+    card = await AsyncSky3DSDisk.open('/dev/sdb')
+    operation = card.write_rom('game.3ds')
+    async for event in operation:
+        print(event.done, event.total)
+    await operation
+
+The blocking Sky3DS_Disk calls run on a bounded thread pool, so many cards
+can be driven from one event loop."""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from sky3ds import catalog, disk
+from sky3ds.progress import CancelToken
+
+# threads for all cards without their own executor, see default_executor
+max_workers = 16
+_executor = None
+
+def default_executor():
+    global _executor
+    if _executor == None:
+        _executor = ThreadPoolExecutor(max_workers)
+    return _executor
+
+class Operation:
+    """A Sky3DS_Disk call running in the background
+
+    It starts right away. Await it for the result (exceptions of the call
+    are raised there, Cancelled after cancel()). Iterating over it with
+    async for yields the ProgressEvents of the call until it's done, there
+    is only one iterator per operation."""
+
+    def __init__(self, card, function):
+        """Keyword Arguments:
+
+        card -- AsyncSky3DSDisk
+        function -- function(progress, cancel) doing the blocking work"""
+
+        self.loop = asyncio.get_event_loop()
+        self.events = asyncio.Queue()
+        self.cancel_token = CancelToken()
+        self.finished = False
+        self.task = asyncio.ensure_future(self.run(card, function))
+
+    def progress(self, event):
+        # called from the worker thread
+        self.loop.call_soon_threadsafe(self.events.put_nowait, event)
+
+    async def run(self, card, function):
+        try:
+            async with card.semaphore:
+                self.cancel_token.check()
+                future = self.loop.run_in_executor(card.executor, function, self.progress, self.cancel_token)
+                try:
+                    return await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    # the task was cancelled (i.e. by asyncio.wait_for), the
+                    # thread can't be killed: stop it at the next chunk and
+                    # keep the card busy until it's done
+                    self.cancel_token.cancel()
+                    try:
+                        await future
+                    except Exception:
+                        pass
+                    raise
+        finally:
+            # after all progress events that are already on their way
+            self.loop.call_soon(self.events.put_nowait, None)
+
+    def cancel(self):
+        """Stop the call at its next chunk
+
+        Only rom writes and dumps can be stopped while they are running
+        (interrupted writes and dumps can be resumed later), everything else
+        is only stopped if it hasn't started yet."""
+
+        self.cancel_token.cancel()
+
+    def __await__(self):
+        return self.task.__await__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.finished:
+            raise StopAsyncIteration
+        event = await self.events.get()
+        if event == None:
+            self.finished = True
+            raise StopAsyncIteration
+        return event
+
+class AsyncSky3DSDisk:
+    """asyncio facade for a Sky3DS_Disk
+
+    Every call returns an Operation. At most concurrency calls run on the
+    same card at once (the others wait), which should be 1 unless only
+    reads (dumps, listings) are done: sdcards don't get faster with more
+    requests and writes to the same card have to be serialized anyway.
+    Use one AsyncSky3DSDisk per card."""
+
+    def __init__(self, sky3ds_disk, concurrency=1, executor=None):
+        """Keyword Arguments:
+
+        sky3ds_disk -- opened Sky3DS_Disk (see open)
+        concurrency -- number of calls running at once on this card
+        executor -- thread pool for the blocking calls (default: shared
+                    pool with max_workers threads)"""
+
+        self.disk = sky3ds_disk
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = executor or default_executor()
+
+    @classmethod
+    async def open(cls, disk_path, concurrency=1, executor=None):
+        """Open a card (and read its rom list) without blocking the loop"""
+
+        executor = executor or default_executor()
+        def open_disk():
+            sky3ds_disk = disk.Sky3DS_Disk(disk_path)
+            sky3ds_disk.rom_list
+            return sky3ds_disk
+        sky3ds_disk = await asyncio.get_event_loop().run_in_executor(executor, open_disk)
+        return cls(sky3ds_disk, concurrency, executor)
+
+    @property
+    def disk_path(self):
+        return self.disk.disk_path
+
+    @property
+    def rom_list(self):
+        """Rom list as of the last call (doesn't touch the card)"""
+        return self.disk.rom_list
+
+    def listing(self, replaces=None):
+        """Rom listing, see catalog.card_listing"""
+        return Operation(self, lambda progress, cancel: catalog.card_listing(self.disk, replaces=replaces))
+
+    def write_rom(self, rom, **kwargs):
+        """See Sky3DS_Disk.write_rom"""
+        return Operation(self, lambda progress, cancel: self.disk.write_rom(rom, progress=progress, cancel=cancel, **kwargs))
+
+    def dump_rom(self, slot, output, **kwargs):
+        """See Sky3DS_Disk.dump_rom"""
+        return Operation(self, lambda progress, cancel: self.disk.dump_rom(slot, output, progress=progress, cancel=cancel, **kwargs))
+
+    def delete_rom(self, slot):
+        return Operation(self, lambda progress, cancel: self.disk.delete_rom(slot))
+
+    def dump_savegame(self, slot, output, compression=None):
+        return Operation(self, lambda progress, cancel: self.disk.dump_savegame(slot, output, compression=compression))
+
+    def write_savegame(self, savefile):
+        return Operation(self, lambda progress, cancel: self.disk.write_savegame(savefile))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import threading
+from appdirs import user_data_dir
+
+from sky3ds import metrics, titles
+
+data_dir = user_data_dir('sky3ds', 'Aperture Laboratories')
+catalog_json = os.path.join(data_dir, 'catalog.json')
+
+# several cards may be listed at the same time (see inventory.py)
+catalog_lock = threading.Lock()
+
+# last_seen of unchanged cards is only updated (and the catalog written)
+# this often, in seconds
+last_seen_interval = 3600
+
+def load_catalog():
+    """Load all known cards, keyed by fingerprint (see Sky3DS_Disk.fingerprint)"""
+    try:
+        catalog_json_fp = open(catalog_json)
+        catalog = json.load(catalog_json_fp)
+        catalog_json_fp.close()
+        return catalog
+    except:
+        return {}
+
+def save_catalog(catalog):
+    tmp_catalog_json = catalog_json + ".tmp"
+    catalog_json_fp = open(tmp_catalog_json, "w")
+    catalog_json_fp.write(json.dumps(catalog))
+    catalog_json_fp.close()
+    if os.name == 'nt' and os.path.exists(catalog_json):
+        os.remove(catalog_json)
+    os.rename(tmp_catalog_json, catalog_json)
+
+def titles_stamp():
+    """Changes whenever the title database is updated"""
+    try:
+        return os.path.getmtime(titles.titles_json)
+    except:
+        return None
+
+def lookup_title(rom):
+    """Look up title and firmware of a rom in the title database"""
+    rom_info = titles.rom_info(rom['product_code'], rom['media_id'])
+    rom['title'] = rom_info['name'] if rom_info else "???"
+    rom['firmware'] = rom_info['firmware'] if rom_info else "???"
+
+def lookup_titles(card):
+    """(Re)lookup titles of all roms on a card in the title database"""
+    for rom in card['roms']:
+        lookup_title(rom)
+    card['titles_stamp'] = titles_stamp()
+
+def read_card(disk, on_rom=None):
+    """Read everything that is needed to list the roms on a card
+
+    This reads the ncsd header and sky3ds header of every rom and looks up
+    the titles in the title database.
+
+    Keyword Arguments:
+    disk -- Sky3DS_Disk
+    on_rom -- function(rom) called for every rom as soon as it's read"""
+
+    roms = []
+    for rom in disk.rom_list:
+        slot = rom[0]
+        rom_header = disk.ncsd_header(slot)
+        sky3ds_header = disk.sky3ds_header(slot)
+        roms.append({
+            'slot': slot,
+            'start': rom[1],
+            'size': rom[2],
+            'card_type': rom_header['card_type'],
+            'product_code': rom_header['product_code'],
+            'media_id': rom_header['media_id'],
+            'save_crypto': rom_header['save_crypto'],
+            'writable_address': rom_header['writable_address'],
+            'card_id': " ".join("%.2x" % x for x in sky3ds_header[0x04:0x08]).upper(),
+            'unique_id': " ".join("%.2x" % x for x in sky3ds_header[0x40:0x50]).upper(),
+            })
+        lookup_title(roms[-1])
+        if on_rom:
+            on_rom(roms[-1])
+
+    return {
+        'disk_path': disk.disk_path,
+        'disk_size': disk.disk_size,
+        'rom_list': disk.rom_list,
+        'free_blocks': disk.free_blocks,
+        'roms': roms,
+        'titles_stamp': titles_stamp(),
+        }
+
+@metrics.instrument('listing')
+def card_listing(disk, replaces=None, on_rom=None, fingerprint=None):
+    """Get the rom listing for a card, from the catalog if possible
+
+    If the fingerprint of the card is in the catalog the cached listing is
+    used, so only the position headers and sky3ds headers have to be read.
+    Otherwise the card is read completely and stored in the catalog.
+    Titles are looked up again if the title database changed. The catalog
+    is only written if anything changed (last_seen of cards that didn't
+    change is updated every last_seen_interval seconds).
+
+    Keyword Arguments:
+    disk -- Sky3DS_Disk
+    replaces -- fingerprint of this card before it was modified, this entry
+                gets removed from the catalog
+    on_rom -- function(rom) called for every rom as soon as it's known (see
+              read_card)
+    fingerprint -- fingerprint of the card if it's known already (saves
+                   reading the sky3ds headers again)"""
+
+    if fingerprint == None:
+        fingerprint = disk.fingerprint()
+    with catalog_lock:
+        card = load_catalog().get(fingerprint)
+
+    changed = not card
+    if card:
+        if card.get('titles_stamp') != titles_stamp():
+            lookup_titles(card)
+            changed = True
+        if on_rom:
+            for rom in card['roms']:
+                on_rom(rom)
+    else:
+        card = read_card(disk, on_rom)
+    now = int(time.time())
+    if card.get('disk_path') != disk.disk_path or now - card.get('last_seen', 0) >= last_seen_interval:
+        changed = True
+    card['fingerprint'] = fingerprint
+    card['disk_path'] = disk.disk_path
+    if changed:
+        card['last_seen'] = now
+
+    with catalog_lock:
+        catalog = load_catalog()
+        if replaces and replaces != fingerprint and replaces in catalog:
+            del catalog[replaces]
+            changed = True
+        if not changed:
+            return card
+        catalog[fingerprint] = card
+
+        try:
+            save_catalog(catalog)
+        except:
+            pass
+
+    return card
+
+def forget(fingerprint):
+    """Remove a card from the catalog (i.e. when it gets overwritten)"""
+    with catalog_lock:
+        catalog = load_catalog()
+        if not fingerprint in catalog:
+            return
+        del catalog[fingerprint]
+
+        try:
+            save_catalog(catalog)
+        except:
+            pass
+
+def known_cards():
+    """All cards in the catalog, most recently seen first"""
+    return sorted(load_catalog().values(), key=lambda x: x.get('last_seen', 0), reverse=True)
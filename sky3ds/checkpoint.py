@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+import os
+import json
+import logging
+import hashlib
+from appdirs import user_data_dir
+
+data_dir = user_data_dir('sky3ds', 'Aperture Laboratories')
+checkpoints_dir = os.path.join(data_dir, 'checkpoints')
+
+class Checkpoint:
+    """Progress of a rom write/dump, so it can be resumed after it died
+
+    The checkpoint is a small json file in the data directory, one for every
+    combination of operation, sdcard and rom file. It records where the
+    source came from (identity), where the data goes to (target) and how
+    many bytes are done, along with the sha1 of the last chunk, which is
+    checked before resuming. It's saved every interval bytes, right after
+    the data has been synced, so it never claims more than what's really
+    stored."""
+
+    def __init__(self, operation, disk_path, path, identity, sync, interval=0x4000000):
+        """Keyword Arguments:
+
+        operation -- 'write' or 'dump'
+        disk_path -- sdcard
+        path -- rom file that is written/dumped
+        identity -- dict identifying the source (size, mtime, header sha1, ...)
+        sync -- function that makes sure everything written is stored
+        interval -- save checkpoint every interval bytes"""
+
+        key = "%s\0%s\0%s" % (operation, os.path.realpath(disk_path), os.path.realpath(path))
+        self.checkpoint_file = os.path.join(checkpoints_dir, "%s.json" % hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+        self.state = {
+            'operation': operation,
+            'disk_path': disk_path,
+            'path': path,
+            'identity': identity,
+            'target': None,
+            'completed': 0,
+            'last_chunk_sha1': None,
+            'last_chunk_length': 0,
+            }
+        self.sync = sync
+        self.interval = interval
+        self.saved = 0
+        self.last_chunk = None
+
+    def load(self):
+        """Load the checkpoint of a previous run
+
+        Returns the target and the number of completed bytes, (None, 0) if
+        there is nothing to resume. A checkpoint of a source that changed
+        since then is thrown away."""
+
+        try:
+            checkpoint_fp = open(self.checkpoint_file)
+            state = json.load(checkpoint_fp)
+            checkpoint_fp.close()
+        except:
+            return (None, 0)
+
+        if state['identity'] != self.state['identity']:
+            logging.warning("%s changed since the last run, starting over." % self.state['path'])
+            self.remove()
+            return (None, 0)
+
+        self.state = state
+        self.saved = state['completed']
+        return (state['target'], state['completed'])
+
+    def verify(self, read_at):
+        """Check the last completed chunk against its sha1
+
+        Keyword Arguments:
+        read_at -- function(offset, length) reading from the target, offsets
+                   relative to the start of the rom"""
+
+        length = self.state['last_chunk_length']
+        if not length:
+            return True
+        data = read_at(self.state['completed'] - length, length)
+        return hashlib.sha1(data).hexdigest() == self.state['last_chunk_sha1']
+
+    def begin(self, target, completed=0):
+        self.state['target'] = target
+        self.state['completed'] = completed
+        self.saved = completed
+
+    def update(self, completed, chunk):
+        self.state['completed'] = completed
+        self.last_chunk = chunk
+        if completed - self.saved >= self.interval:
+            self.save()
+
+    def save(self):
+        if self.state['completed'] == self.saved:
+            return
+        self.sync()
+        self.state['last_chunk_sha1'] = hashlib.sha1(self.last_chunk).hexdigest()
+        self.state['last_chunk_length'] = len(self.last_chunk)
+
+        if not os.path.exists(checkpoints_dir):
+            os.makedirs(checkpoints_dir)
+        tmp_checkpoint_file = self.checkpoint_file + ".tmp"
+        checkpoint_fp = open(tmp_checkpoint_file, "w")
+        checkpoint_fp.write(json.dumps(self.state))
+        checkpoint_fp.close()
+        if os.name == 'nt' and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+        os.rename(tmp_checkpoint_file, self.checkpoint_file)
+        self.saved = self.state['completed']
+
+    def abort(self):
+        """Save what's done so far after an error (if the sdcard is still there)"""
+        try:
+            self.save()
+        except:
+            pass
+
+    def remove(self):
+        if os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+def file_identity(path, header):
+    """Identity of a rom file: size, mtime and sha1 of the (decompressed) header"""
+    path = os.path.realpath(path.rsplit(':', 1)[0] if not os.path.exists(path) and ':' in path else path)
+    return {
+        'path': path,
+        'size': os.path.getsize(path),
+        'mtime': int(os.path.getmtime(path)),
+        'header_sha1': hashlib.sha1(header).hexdigest(),
+        }
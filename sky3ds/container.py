@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+import os
+import sys
+import struct
+import zlib
+import bz2
+import collections
+
+try:
+    import lzma
+except:
+    lzma = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except:
+    ThreadPoolExecutor = None
+
+# Container layout:
+#
+# 0x00 - 0x40  header: magic, version, codec, block size, offset of the block
+#              index (relative to the start of the container), uncompressed
+#              size and block count
+# 0x40 - ...   independently compressed blocks
+# index        (offset, compressed length) of every block, 12 bytes each
+#
+# A compressed length of 0 marks a block which is completely filled with 0xff
+# (free space and padding in roms/savegames), those aren't stored at all.
+
+MAGIC = b'SKY3DSZ\x00'
+VERSION = 1
+EXTENSION = '.s3z'
+
+header_format = "<8sHHIQQI"
+header_length = 0x40
+index_entry_format = "<QI"
+index_entry_length = struct.calcsize(index_entry_format)
+
+CODECS = {
+    'store': 0,
+    'zlib': 1,
+    'bz2': 2,
+    'lzma': 3,
+}
+
+# Card image layout (see Sky3DS_Disk.export_image):
+#
+# 0x00 - 0x40  header: magic, version, size of the original sdcard, extent
+#              count and offset of the extent index
+# 0x40 - ...   one container per extent
+# index        (start on sdcard, length, offset of container) of every
+#              extent, 24 bytes each
+#
+# The first extent is always 0x0 - 0x2000000 (rom position headers and Card1
+# savegames), followed by the roms in the order they are stored on sdcard.
+# Free space isn't stored at all.
+
+IMAGE_MAGIC = b'SKY3DSI\x00'
+IMAGE_VERSION = 1
+IMAGE_EXTENSION = '.s3i'
+
+image_header_format = "<8sHQIQ"
+image_entry_format = "<QQQ"
+image_entry_length = struct.calcsize(image_entry_format)
+
+def write_image_header(fp, disk_size, extents):
+    """Write extent index at the current position of fp and the image header
+    at the start of fp
+
+    Keyword Arguments:
+    fp -- image file object
+    disk_size -- size of the original sdcard
+    extents -- list of (start on sdcard, length, offset of container)"""
+
+    index_offset = fp.tell()
+    for extent in extents:
+        fp.write(struct.pack(image_entry_format, *extent))
+    fp.seek(0)
+    fp.write(struct.pack(image_header_format, IMAGE_MAGIC, IMAGE_VERSION, disk_size, len(extents), index_offset))
+
+def read_image_header(fp):
+    """Read image header and extent index
+
+    Returns (size of the original sdcard, list of (start, length, offset))"""
+
+    fp.seek(0)
+    magic, version, disk_size, extent_count, index_offset = struct.unpack(image_header_format, fp.read(struct.calcsize(image_header_format)))
+    if magic != IMAGE_MAGIC:
+        raise Exception("Not a sky3ds card image")
+    if version != IMAGE_VERSION:
+        raise Exception("Unsupported card image version %d" % version)
+
+    fp.seek(index_offset)
+    raw_index = fp.read(extent_count * image_entry_length)
+    extents = [struct.unpack(image_entry_format, raw_index[i*image_entry_length:(i+1)*image_entry_length]) for i in range(extent_count)]
+    return disk_size, extents
+
+def _compress(codec, data):
+    if codec == CODECS['zlib']:
+        return zlib.compress(data, 6)
+    elif codec == CODECS['bz2']:
+        return bz2.compress(data, 9)
+    elif codec == CODECS['lzma']:
+        return lzma.compress(data)
+    return bytes(data)
+
+def _decompress(codec, data):
+    if codec == CODECS['zlib']:
+        return zlib.decompress(data)
+    elif codec == CODECS['bz2']:
+        return bz2.decompress(data)
+    elif codec == CODECS['lzma']:
+        return lzma.decompress(data)
+    return data
+
+def _pack_block(codec, data):
+    """Compress a block, returns None for blocks that are filled with 0xff"""
+    if data.count(b'\xff') == len(data):
+        return None
+    return _compress(codec, data)
+
+def codec_names():
+    """Names of codecs that can be used on this system"""
+    return [name for name in sorted(CODECS, key=lambda x: CODECS[x]) if name != 'lzma' or lzma]
+
+def is_container(path):
+    """Check if a file is a compressed sky3ds container"""
+    try:
+        fp = open(path, "rb")
+        magic = fp.read(len(MAGIC))
+        fp.close()
+    except:
+        return False
+    return magic == MAGIC
+
+def open_file(path):
+    """Open a file for reading, transparently decompressing containers"""
+    if is_container(path):
+        return ContainerReader(open(path, "rb"), close_fp=True)
+    return open(path, "rb")
+
+def strip_extension(path):
+    """Remove container extension from a filename (i.e. game.3dz.s3z -> game.3dz)"""
+    if path.endswith(EXTENSION):
+        return path[:-len(EXTENSION)]
+    return path
+
+class ContainerWriter:
+    """Write data to a blockwise compressed container
+
+    Data is split into blocks of block_size bytes which are compressed
+    independently in a thread pool, so compression keeps up with reading from
+    the sdcard. Blocks are written in order as soon as they are done.
+
+    The container is written at the current position of fp, which has to be
+    seekable because the header gets updated when the container is closed."""
+
+    def __init__(self, fp, codec='zlib', block_size=0x100000, threads=None):
+        """Keyword Arguments:
+
+        fp -- file object to write container to
+        codec -- compression codec (see codec_names())
+        block_size -- uncompressed size of a single block
+        threads -- number of compression threads (default: cpu count)"""
+
+        if not codec in codec_names():
+            raise Exception("Unsupported compression codec %s" % codec)
+
+        self.fp = fp
+        self.codec = CODECS[codec]
+        self.block_size = block_size
+        self.base = fp.tell()
+
+        self.size = 0
+        self.index = []
+        self.buffer = bytearray()
+
+        if not threads:
+            threads = os.cpu_count() if hasattr(os, 'cpu_count') else 2
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(self.threads) if ThreadPoolExecutor else None
+        self.pending = collections.deque()
+
+        self.fp.write(bytearray([0x00] * header_length))
+        self.offset = header_length
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block)
+
+    def _submit(self, block):
+        if self.executor:
+            self.pending.append(self.executor.submit(_pack_block, self.codec, block))
+            # don't buffer more blocks than there are threads to work on them
+            while len(self.pending) > self.threads * 2:
+                self._write_block(self.pending.popleft().result())
+        else:
+            self._write_block(_pack_block(self.codec, block))
+
+    def _write_block(self, packed):
+        if packed is None:
+            self.index.append((0, 0))
+            return
+        self.fp.write(packed)
+        self.index.append((self.offset, len(packed)))
+        self.offset += len(packed)
+
+    def close(self):
+        """Flush all blocks and write block index and header
+
+        This doesn't close the underlying file object."""
+
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self._write_block(self.pending.popleft().result())
+        if self.executor:
+            self.executor.shutdown()
+
+        index_offset = self.offset
+        for entry in self.index:
+            self.fp.write(struct.pack(index_entry_format, *entry))
+        end = self.fp.tell()
+
+        self.fp.seek(self.base)
+        self.fp.write(struct.pack(header_format, MAGIC, VERSION, self.codec, self.block_size, index_offset, self.size, len(self.index)))
+        self.fp.seek(end)
+
+    def abort(self):
+        """Stop compressing after an error
+
+        Blocks that aren't written yet are dropped and the header isn't
+        written, so the container stays invalid. This doesn't close the
+        underlying file object."""
+
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        if self.executor:
+            self.executor.shutdown()
+
+class ContainerReader:
+    """Read data from a blockwise compressed container
+
+    This behaves like a read-only file object, seeking is done through the
+    block index. When reading sequentially the next blocks are decompressed
+    in the background."""
+
+    def __init__(self, fp, close_fp=False, readahead=4):
+        """Keyword Arguments:
+
+        fp -- file object positioned at the start of the container
+        close_fp -- close fp when the reader is closed
+        readahead -- number of blocks to decompress in advance"""
+
+        self.fp = fp
+        self.close_fp = close_fp
+        self.base = fp.tell()
+
+        magic, version, self.codec, self.block_size, index_offset, self.size, block_count = struct.unpack(header_format, fp.read(struct.calcsize(header_format)))
+        if magic != MAGIC:
+            raise Exception("Not a sky3ds container")
+        if version != VERSION:
+            raise Exception("Unsupported container version %d" % version)
+        if self.codec == CODECS['lzma'] and not lzma:
+            raise Exception("lzma compression is not supported on this system")
+
+        fp.seek(self.base + index_offset)
+        raw_index = fp.read(block_count * index_entry_length)
+        self.index = [struct.unpack(index_entry_format, raw_index[i*index_entry_length:(i+1)*index_entry_length]) for i in range(block_count)]
+
+        self.position = 0
+        self.readahead = readahead
+        self.executor = ThreadPoolExecutor(readahead) if ThreadPoolExecutor and readahead else None
+        self.blocks = {}
+
+    def _fetch(self, block):
+        offset, length = self.index[block]
+        if length == 0:
+            return None
+        self.fp.seek(self.base + offset)
+        return self.fp.read(length)
+
+    def _block_length(self, block):
+        return min(self.block_size, self.size - block * self.block_size)
+
+    def _unpack(self, block, packed):
+        if packed is None:
+            return b'\xff' * self._block_length(block)
+        return _decompress(self.codec, packed)
+
+    def _block(self, block):
+        if not self.executor:
+            if not block in self.blocks:
+                self.blocks = {block: self._unpack(block, self._fetch(block))}
+            return self.blocks[block]
+
+        # forget blocks that are behind us, queue the ones ahead
+        for old in [i for i in self.blocks if i < block or i > block + self.readahead]:
+            del self.blocks[old]
+        for i in range(block, min(block + self.readahead + 1, len(self.index))):
+            if not i in self.blocks:
+                self.blocks[i] = self.executor.submit(self._unpack, i, self._fetch(i))
+        return self.blocks[block].result()
+
+    def read(self, length=-1):
+        if length is None or length < 0:
+            length = self.size - self.position
+        length = min(length, self.size - self.position)
+
+        data = bytearray()
+        while length > 0:
+            block = self.position // self.block_size
+            block_offset = self.position % self.block_size
+            chunk = self._block(block)[block_offset:block_offset + length]
+            data += chunk
+            self.position += len(chunk)
+            length -= len(chunk)
+        return bytes(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+        self.blocks = {}
+        if self.close_fp:
+            self.fp.close()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import signal
+import socket
+import logging
+import threading
+import contextlib
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from appdirs import user_data_dir
+
+from sky3ds import catalog, devices, disk, inventory, titles
+from sky3ds.progress import CancelToken, Cancelled, ProgressEvent
+
+data_dir = user_data_dir('sky3ds', 'Aperture Laboratories')
+default_socket = os.path.join(data_dir, 'daemon.sock')
+
+class ReadWriteLock:
+    """Many readers or a single writer, waiting writers go first"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    @contextlib.contextmanager
+    def reading(self):
+        with self.condition:
+            while self.writer or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+class Card:
+    """A sdcard kept open between requests
+
+    Reads (listing, dumps) of the same card run at the same time, changes
+    (writes, deletes) get the card for themselves, see ReadWriteLock."""
+
+    def __init__(self, disk_path):
+        self.disk_path = disk_path
+        self.lock = ReadWriteLock()
+        self.mutex = threading.Lock()
+        self.disk = None
+        self.signature = None
+        self.header = None
+
+    def current_signature(self):
+        # block devices change their signature when the card is swapped (see
+        # devices.signature), images when they are replaced
+        if self.disk_path.startswith('/dev/'):
+            return devices.signature(os.path.basename(os.path.realpath(self.disk_path)))
+        stat = os.stat(self.disk_path)
+        return (stat.st_dev, stat.st_ino, stat.st_size)
+
+    def get(self):
+        """Sky3DS_Disk for this card
+
+        The card is opened again if it was swapped or if its rom position
+        headers changed since the last request (other programs may have
+        changed them). A Sky3DS_Disk is never updated in place, requests
+        that are still reading keep the one they got."""
+
+        with self.mutex:
+            signature = self.current_signature()
+            if not self.disk or signature != self.signature or self.disk.read_at(0, 0x200) != self.header:
+                self.disk = disk.Sky3DS_Disk(self.disk_path)
+                self.signature = signature
+                self.header = self.disk.read_at(0, 0x200)
+            return self.disk
+
+    def changed(self, sky3ds_disk):
+        """Take over the rom position headers after a change through sky3ds_disk
+
+        Only call this while holding the write lock."""
+
+        with self.mutex:
+            if sky3ds_disk is self.disk:
+                self.header = sky3ds_disk.read_at(0, 0x200)
+
+    def close(self):
+        """Close the card, only call this while holding the write lock"""
+
+        with self.mutex:
+            if self.disk:
+                self.disk.diskfp.close()
+            self.disk = None
+
+def list_card(sky3ds_disk, request, progress, cancel):
+    sky3ds_disk.fail_on_non_sky3ds()
+    return catalog.card_listing(sky3ds_disk)
+
+def write_rom(sky3ds_disk, request, progress, cancel):
+    sky3ds_disk.write_rom(request['rom'], progress=progress, use_header_bin=request.get('use_header_bin', True), resume=request.get('resume', False), cancel=cancel, rom_size=request.get('rom_size'))
+
+def dump_rom(sky3ds_disk, request, progress, cancel):
+    sky3ds_disk.dump_rom(int(request['slot']), request['output'], progress=progress, compression=request.get('compression'), queue_depth=request.get('queue_depth'), resume=request.get('resume', False), cancel=cancel)
+
+def delete_rom(sky3ds_disk, request, progress, cancel):
+    sky3ds_disk.delete_rom(int(request['slot']))
+
+def dump_savegame(sky3ds_disk, request, progress, cancel):
+    sky3ds_disk.dump_savegame(int(request['slot']), request['output'], compression=request.get('compression'))
+
+def write_savegame(sky3ds_disk, request, progress, cancel):
+    sky3ds_disk.write_savegame(request['savegame'])
+
+# command -> (function(sky3ds_disk, request, progress, cancel), changes the card)
+commands = {
+    'list': (list_card, False),
+    'write': (write_rom, True),
+    'dump': (dump_rom, False),
+    'delete': (delete_rom, True),
+    'dump_savegame': (dump_savegame, False),
+    'write_savegame': (write_savegame, True),
+    }
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Keeps sdcards open and serves requests for them
+
+    Every connection is handled in its own thread. Requests are json
+    objects, one per line, with a 'command' and its arguments, i.e.
+
+        {"command": "dump", "disk": "/dev/sdb", "slot": 0, "output": "/tmp/rom.3ds"}
+
+    Progress events are sent as {"event": "progress", "progress": {...}}
+    (see ProgressEvent) while the request is running, it ends with
+    {"result": ...} or {"error": "message"}. Changing commands (write,
+    delete, write_savegame) return the new listing of the card. A running
+    request is cancelled when its client goes away."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        socketserver.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+        self.cards = {}
+        self.cards_lock = threading.Lock()
+
+    def card(self, disk_path):
+        if not disk_path:
+            raise Exception("No disk specified.")
+        with self.cards_lock:
+            if not disk_path in self.cards:
+                self.cards[disk_path] = Card(disk_path)
+            return self.cards[disk_path]
+
+    def execute(self, request, progress, cancel):
+        command = request.get('command')
+
+        if command == 'ping':
+            return 'pong'
+
+        if command == 'update':
+            titles.update_title_db()
+            return None
+
+        if command == 'inventory':
+            disk_paths = request.get('disks') or [device['disk_path'] for device in devices.list_devices()]
+            results = []
+            for disk_path in disk_paths:
+                # only look at the cards, they are opened read-only and not
+                # kept open; cards that are open already aren't changed while
+                # they're probed
+                with self.cards_lock:
+                    card = self.cards.get(disk_path)
+                if not card:
+                    results.append(inventory.probe(disk_path))
+                    continue
+                with card.lock.reading():
+                    results.append(inventory.probe(disk_path))
+            return results
+
+        if command == 'close':
+            card = self.card(request.get('disk'))
+            with card.lock.writing():
+                with self.cards_lock:
+                    self.cards.pop(card.disk_path, None)
+                card.close()
+            return None
+
+        if not command in commands:
+            raise Exception("Unknown command: %s" % command)
+
+        function, changes_card = commands[command]
+        card = self.card(request.get('disk'))
+        if not changes_card:
+            with card.lock.reading():
+                return function(card.get(), request, progress, cancel)
+
+        with card.lock.writing():
+            sky3ds_disk = card.get()
+            fingerprint = sky3ds_disk.fingerprint() if sky3ds_disk.is_sky3ds_disk else None
+            try:
+                function(sky3ds_disk, request, progress, cancel)
+            finally:
+                card.changed(sky3ds_disk)
+            return catalog.card_listing(sky3ds_disk, replaces=fingerprint)
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError:
+                self.send({'error': "Invalid request"})
+                continue
+
+            cancel = CancelToken()
+            def progress(event):
+                if not self.send({'event': 'progress', 'progress': dict(event.__dict__)}):
+                    cancel.cancel()
+
+            try:
+                result = self.server.execute(request, progress, cancel)
+            except Cancelled:
+                logging.info("%s cancelled" % request.get('command'))
+                self.send({'error': "Cancelled"})
+                continue
+            except Exception as e:
+                logging.error("%s failed: %s" % (request.get('command'), e))
+                self.send({'error': str(e)})
+                continue
+            self.send({'result': result})
+
+    def send(self, message):
+        """Send a line of json to the client, False if it went away"""
+        try:
+            self.wfile.write((json.dumps(message) + "\n").encode('utf-8'))
+            self.wfile.flush()
+            return True
+        except (IOError, OSError, socket.error):
+            return False
+
+def ping(socket_path):
+    try:
+        return Client(socket_path).request('ping') == 'pong'
+    except Exception:
+        return False
+
+def serve(socket_path=None):
+    """Run the daemon until it's killed (SIGTERM or ctrl-c)
+
+    Keyword Arguments:
+    socket_path -- unix socket to listen on (default: daemon.sock next to
+                   template.txt), only the current user can connect"""
+
+    if not hasattr(socket, 'AF_UNIX'):
+        raise Exception("Daemon mode needs unix sockets.")
+
+    socket_path = socket_path or default_socket
+    if os.path.exists(socket_path):
+        if ping(socket_path):
+            raise Exception("Daemon is already running on %s" % socket_path)
+        os.remove(socket_path)
+
+    # load the title database and templates once for all requests
+    try:
+        titles.load_titles()
+        titles.load_templates()
+    except:
+        pass
+
+    umask = os.umask(0o077)
+    try:
+        server = Server(socket_path)
+    finally:
+        os.umask(umask)
+
+    # clean up the socket when killed
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    logging.info("Listening on %s" % socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+class Client:
+    """Sends requests to a running daemon"""
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or default_socket
+
+    def request(self, command, progress=None, **arguments):
+        """Send a request and wait for its result
+
+        Keyword Arguments:
+        command -- see Server
+        progress -- function(ProgressEvent) called for progress events
+        arguments -- arguments of the command (paths have to be absolute)
+
+        Returns the result, errors of the request are raised."""
+
+        request = dict(arguments)
+        request['command'] = command
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                connection.connect(self.socket_path)
+            except socket.error as e:
+                raise Exception("Can't connect to daemon on %s: %s" % (self.socket_path, e))
+
+            connection.sendall((json.dumps(request) + "\n").encode('utf-8'))
+            for line in connection.makefile('rb'):
+                reply = json.loads(line.decode('utf-8'))
+                if 'event' in reply:
+                    if progress:
+                        progress(ProgressEvent(**reply['progress']))
+                elif 'error' in reply:
+                    raise Exception(reply['error'])
+                else:
+                    return reply.get('result')
+            raise Exception("Daemon closed the connection.")
+        finally:
+            connection.close()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import os
+import sys
+import stat
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+sysfs_block = '/sys/block'
+dev_dir = '/dev'
+
+# virtual devices that are never sdcards
+ignored_prefixes = ('loop', 'ram', 'zram', 'dm-', 'md', 'sr', 'fd', 'nbd')
+
+# built-in sdcard readers, they don't report their cards as removable
+sdcard_prefixes = ('mmcblk',)
+
+# _IOR(0x12, 114, size_t) from linux/fs.h
+BLKGETSIZE64 = 0x80081272
+
+# device name -> (signature, device), see list_devices
+_cache = {}
+
+def read_attribute(path, default=None):
+    try:
+        attribute_fp = open(path)
+        value = attribute_fp.read().strip()
+        attribute_fp.close()
+        return value
+    except:
+        return default
+
+def read_int(path, default=None):
+    try:
+        return int(read_attribute(path))
+    except:
+        return default
+
+def signature(name):
+    """Changes whenever a device shows up, goes away or gets another card
+
+    Size is always in 512 byte sectors in sysfs, diskseq (Linux 5.15+) is
+    increased on every media change, so swapping two cards of the same size
+    is noticed too."""
+
+    device_dir = os.path.join(sysfs_block, name)
+    return (read_attribute(os.path.join(device_dir, 'size')), read_attribute(os.path.join(device_dir, 'diskseq')))
+
+def check_magic(disk_path):
+    """Read just the "ROMS" magic at 0x100
+
+    Returns True/False, or None if the device can't be read (i.e. no
+    permission)."""
+
+    try:
+        diskfp = open(disk_path, "rb")
+        diskfp.seek(0x100)
+        magic = diskfp.read(0x4)
+        diskfp.close()
+    except:
+        return None
+    return magic == b'ROMS'
+
+def probe_device(name):
+    """Everything sysfs knows about a block device
+
+    Returns a dict (size in bytes) or None if it isn't a usable device"""
+
+    device_dir = os.path.join(sysfs_block, name)
+    sectors = read_int(os.path.join(device_dir, 'size'))
+    if sectors == None:
+        return None
+
+    disk_path = os.path.join(dev_dir, name)
+    size = sectors * 512
+    return {
+        'name': name,
+        'disk_path': disk_path,
+        'size': size,
+        'removable': read_int(os.path.join(device_dir, 'removable'), 0) == 1,
+        'logical_block_size': read_int(os.path.join(device_dir, 'queue', 'logical_block_size'), 512),
+        'physical_block_size': read_int(os.path.join(device_dir, 'queue', 'physical_block_size'), 512),
+        'vendor': read_attribute(os.path.join(device_dir, 'device', 'vendor'), ''),
+        'model': read_attribute(os.path.join(device_dir, 'device', 'model'), ''),
+        'is_sky3ds_disk': check_magic(disk_path) if size else False,
+        }
+
+def list_devices(include_empty=False, include_fixed=False):
+    """Find block devices that could be sdcards (Linux only)
+
+    Removable disks, built-in sdcard readers and disks with the "ROMS" magic
+    string in /sys/block are listed, never virtual devices like loop or
+    device-mapper devices. Results are cached, a device is only probed again
+    when its signature changes, so this is cheap enough to be polled for
+    hotplug events.
+
+    Keyword Arguments:
+    include_empty -- also list devices without media (i.e. empty readers)
+    include_fixed -- also list fixed disks (i.e. the system disk)
+
+    Returns a list of dicts (see probe_device), sorted by name"""
+
+    if not sys.platform.startswith('linux'):
+        raise Exception("Device discovery is only supported on Linux, please specify devices.")
+
+    try:
+        names = sorted(os.listdir(sysfs_block))
+    except:
+        names = []
+
+    devices = []
+    for name in names:
+        if name.startswith(ignored_prefixes):
+            continue
+        current = signature(name)
+        if not name in _cache or _cache[name][0] != current:
+            _cache[name] = (current, probe_device(name))
+        device = _cache[name][1]
+        if not device or not (device['size'] or include_empty):
+            continue
+        if device['removable'] or name.startswith(sdcard_prefixes) or device['is_sky3ds_disk'] or include_fixed:
+            devices.append(device)
+
+    # forget unplugged devices
+    for name in list(_cache):
+        if not name in names:
+            del _cache[name]
+
+    return devices
+
+def poll(last=None):
+    """Check for hotplug events
+
+    Keyword Arguments:
+    last -- state returned by the previous call
+
+    Returns (changed, state), changed is True if devices or cards were added
+    or removed since last."""
+
+    try:
+        names = sorted(i for i in os.listdir(sysfs_block) if not i.startswith(ignored_prefixes))
+    except:
+        names = []
+    state = [(name, signature(name)) for name in names]
+    return state != last, state
+
+def block_device_size(fileno):
+    """Size of an open block device in bytes (BLKGETSIZE64)
+
+    Returns None for regular files or if the ioctl isn't available."""
+
+    if not fcntl or not sys.platform.startswith('linux'):
+        return None
+    try:
+        if not stat.S_ISBLK(os.fstat(fileno).st_mode):
+            return None
+        return struct.unpack("Q", fcntl.ioctl(fileno, BLKGETSIZE64, b'\0' * 8))[0]
+    except:
+        return None
@@ -2,15 +2,10 @@
 import sys
 import os
 import struct
+import hashlib
 import logging
-import subprocess
-import plistlib
 import re
-
-try:
-    from progressbar import FileTransferSpeed, ProgressBar, Percentage, Bar
-except:
-    pass
+import threading
 
 try:
     from appdirs import user_data_dir
@@ -18,26 +13,107 @@ try:
 except:
     pass
 
-from sky3ds import gamecard, titles
+from sky3ds import checkpoint, container, devices, gamecard, metrics, pipeline, titles, tuning
+from sky3ds.progress import Progress
+
+class WriteBatch:
+    """Collect bulk writes and write them as whole allocation units
+
+    Sdcards erase and program flash in allocation units (AU, usually 4MB).
+    Writing only part of an AU makes the card read, merge and rewrite the
+    whole unit internally, several writes to the same AU do that several
+    times. WriteBatch collects writes of savegame slots and writes every
+    touched AU exactly once: untouched parts are read from sdcard first, then
+    the whole AU is written with all changes applied.
+
+    This only pays off for bulk data. Rom position headers and sky3ds
+    headers are a few bytes and are written directly with write_at, merging
+    them would read and rewrite a whole AU (AU 0 also holds the Card1
+    savegames from 0x100000 on) for every change.
 
-class Sky3DS_Disk:
-    """This class can manage a sdcard for sky3ds"""
+    Once more than max_size bytes are queued, they are written right away,
+    so a batch never holds more than that (plus one write) in memory."""
+
+    def __init__(self, disk, max_size=0x4000000):
+        """Keyword Arguments:
+
+        disk -- Sky3DS_Disk (AU size is taken from its tuning)
+        max_size -- flush when more than this many bytes are queued"""
+
+        self.disk = disk
+        self.au_size = disk.tuning['au_size']
+        self.max_size = max_size
+        self.writes = []
+        self.queued = 0
+
+    def write(self, offset, data):
+        """Queue a write, later writes to the same bytes win"""
+        if len(data):
+            self.writes.append((offset, bytes(data)))
+            self.queued += len(data)
+            if self.queued > self.max_size:
+                self.flush()
+
+    def runs(self):
+        """Ranges of consecutive AUs touched by the queued writes, as (start, end) in bytes"""
+        units = set()
+        for offset, data in self.writes:
+            units.update(range(offset // self.au_size, (offset + len(data) - 1) // self.au_size + 1))
+
+        runs = []
+        for unit in sorted(units):
+            if runs and runs[-1][1] == unit:
+                runs[-1][1] = unit + 1
+            else:
+                runs.append([unit, unit + 1])
+        return [(start * self.au_size, min(end * self.au_size, self.disk.disk_size)) for start, end in runs]
+
+    def flush(self):
+        """Write all queued writes (this doesn't fsync)"""
+        for start, end in self.runs()[::-1]:
+            writes = [(offset, data) for offset, data in self.writes if offset < end and start < offset + len(data)]
+            if len(writes) == 1 and writes[0][0] == start and len(writes[0][1]) == end - start:
+                self.disk.write_at(start, writes[0][1])
+                continue
+
+            buffer = bytearray(self.disk.read_at(start, end - start))
+            for offset, data in writes:
+                data_start = max(start, offset)
+                data_end = min(end, offset + len(data))
+                buffer[data_start - start:data_end - start] = data[data_start - offset:data_end - offset]
+            self.disk.write_at(start, buffer)
+        self.writes = []
+        self.queued = 0
+
+class Sky3DS_Disk(object):
+    """This class can manage a sdcard for sky3ds
+
+    All reads and writes go through read_at/write_at, which use positional
+    I/O (os.pread/os.pwrite) and never touch a shared file position. It's
+    safe to read from the same Sky3DS_Disk in several threads at once (i.e.
+    listing roms while dumping another one). Changes to the rom position
+    headers, sky3ds headers and savegame slots are serialized with
+    header_lock, writing rom data is not (different roms never overlap)."""
 
     diskfp = None
+    fileno = None
     disk_size = None
     disk_path = None
 
-    is_sky3ds_disk = False
+    # see is_sky3ds_disk, rom_list and free_blocks
+    _is_sky3ds_disk = None
+    _rom_list = None
+    _free_blocks = None
 
-    rom_list = []
-    free_blocks = []
-
-    def __init__(self, disk_path, diskfp=None, disk_size=None):
+    def __init__(self, disk_path, diskfp=None, disk_size=None, read_only=False):
         """Keyword Arguments:
 
-        disk_path -- Location to sdcard blockdevice (not mount or partition!)"""
+        disk_path -- Location to sdcard blockdevice (not mount or partition!)
+        read_only -- open the sdcard for reading only (listings, dumps)"""
 
         self.disk_path = disk_path
+        self.header_lock = threading.RLock()
+        self.io_lock = threading.Lock()
 
         if diskfp and disk_size:
             self.diskfp = diskfp
@@ -45,7 +121,7 @@ class Sky3DS_Disk:
 
         else:
             try:
-                self.diskfp = open(disk_path, "r+b")
+                self.diskfp = open(disk_path, "rb" if read_only else "r+b")
             except:
                 raise Exception("Couldn't open disk, can't continue.")
 
@@ -54,41 +130,168 @@ class Sky3DS_Disk:
             except:
                 raise Exception("Couldn't get disksize, will not continue.")
 
-        self.check_if_sky3ds_disk()
-
-        if self.is_sky3ds_disk:
-            self.update_rom_list()
+        # positional I/O needs a real file descriptor
+        try:
+            self.fileno = self.diskfp.fileno() if hasattr(os, 'pread') else None
+        except:
+            self.fileno = None
+
+        # chunk sizes etc. for this sdcard reader (see tuning.profile_device)
+        self.tuning = tuning.tuning_for(disk_path)
+
+    def _ensure_loaded(self):
+        # the sdcard is scanned when is_sky3ds_disk, rom_list or free_blocks
+        # are used for the first time, not when it's opened
+        with self.header_lock:
+            if self._rom_list is None:
+                with metrics.operation('open', disk=self.disk_path):
+                    self.check_if_sky3ds_disk()
+                    if self._is_sky3ds_disk:
+                        self.update_rom_list()
+                    else:
+                        self._rom_list = []
+                        self._free_blocks = []
+
+    @property
+    def is_sky3ds_disk(self):
+        if self._is_sky3ds_disk is None:
+            self._ensure_loaded()
+        return self._is_sky3ds_disk
+
+    @is_sky3ds_disk.setter
+    def is_sky3ds_disk(self, value):
+        self._is_sky3ds_disk = value
+
+    @property
+    def rom_list(self):
+        if self._rom_list is None:
+            self._ensure_loaded()
+        return self._rom_list
+
+    @rom_list.setter
+    def rom_list(self, value):
+        self._rom_list = value
+
+    @property
+    def free_blocks(self):
+        if self._free_blocks is None:
+            self._ensure_loaded()
+        return self._free_blocks
+
+    @free_blocks.setter
+    def free_blocks(self, value):
+        self._free_blocks = value
 
     def __del__(self):
         if self.diskfp:
             self.diskfp.close()
 
+    def read_at(self, offset, length):
+        """Read from sdcard without moving the file position
+
+        Falls back to seek + read (under a lock) where os.pread isn't
+        available (Windows, Python 2, file objects without a fileno).
+
+        Keyword Arguments:
+        offset -- position on sdcard in bytes
+        length -- number of bytes to read"""
+
+        if metrics.enabled:
+            metrics.count('bytes_read', length)
+
+        if self.fileno is None:
+            with self.io_lock:
+                self.diskfp.seek(offset)
+                return self.diskfp.read(length)
+
+        data = os.pread(self.fileno, length, offset)
+        while len(data) < length:
+            # short read (i.e. interrupted by a signal)
+            chunk = os.pread(self.fileno, length - len(data), offset + len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def write_at(self, offset, data):
+        """Write to sdcard without moving the file position
+
+        Keyword Arguments:
+        offset -- position on sdcard in bytes
+        data -- bytes to write"""
+
+        if metrics.enabled:
+            metrics.count('bytes_written', len(data))
+
+        if self.fileno is None:
+            with self.io_lock:
+                self.diskfp.seek(offset)
+                self.diskfp.write(data)
+                self.diskfp.flush()
+            return
+
+        data = memoryview(data)
+        while len(data):
+            written = os.pwrite(self.fileno, data, offset)
+            data = data[written:]
+            offset += written
+
+    def sync(self):
+        """Flush all writes to sdcard"""
+
+        with metrics.span('fsync', 'fsync_seconds'):
+            if self.fileno is None:
+                with self.io_lock:
+                    self.diskfp.flush()
+            try:
+                fileno = self.diskfp.fileno()
+            except:
+                # nothing to fsync (i.e. a BytesIO)
+                return
+            os.fsync(fileno)
+
     def fail_on_non_sky3ds(self):
         """Fail if disk is not formatted. This is just a sanity function."""
 
         if not self.is_sky3ds_disk:
             raise Exception("Disk is not formatted, won't continue.")
 
+    def read_extent(self, start, length, chunk_size=1024*1024*8, queue_depth=1):
+        """Read a region of the sdcard in chunks
+
+        With a queue_depth > 1 several chunks are read at once, which is a lot
+        faster with most USB sdcard readers (see pipeline.parallel_read).
+
+        Keyword Arguments:
+        start -- start of region in bytes
+        length -- length of region in bytes
+        chunk_size -- maximum size of the chunks
+        queue_depth -- number of chunks read at the same time"""
+
+        return pipeline.parallel_read(self.read_at, start, length, chunk_size, queue_depth)
+
     def check_if_sky3ds_disk(self):
         """Check if disk is actually a sky3ds sdcard
 
         This code looks for the "ROMS" string at 0x100."""
-        self.diskfp.seek(0x100)
-        disk_data = self.diskfp.read(0x4)
+        disk_data = self.read_at(0x100, 0x4)
         self.is_sky3ds_disk = (b'ROMS' == disk_data)
 
     def get_disk_size(self):
         """Get sdcard size in bytes
 
-        This currently is an ugly workaround. It seeks to the end of the sdcard
-        and reads how many bytes were skipped. This should be replaced with
-        something more clean."""
+        On Linux the size of block devices is asked from the kernel (see
+        devices.block_device_size), otherwise this seeks to the end of the
+        sdcard and reads how many bytes were skipped."""
 
         if sys.platform == 'darwin':
             # meh
             if not re.match("^\/dev\/disk[0-9]+$", self.disk_path):
                 raise Exception("Disk path must be in format /dev/diskN")
 
+            import subprocess
+            import plistlib
+
             try:
                 diskname = os.path.basename(self.disk_path)
                 diskutil_output = subprocess.check_output(["diskutil", "list", "-plist", self.disk_path])
@@ -108,13 +311,16 @@ class Sky3DS_Disk:
                 raise Exception("Can't get disk size from diskutil :(\nError was: %s" % e)
 
         else:
-            self.diskfp.seek(0, os.SEEK_END)
-            disk_size = self.diskfp.tell()
+            disk_size = devices.block_device_size(self.diskfp.fileno())
+            if disk_size == None:
+                self.diskfp.seek(0, os.SEEK_END)
+                disk_size = self.diskfp.tell()
             disk_size = disk_size - disk_size % 0x2000000
             if disk_size == 0:
                 raise Exception("0 byte disk?!")
             self.disk_size = disk_size
 
+    @metrics.instrument('format')
     def format(self):
         """Format sdcard
 
@@ -122,22 +328,22 @@ class Sky3DS_Disk:
         at 0x100 - 0x103 where the magic string "ROMS" is written.
         It also writes zeros to the area for Card1 savegames."""
 
-        self.diskfp.seek(0)
-        # fill first 0x200 bytes with 0xff except for magic string
-        self.diskfp.write(bytearray([0xff]*0x100))
-        self.diskfp.write(bytearray("ROMS", "ascii"))
-        self.diskfp.write(bytearray([0xff]*0xfc))
+        with self.header_lock:
+            # erase savegame slots
+            batch = WriteBatch(self)
+            for i in range(1, 32):
+                batch.write(i * 0x100000, bytearray([0xff] * 0x100000))
+            batch.flush()
+            self.sync()
 
-        # erase savegame slots
-        for i in range(1, 32):
-            self.diskfp.seek(i * 0x100000)
-            self.diskfp.write(bytearray([0xff] * 0x100000))
+            # fill first 0x200 bytes with 0xff except for magic string
+            self.write_at(0, bytearray([0xff]*0x100) + bytearray("ROMS", "ascii") + bytearray([0xff]*0xfc))
+            self.sync()
 
-        os.fsync(self.diskfp)
-
-        self.check_if_sky3ds_disk()
-        self.update_rom_list()
+            self.check_if_sky3ds_disk()
+            self.update_rom_list()
 
+    @metrics.phase('header_scan')
     def update_rom_list(self):
         """Read positions/sizes of roms in bytes and calculate regions of free blocks
 
@@ -154,9 +360,8 @@ class Sky3DS_Disk:
 
         self.fail_on_non_sky3ds()
 
-        self.diskfp.seek(0)
         position_header_length = 0x100
-        raw_positions = self.diskfp.read(position_header_length)
+        raw_positions = self.read_at(0, position_header_length)
         positions = []
         for i in range(0, int(position_header_length / 8)):
             position = struct.unpack("ii", raw_positions[i*8:i*8+8])
@@ -201,6 +406,24 @@ class Sky3DS_Disk:
 
         self.free_blocks = free_blocks
 
+    def fingerprint(self):
+        """Fingerprint of the current card layout
+
+        This is a sha1 over the disk size, the first 0x200 bytes (rom position
+        headers and magic string) and the sky3ds headers of all roms (which
+        contain the unique ids that change when savegames are restored). It's cheap to
+        calculate and changes whenever roms are written, deleted or savegames
+        are restored, so it's used to find out if cached data about the card
+        (see catalog.py) is still valid."""
+
+        self.fail_on_non_sky3ds()
+
+        fingerprint = hashlib.sha1(struct.pack("<Q", self.disk_size))
+        fingerprint.update(self.read_at(0, 0x200))
+        for rom in self.rom_list:
+            fingerprint.update(self.read_at(rom[1] + 0x1400, 0x200))
+        return fingerprint.hexdigest()
+
     ################
     # Rom Handling #
     ################
@@ -212,8 +435,7 @@ class Sky3DS_Disk:
 
         self.fail_on_non_sky3ds()
 
-        self.diskfp.seek(self.rom_list[slot][1])
-        return gamecard.ncsd_header(self.diskfp.read(0x1200))
+        return gamecard.ncsd_header(self.read_at(self.rom_list[slot][1], 0x1200))
 
     def sky3ds_header(self, slot):
         """Retrieve sky3ds specific header from rom on sdcard.
@@ -222,33 +444,32 @@ class Sky3DS_Disk:
 
         self.fail_on_non_sky3ds()
 
-        self.diskfp.seek(self.rom_list[slot][1] + 0x1400)
-        return bytearray(self.diskfp.read(0x200))
-
-    def write_rom(self, rom, silent=False, progress=None, use_header_bin=False, verbose=False):
-        """Write rom to sdcard.
-
-        Roms are stored at the position marked in the position headers (starting
-        at 0x2000000).
+        return bytearray(self.read_at(self.rom_list[slot][1] + 0x1400, 0x200))
 
-        This code first looks for a free block with enough space to hold the
-        specified rom, then continues to write the data to that location.
-        After successful writing the savegame slot for this game is filled with
-        zero.
-        The last thing to do is to find the game in template.txt and write the
-        data from that file to offset 0x1400 inside the rom on sdcard.
+    def is_free(self, start, size, ignore_slot=None):
+        """Check if a region on sdcard can be used for a rom
 
         Keyword Arguments:
-        rom -- path to rom file"""
+        start -- start of region in bytes
+        size -- size of region in bytes
+        ignore_slot -- the rom in this slot doesn't count as used space"""
 
-        self.fail_on_non_sky3ds()
+        if start < 0x2000000 or start + size > self.disk_size:
+            return False
+        for rom in self.rom_list:
+            if rom[0] == ignore_slot:
+                continue
+            if start < rom[1] + rom[2] and rom[1] < start + size:
+                return False
+        return True
 
-        # follow symlink
-        rom = os.path.realpath(rom)
+    def find_free_space(self, rom_blocks):
+        """Find the smallest free block that can hold a rom
 
-        # get rom size and calculate block count
-        rom_size = os.path.getsize(rom)
-        rom_blocks = int(rom_size / 0x200)
+        Keyword Arguments:
+        rom_blocks -- size of rom in 512-byte sectors
+
+        Returns the start of the free block in 512-byte sectors"""
 
         # get free blocks on sd-card and search for a block big enough for the rom
         start_block = 0
@@ -260,13 +481,18 @@ class Sky3DS_Disk:
         if start_block == 0:
             raise Exception("Not enough free continous blocks")
 
-        self.diskfp.seek(0)
+        return start_block
+
+    def find_free_slot(self):
+        """Find a free rom position header slot"""
+
         position_header_length = 0x100
+        raw_positions = self.read_at(0, position_header_length)
 
         # find free slot for game (card format is limited to 31 games)
         free_slot = -1
         for i in range(0, int(position_header_length / 0x8) - 1):
-            position = struct.unpack("ii", self.diskfp.read(0x8))
+            position = struct.unpack("ii", raw_positions[i*8:i*8+8])
             if position == (-1, -1):
                 free_slot = i
                 break
@@ -274,17 +500,48 @@ class Sky3DS_Disk:
         if free_slot == -1:
             raise Exception("No free slot found. There can be a maximum of %d games on one card." % int(position_header_length / 0x8))
 
-        # seek to start of rom on sd-card
-        self.diskfp.seek(start_block * 0x200)
+        return free_slot
+
+    def prepare_rom(self, rom_source, use_header_bin=False, verbose=False, start_block=None):
+        """Plan writing a rom to sdcard
+
+        This finds a free block with enough space to hold the rom and a free
+        rom position header slot, and builds the sky3ds specific data (from
+        template.txt, a 3dz file or header.bin) that gets written to offset
+        0x1400 inside the rom on sdcard. Nothing is written to sdcard yet.
 
-        # open rom file
-        romfp = open(rom, "rb")
+        Keyword Arguments:
+        rom_source -- rom to write (see source.open_rom)
+        start_block -- write rom to this position (in 512-byte sectors)
+                       instead of looking for a free block
+
+        Returns a dict with rom_size, rom_blocks, start_block, free_slot and
+        card_data which is used by commit_rom"""
+
+        self.fail_on_non_sky3ds()
+
+        # the header is all we need to look at before writing
+        romfp = rom_source.header_fp()
+
+        # get rom size and calculate block count
+        rom_size = rom_source.size
+        rom_blocks = int(rom_size / 0x200)
+
+        # get free blocks on sd-card and search for a block big enough for the rom
+        if start_block != None:
+            if not self.is_free(start_block * 0x200, rom_size):
+                raise Exception("Can't write rom to 0x%x, space is not free" % (start_block * 0x200))
+        else:
+            start_block = self.find_free_space(rom_blocks)
+
+        free_slot = self.find_free_slot()
 
         # get card specific data from template.txt
         serial = gamecard.ncsd_serial(romfp)
         sha1 = gamecard.ncch_sha1sum(romfp)
 
-        template_data = titles.get_template(serial, sha1)
+        with metrics.span('template_lookup'):
+            template_data = titles.get_template(serial, sha1)
         if template_data:
             generated_template = False
             card_data = bytearray.fromhex(template_data['card_data'])
@@ -343,7 +600,7 @@ class Sky3DS_Disk:
                 except:
                     raise Exception("Error: Can't inject headers from header.bin")
 
-        elif rom[-4:] == ".3dz":
+        elif rom_source.name[-4:] == ".3dz":
             romfp.seek(0x1200)
             rom_header = romfp.read(0x44)
             if rom_header[0x00:0x10] != bytearray([0xff]*0x10):
@@ -373,104 +630,300 @@ class Sky3DS_Disk:
             template += "\n"
             logging.info(template)
 
-        # write rom (with fancy progressbar!)
-        romfp.seek(0)
+        return {
+            'rom_size': rom_size,
+            'rom_blocks': rom_blocks,
+            'start_block': start_block,
+            'free_slot': free_slot,
+            'card_data': card_data,
+            }
+
+    @metrics.instrument('write_rom')
+    def write_rom(self, rom, silent=False, progress=None, use_header_bin=False, verbose=False, start_block=None, resume=False, cancel=None, rom_size=None):
+        """Write rom to sdcard.
+
+        Roms are stored at the position marked in the position headers (starting
+        at 0x2000000).
+
+        This code first looks for a free block with enough space to hold the
+        specified rom (see prepare_rom), then continues to write the data to
+        that location.
+        After successful writing the savegame slot for this game is filled with
+        zero, and the data for this game from template.txt is written to
+        offset 0x1400 inside the rom on sdcard (see commit_rom).
+
+        Roms don't have to be plain files, they can also be compressed
+        (containers, zip archives, .gz/.xz/.bz2, see source.open_rom). Only
+        the rom header is buffered, everything else is streamed to sdcard.
+
+        Progress is saved to a checkpoint (see checkpoint.py) while writing.
+        If a write dies, it can be resumed at the last checkpoint as long as
+        neither the rom nor the card have changed, otherwise it starts over.
+        Until the rom is complete it doesn't show up in rom_list.
+
+        Keyword Arguments:
+        rom -- path to rom file
+        silent -- don't show a progress bar
+        progress -- function(ProgressEvent) instead of a progress bar
+        start_block -- write rom to this position (in 512-byte sectors)
+                       instead of looking for a free block
+        resume -- continue an interrupted write of the same rom
+        cancel -- CancelToken, stops the write (at the last checkpoint)
+        rom_size -- size of a .gz/.xz/.bz2 rom in bytes (default: taken from
+                    the compressed file, or counted before writing if it
+                    isn't stored there, see RomSource.check_size)"""
+
+        self.fail_on_non_sky3ds()
+
+        # only needed here (zipfile etc. are slow to import)
+        from sky3ds import source
+
+        rom_source = source.open_rom(rom, size=rom_size)
         try:
-            if not silent and not progress:
-                progress = ProgressBar(widgets=[Percentage(), Bar(), FileTransferSpeed()], maxval=rom_size).start()
+            rom_source.check_size()
+            rom_checkpoint = checkpoint.Checkpoint('write', self.disk_path, rom, checkpoint.file_identity(rom, rom_source.header), self.sync)
+            written = 0
+            if resume:
+                target, written = rom_checkpoint.load()
+                if target and target['fingerprint'] != self.fingerprint():
+                    logging.warning("Card changed since the last run, starting over.")
+                    rom_checkpoint.remove()
+                    target, written = None, 0
+                if target:
+                    start_block = target['start_block']
+                    if not rom_checkpoint.verify(lambda offset, length: self.read_at(start_block * 0x200 + offset, length)):
+                        logging.warning("Last checkpoint doesn't match data on sdcard, starting over.")
+                        written = 0
+                    elif written:
+                        logging.info("Resuming at %d MB" % (written / 1024 / 1024))
+
+            rom_plan = self.prepare_rom(rom_source, use_header_bin=use_header_bin, verbose=verbose, start_block=start_block)
+            rom_checkpoint.begin({'start_block': rom_plan['start_block'], 'fingerprint': self.fingerprint()}, written)
         except:
-            pass
-        written = 0
-        while written < rom_size:
-            chunk = romfp.read(1024*1024*8)
+            rom_source.close()
+            raise
+        rom_size = rom_plan['rom_size']
 
-            self.diskfp.write(chunk)
-            os.fsync(self.diskfp)
+        position = rom_plan['start_block'] * 0x200
 
-            written = written + len(chunk)
-            try:
-                if not silent:
-                   progress.update(written)
-            except:
-                pass
+        # write rom (progress goes to a TextBar unless silent or a listener is given)
+        tracker = Progress('write_rom', rom_size, progress, silent=silent, cancel=cancel, target=rom, done=written)
         try:
-            if not silent:
-                progress.finish()
-        except:
-            pass
+            for chunk in metrics.timed(rom_source.chunks(self.tuning['write_chunk_size'], start=written), 'source_read'):
+                with metrics.span('device_write'):
+                    self.write_at(position + written, chunk)
+                if self.tuning['fsync'] == 'chunk':
+                    self.sync()
+
+                written = written + len(chunk)
+                rom_checkpoint.update(written, chunk)
+                tracker.update(written, 'copy')
+        except BaseException:
+            rom_checkpoint.abort()
+            raise
+        finally:
+            # cleanup
+            rom_source.close()
+
+        tracker.update(written, 'commit')
+        self.commit_rom(rom_plan)
+        rom_checkpoint.remove()
+        tracker.finish()
+
+    @metrics.phase('header_commit')
+    def commit_rom(self, rom_plan):
+        """Make a rom written to sdcard visible
+
+        After the rom data has been written to the location from prepare_rom,
+        this writes the rom position header, clears the savegame slot of the
+        game and writes the sky3ds specific data to offset 0x1400 of the rom.
+
+        Keyword Arguments:
+        rom_plan -- result of prepare_rom"""
 
-        # seek to slot header and write position + block-count of rom
-        self.diskfp.seek(free_slot * 0x8)
-        self.diskfp.write(struct.pack("ii", start_block, rom_blocks))
+        # rom data has to be on sdcard before it becomes visible
+        self.sync()
 
-        # add savegame slot
-        self.diskfp.seek(0x100000 * (1 + len(self.rom_list)))
-        self.diskfp.write(bytearray([0xff]*0x100000))
+        with self.header_lock:
+            # add savegame slot
+            self.write_at(0x100000 * (1 + len(self.rom_list)), bytearray([0xff]*0x100000))
 
-        self.diskfp.seek(start_block * 0x200 + 0x1400)
-        self.diskfp.write(card_data)
+            self.write_at(rom_plan['start_block'] * 0x200 + 0x1400, rom_plan['card_data'])
+            self.sync()
 
-        # cleanup
-        romfp.close()
-        os.fsync(self.diskfp)
+            # write position + block-count of rom to slot header
+            self.write_at(rom_plan['free_slot'] * 0x8, struct.pack("ii", rom_plan['start_block'], rom_plan['rom_blocks']))
+            self.sync()
 
-        self.update_rom_list()
+            self.update_rom_list()
 
-    def dump_rom(self, slot, output, silent=False, progress=None):
+    @metrics.instrument('dump_rom')
+    def dump_rom(self, slot, output, silent=False, progress=None, compression=None, chunk_size=None, queue_depth=None, resume=False, cancel=None):
         """Dump rom from sdcard to file
 
         This opens the rom position header at the specified slot, seeks to
         the start point on sdcard, and just starts dumping data to the output-
-        file until the whole rom has been dumped. After dumping sky3ds specific
-        data (0x1400 - 0x1600) gets removed from the romfile.
+        file until the whole rom has been dumped. While dumping sky3ds specific
+        data (0x1400 - 0x1600) gets removed from the rom data.
+
+        If compression is set the rom is stored in a blockwise compressed
+        container (see container.py) which can be written back to sdcard with
+        write_rom without decompressing it first.
+
+        Like write_rom, uncompressed dumps save their progress to a
+        checkpoint and can be resumed.
 
         Keyword Arguments:
         slot -- rom position header slot
-        output -- output rom file"""
+        output -- output rom file
+        silent -- don't show a progress bar
+        progress -- function(ProgressEvent) instead of a progress bar
+        compression -- compression codec (zlib, bz2 or lzma) or None
+        chunk_size -- size of reads from sdcard (default: from device profile)
+        queue_depth -- number of reads in flight (default: from device profile)
+        resume -- continue an interrupted dump to the same file
+        cancel -- CancelToken, stops the dump"""
 
         self.fail_on_non_sky3ds()
 
+        if chunk_size == None:
+            chunk_size = self.tuning['read_chunk_size']
+        if queue_depth == None:
+            queue_depth = self.tuning['queue_depth']
+
         start = self.rom_list[slot][1]
         rom_size = self.rom_list[slot][2]
 
-        self.diskfp.seek(start)
+        def sync_output():
+            outputfp.flush()
+            os.fsync(outputfp.fileno())
 
-        outputfp = open(output, "wb")
+        if compression:
+            if resume:
+                raise Exception("Compressed dumps can't be resumed.")
+            rom_checkpoint = None
+        else:
+            identity = {'fingerprint': self.fingerprint(), 'start': start, 'size': rom_size}
+            # synced at every checkpoint only, like write_rom
+            rom_checkpoint = checkpoint.Checkpoint('dump', self.disk_path, output, identity, sync_output)
 
-        # read rom
-        try:
-            if not silent and not progress:
-                progress = ProgressBar(widgets=[Percentage(), Bar(), FileTransferSpeed()], maxval=rom_size).start()
-        except:
-            pass
         written = 0
-        while written < rom_size:
-            chunk = self.diskfp.read(1024*1024)
+        if resume:
+            target, written = rom_checkpoint.load()
+            if written:
+                def read_output(offset, length):
+                    outputfp = open(output, "rb")
+                    outputfp.seek(offset)
+                    data = outputfp.read(length)
+                    outputfp.close()
+                    return data
+                if not os.path.exists(output) or os.path.getsize(output) < written or not rom_checkpoint.verify(read_output):
+                    logging.warning("Last checkpoint doesn't match %s, starting over." % output)
+                    written = 0
+                else:
+                    logging.info("Resuming at %d MB" % (written / 1024 / 1024))
 
-            outputfp.write(chunk)
-            os.fsync(outputfp)
+        if written:
+            outputfp = open(output, "r+b")
+            outputfp.truncate(written)
+            outputfp.seek(written)
+        else:
+            outputfp = open(output, "wb")
+        if rom_checkpoint:
+            rom_checkpoint.begin({'output': os.path.realpath(output)}, written)
 
-            written = written + len(chunk)
-            try:
-                if not silent:
-                    progress.update(written)
-            except:
-                pass
-        try:
-            if not silent:
-                progress.finish()
-        except:
-            pass
+        if compression:
+            writer = container.ContainerWriter(outputfp, compression)
+        else:
+            writer = outputfp
 
-        # remove sky3ds specific data from
-        outputfp.seek(0x1400)
-        outputfp.write(bytearray([0xff]*0x200))
+        # read rom
+        tracker = Progress('dump_rom', rom_size, progress, silent=silent, cancel=cancel, target=output, done=written)
+        try:
+            for chunk in metrics.timed(self.read_extent(start + written, rom_size - written, chunk_size, queue_depth), 'device_read'):
+                # remove sky3ds specific data
+                blank_start = max(0x1400, written)
+                blank_end = min(0x1600, written + len(chunk))
+                if blank_start < blank_end:
+                    chunk = bytearray(chunk)
+                    chunk[blank_start - written:blank_end - written] = bytearray([0xff]*(blank_end - blank_start))
+
+                with metrics.span('output_write'):
+                    writer.write(chunk)
+
+                written = written + len(chunk)
+                if rom_checkpoint:
+                    rom_checkpoint.update(written, chunk)
+                tracker.update(written)
+        except BaseException:
+            if compression:
+                writer.abort()
+            if rom_checkpoint:
+                rom_checkpoint.abort()
+            outputfp.close()
+            raise
 
         # cleanup
-        os.fsync(outputfp)
+        if compression:
+            writer.close()
+        sync_output()
         outputfp.close()
+        if rom_checkpoint:
+            rom_checkpoint.remove()
+        tracker.finish()
+
+    @metrics.instrument('move_rom')
+    def move_rom(self, slot, start_block, silent=False, progress=None):
+        """Move rom to another position on sdcard
+
+        This copies the rom data (including Card2 savegames, which are stored
+        inside the rom) to the new position and updates the rom position
+        header afterwards. Card1 savegames stay where they are, since their
+        location only depends on the slot.
+        Source and destination may overlap, the data is copied front to back
+        when moving to a lower position and back to front otherwise.
+        Moves can't be cancelled, stopping an overlapping move halfway would
+        destroy the rom.
+
+        Keyword Arguments:
+        slot -- rom position header slot
+        start_block -- new position of the rom (in 512-byte sectors)
+        silent -- don't show a progress bar
+        progress -- function(ProgressEvent) instead of a progress bar"""
+
+        self.fail_on_non_sky3ds()
+
+        start = self.rom_list[slot][1]
+        rom_size = self.rom_list[slot][2]
+        destination = start_block * 0x200
+
+        if destination == start:
+            return
+        if not self.is_free(destination, rom_size, ignore_slot=slot):
+            raise Exception("Can't move rom to 0x%x, space is not free" % destination)
+
+        chunk_size = self.tuning['write_chunk_size']
+        offsets = list(range(0, rom_size, chunk_size))
+        if destination > start:
+            offsets = offsets[::-1]
+
+        tracker = Progress('move_rom', rom_size, progress, silent=silent)
+        for offset in offsets:
+            chunk = self.read_at(start + offset, min(chunk_size, rom_size - offset))
+            self.write_at(destination + offset, chunk)
+            tracker.advance(len(chunk))
+        self.sync()
+
+        # update rom position header
+        with self.header_lock:
+            self.write_at(slot * 0x8, struct.pack("ii", start_block, int(rom_size / 0x200)))
+            self.sync()
+
+            self.update_rom_list()
+        tracker.finish()
 
     # delete rom from sdcard
+    @metrics.instrument('delete_rom')
     def delete_rom(self, slot):
         """Delete rom from sdcard
 
@@ -483,31 +936,33 @@ class Sky3DS_Disk:
 
         self.fail_on_non_sky3ds()
 
-        current_save = slot
-
-        while current_save < len(self.rom_list):
-            self.diskfp.seek(0x100000 * (current_save + 2))
-            tmp_savegame = self.diskfp.read(0x100000)
-            self.diskfp.seek(0x100000 * (current_save + 1))
-            self.diskfp.write(tmp_savegame)
-            current_save += 1
-        self.diskfp.write(bytearray([0xff]*0x100000))
-
-        # remove slot header and rearrange the rest of the headers
-        position_header_length = 0x100
-        self.diskfp.seek(0x0)
-        raw_positions = list(self.diskfp.read(position_header_length))
-        new_raw_positions = bytearray(raw_positions[0:slot*8] + raw_positions[(slot+1)*8:] + [0xff]*8)
-        self.diskfp.seek(0x0)
-        self.diskfp.write(new_raw_positions)
+        with self.header_lock:
+            batch = WriteBatch(self)
+            current_save = slot
+
+            while current_save < len(self.rom_list):
+                tmp_savegame = self.read_at(0x100000 * (current_save + 2), 0x100000)
+                batch.write(0x100000 * (current_save + 1), tmp_savegame)
+                current_save += 1
+            batch.write(0x100000 * (current_save + 1), bytearray([0xff]*0x100000))
+            batch.flush()
+            self.sync()
+
+            # remove slot header and rearrange the rest of the headers
+            position_header_length = 0x100
+            raw_positions = list(bytearray(self.read_at(0x0, position_header_length)))
+            new_raw_positions = bytearray(raw_positions[0:slot*8] + raw_positions[(slot+1)*8:] + [0xff]*8)
+            self.write_at(0x0, new_raw_positions)
+            self.sync()
 
-        self.update_rom_list()
+            self.update_rom_list()
 
     #####################
     # Savegame Handling #
     #####################
 
-    def dump_savegame(self, slot, output):
+    @metrics.instrument('dump_savegame')
+    def dump_savegame(self, slot, output, compression=None):
         """Dump savegame from sdcard to file
 
         This code first looks at the actual game header of the rom in the
@@ -526,21 +981,25 @@ class Sky3DS_Disk:
         mark in front of the actual savegame as well as the type and size of
         (emulated) game chip.
 
+        Like roms, savegames can be stored in a compressed container.
+
         Keyword Arguments:
         slot -- rom slot
-        output -- output savegame file"""
+        output -- output savegame file
+        compression -- compression codec (zlib, bz2 or lzma) or None"""
 
         self.fail_on_non_sky3ds()
 
         if slot >= len(self.rom_list):
             raise Exception("Slot not found")
 
-        self.diskfp.seek(0)
+        ncsd_header = gamecard.ncsd_header(self.read_at(self.rom_list[slot][1], 0x1200))
 
-        self.diskfp.seek(self.rom_list[slot][1])
-        ncsd_header = gamecard.ncsd_header(self.diskfp.read(0x1200))
-
-        savegamefp = open(output, "wb")
+        outputfp = open(output, "wb")
+        if compression:
+            savegamefp = container.ContainerWriter(outputfp, compression)
+        else:
+            savegamefp = outputfp
 
         # 0x00 CTR_SAVE
         savegamefp.write(b'CTR_SAVE')
@@ -555,25 +1014,23 @@ class Sky3DS_Disk:
             savegamefp.write(bytearray([0x00, 0x01]))
 
         # Nand save offset / Writable Address
-        self.diskfp.seek(self.rom_list[slot][1] + 0x200)
-        savegamefp.write(self.diskfp.read(0x4))
+        savegamefp.write(self.read_at(self.rom_list[slot][1] + 0x200, 0x4))
 
         # Unique ID (0x40 bytes but only 0x10 really used)
-        self.diskfp.seek(self.rom_list[slot][1] + 0x1440)
-        savegamefp.write(self.diskfp.read(0x40))
+        savegamefp.write(self.read_at(self.rom_list[slot][1] + 0x1440, 0x40))
 
         # Savegame Data
         if ncsd_header['card_type'] == 'Card1':
             # from card1 region (byte 1M - 32M on disk)
-            self.diskfp.seek(0x100000 * (slot + 1))
-            savegamefp.write(self.diskfp.read(0x100000))
+            savegamefp.write(self.read_at(0x100000 * (slot + 1), 0x100000))
         else:
             # from writable region in rom
-            self.diskfp.seek(self.rom_list[slot][1] + ncsd_header['writable_address'])
             for i in range(0, 10):
-                savegamefp.write(self.diskfp.read(0x100000))
+                savegamefp.write(self.read_at(self.rom_list[slot][1] + ncsd_header['writable_address'] + i * 0x100000, 0x100000))
 
-        savegamefp.close()
+        if compression:
+            savegamefp.close()
+        outputfp.close()
 
     def find_game(self, product_code):
         """Find a game on sdcard by product-code
@@ -590,13 +1047,58 @@ class Sky3DS_Disk:
         slot = -1
         rom_count = 0
         for rom in self.rom_list:
-            self.diskfp.seek(rom[1])
-            ncsd_header = gamecard.ncsd_header(self.diskfp.read(0x1200))
+            ncsd_header = gamecard.ncsd_header(self.read_at(rom[1], 0x1200))
             if ncsd_header['product_code'] == product_code:
                 return (rom_count, ncsd_header)
             rom_count+=1
         return (None, None)
 
+    def product_code_index(self):
+        """Map product-codes of all roms on sdcard to their slot
+
+        This reads every ncsd-header on sdcard exactly once, so looking up
+        several games (i.e. when restoring a whole savegame backup directory)
+        doesn't have to go through find_game(product_code) for every single one.
+        If a game is on sdcard more than once the first slot wins, just like
+        in find_game(product_code).
+
+        Returns a dict of product_code -> (slot, ncsd_header)"""
+
+        self.fail_on_non_sky3ds()
+
+        index = {}
+        rom_count = 0
+        for rom in self.rom_list:
+            ncsd_header = gamecard.ncsd_header(self.read_at(rom[1], 0x1200))
+            if ncsd_header and not ncsd_header['product_code'] in index:
+                index[ncsd_header['product_code']] = (rom_count, ncsd_header)
+            rom_count+=1
+        return index
+
+    def read_savegame_header(self, savegamefp):
+        """Parse the header of a savegame backup
+
+        The header is 'CTR_SAVE', the product-code, zero-padding, the save type,
+        the NAND save offset and the unique id (see dump_savegame). After this
+        function returns savegamefp points to the actual savegame data.
+
+        Keyword Arguments:
+        savegamefp -- opened savegame file"""
+
+        # CTR_SAVE
+        ctr_save = savegamefp.read(0x8)
+        if ctr_save != b'CTR_SAVE':
+            raise Exception("Not a valid savegame")
+
+        return {
+            'product_code': savegamefp.read(0xa).decode('ascii'),
+            'padding': savegamefp.read(0x1),
+            'save_type': savegamefp.read(0x1),
+            'nand_save_offset': savegamefp.read(0x4),
+            'unique_id': savegamefp.read(0x40),
+            }
+
+    @metrics.instrument('write_savegame')
     def write_savegame(self, savefile):
         """Restore savegame from file to sdcard
 
@@ -615,52 +1117,283 @@ class Sky3DS_Disk:
         in the region of Card1-savegames.
 
         For Card2 savegames it gets written to the writable_address offset of
-        the game."""
+        the game.
+
+        Savegames in compressed containers are decompressed on the fly."""
 
         self.fail_on_non_sky3ds()
 
-        savegamefp = open(savefile, "rb")
+        savegamefp = container.open_file(savefile)
 
-        # CTR_SAVE
-        ctr_save = savegamefp.read(0x8)
-        if ctr_save != b'CTR_SAVE':
-            raise Exception("Not a valid savegame")
+        savegame_header = self.read_savegame_header(savegamefp)
 
         # Product Code
-        product_code = savegamefp.read(0xa).decode('ascii')
-        slot,ncsd_header = self.find_game(product_code)
+        slot,ncsd_header = self.find_game(savegame_header['product_code'])
         if slot == None:
             raise Exception("Game not on disk")
 
-        # Zero Padding (ignored)
-        savegamefp.read(0x1)
+        # Save Type and NAND save offset are ignored, they are read directly
+        # from ncsd_header
+
+        with self.header_lock:
+            # Savegame data
+            if ncsd_header['card_type'] == 'Card1':
+                self.write_at(0x100000 * (slot + 1), savegamefp.read(0x100000))
+            elif ncsd_header['card_type'] == 'Card2':
+                self.write_at(self.rom_list[slot][1] + ncsd_header['writable_address'], savegamefp.read(0x100000 * 10))
+            self.sync()
+
+            # Unique ID (+ recalculate crc), once the savegame data is stored
+            card_data = bytearray(self.read_at(self.rom_list[slot][1] + 0x1400, 0x200))
+            card_data[0x40:0x80] = savegame_header['unique_id']
+            crc16 = titles.crc16(card_data[:-2])
+            card_data[-2] = (crc16 & 0xFF00) >> 8
+            card_data[-1] = (crc16 & 0x00FF)
+            self.write_at(self.rom_list[slot][1] + 0x1400, card_data)
+            self.sync()
 
-        # Save Type (ignored, read directly from ncsd_header)
-        savegamefp.read(0x1)
+        savegamefp.close()
 
-        # NAND save offset (ignored, read directly from ncsd_header)
-        savegamefp.read(0x4)
+    @metrics.instrument('write_savegames')
+    def write_savegames(self, savefiles):
+        """Restore several savegames from files to sdcard in one pass
 
-        # Unique ID (+ recalculate crc)
-        self.diskfp.seek(self.rom_list[slot][1] + 0x1440)
-        self.diskfp.write(savegamefp.read(0x40))
+        This does the same as write_savegame(savefile) for a whole bunch of
+        savegame backups, but only reads the ncsd-headers on sdcard once.
 
-        self.diskfp.seek(self.rom_list[slot][1] + 0x1400)
-        card_data = self.diskfp.read(0x200)
-        crc16 = titles.crc16(bytearray(card_data[:-2]))
-        self.diskfp.seek(self.rom_list[slot][1] + 0x1400 + 0x200 - 0x2)
-        self.diskfp.write(bytearray([(crc16 & 0xFF00) >> 8, crc16 & 0x00FF]))
+        All savegame headers are parsed up front and matched against
+        product_code_index(). The savegame data is written first (sorted by
+        offset on sdcard, in whole allocation units, see WriteBatch) and
+        synced, the unique id block of every game is patched (and its crc
+        recalculated) only after that, so an interrupted restore never leaves
+        a game with a new unique id but its old savegame behind.
+        If there are multiple savegames for the same game, the last one (in
+        filename order) is restored.
 
-        # Savegame data
-        if ncsd_header['card_type'] == 'Card1':
-            self.diskfp.seek(0x100000 * (slot + 1))
-            self.diskfp.write(savegamefp.read(0x100000))
-            os.fsync(self.diskfp)
-        elif ncsd_header['card_type'] == 'Card2':
-            self.diskfp.seek(self.rom_list[slot][1] + ncsd_header['writable_address'])
-            for i in range(0, 10):
-                self.diskfp.write(savegamefp.read(0x100000))
-                os.fsync(self.diskfp)
+        Keyword Arguments:
+        savefiles -- directory containing *.sav(.s3z) files or list of savegame files
 
-        savegamefp.close()
+        Returns a list of (savefile, result) tuples, result is "OK" or the
+        reason why the savegame wasn't restored."""
+
+        self.fail_on_non_sky3ds()
+
+        if isinstance(savefiles, (str, type(u''))):
+            if os.path.isdir(savefiles):
+                savefiles = [os.path.join(savefiles, f) for f in sorted(os.listdir(savefiles)) if container.strip_extension(f).lower().endswith(".sav")]
+            else:
+                savefiles = [savefiles]
 
+        index = self.product_code_index()
+
+        results = dict((savefile, None) for savefile in savefiles)
+        restores = {}
+        for savefile in savefiles:
+            try:
+                savegamefp = container.open_file(savefile)
+                try:
+                    savegame_header = self.read_savegame_header(savegamefp)
+                finally:
+                    savegamefp.close()
+
+                if not savegame_header['product_code'] in index:
+                    raise Exception("Game not on disk")
+                slot, ncsd_header = index[savegame_header['product_code']]
+
+                if ncsd_header['card_type'] == 'Card1':
+                    save_offset = 0x100000 * (slot + 1)
+                    save_length = 0x100000
+                elif ncsd_header['card_type'] == 'Card2':
+                    save_offset = self.rom_list[slot][1] + ncsd_header['writable_address']
+                    save_length = 0x100000 * 10
+                else:
+                    raise Exception("Unsupported card type %s" % ncsd_header['card_type'])
+
+                if slot in restores:
+                    results[restores[slot]['savefile']] = "Skipped, superseded by %s" % savefile
+                restores[slot] = {
+                        'savefile': savefile,
+                        'unique_id': savegame_header['unique_id'],
+                        'save_offset': save_offset,
+                        'save_length': save_length,
+                        }
+            except Exception as e:
+                results[savefile] = str(e)
+
+        # savegame data first, in disk order
+        with self.header_lock:
+            batch = WriteBatch(self)
+            for slot, restore in sorted(restores.items(), key=lambda x: x[1]['save_offset']):
+                if results[restore['savefile']] != None:
+                    continue
+                try:
+                    savegamefp = container.open_file(restore['savefile'])
+                    try:
+                        savegamefp.seek(0x58)
+                        written = 0
+                        while written < restore['save_length']:
+                            chunk = savegamefp.read(min(0x100000, restore['save_length'] - written))
+                            if not chunk:
+                                break
+                            batch.write(restore['save_offset'] + written, chunk)
+                            written += len(chunk)
+                    finally:
+                        savegamefp.close()
+                except Exception as e:
+                    results[restore['savefile']] = str(e)
+
+            batch.flush()
+            self.sync()
+
+            # unique id and crc last, once the savegame data is stored
+            for slot, restore in sorted(restores.items()):
+                if results[restore['savefile']] != None:
+                    continue
+                offset = self.rom_list[slot][1] + 0x1400
+                card_data = bytearray(self.read_at(offset, 0x200))
+                card_data[0x40:0x80] = restore['unique_id']
+                crc16 = titles.crc16(card_data[:-2])
+                card_data[-2] = (crc16 & 0xFF00) >> 8
+                card_data[-1] = (crc16 & 0x00FF)
+                self.write_at(offset, card_data)
+                results[restore['savefile']] = "OK"
+            self.sync()
+
+        return [(savefile, results[savefile]) for savefile in savefiles]
+
+    ###############
+    # Card Images #
+    ###############
+
+    @metrics.instrument('export_image')
+    def export_image(self, output, compression=None, silent=False, progress=None, queue_depth=None, cancel=None):
+        """Save the whole sdcard to a compact image file
+
+        Only the used parts of the sdcard are stored: the rom position
+        headers and Card1 savegames (0x0 - 0x2000000) and every rom including
+        its sky3ds header and Card2 savegame. Every part is stored in its own
+        container (see container.py), so free space and 0xff padding take up
+        no space in the image. Reading from sdcard is done in a background
+        thread while the previous chunk is compressed and written.
+
+        Keyword Arguments:
+        output -- image file
+        compression -- compression codec (zlib, bz2 or lzma) or None
+        silent -- don't show a progress bar
+        progress -- function(ProgressEvent) instead of a progress bar
+        queue_depth -- number of reads in flight (default: from device profile)
+        cancel -- CancelToken, stops the export (the image is incomplete then)"""
+
+        self.fail_on_non_sky3ds()
+
+        if queue_depth == None:
+            queue_depth = self.tuning['queue_depth']
+
+        extents = [(0, 0x2000000)] + sorted((rom[1], rom[2]) for rom in self.rom_list)
+        total = sum(extent[1] for extent in extents)
+
+        tracker = Progress('export_image', total, progress, silent=silent, cancel=cancel, target=output)
+
+        outputfp = open(output, "wb")
+        outputfp.write(bytearray([0x00] * container.header_length))
+
+        index = []
+        written = 0
+        for start, length in extents:
+            index.append((start, length, outputfp.tell()))
+            writer = container.ContainerWriter(outputfp, compression or 'store')
+            for chunk in pipeline.prefetch(self.read_extent(start, length, self.tuning['read_chunk_size'], queue_depth)):
+                writer.write(chunk)
+                written += len(chunk)
+                tracker.update(written)
+            writer.close()
+
+        container.write_image_header(outputfp, self.disk_size, index)
+
+        os.fsync(outputfp)
+        outputfp.close()
+        tracker.finish()
+
+    @metrics.instrument('import_image')
+    def import_image(self, image, silent=False, progress=None, cancel=None):
+        """Restore an image from export_image to sdcard (will be overwritten!)
+
+        The sdcard doesn't have to be formatted and may be bigger or smaller
+        than the original one. Roms keep their positions if possible, if the
+        sdcard is too small for that, they are stored one after another (in
+        their original order). The rom position headers are written last, so
+        an interrupted import doesn't leave a card with broken roms behind.
+
+        Keyword Arguments:
+        image -- image file from export_image
+        silent -- don't show a progress bar
+        progress -- function(ProgressEvent) instead of a progress bar
+        cancel -- CancelToken, stops the import (the sdcard isn't a valid
+                  card then)"""
+
+        imagefp = open(image, "rb")
+        try:
+            disk_size, extents = container.read_image_header(imagefp)
+            if not extents or extents[0][:2] != (0, 0x2000000):
+                raise Exception("Card image doesn't start with rom position headers")
+
+            # work out where the roms go
+            roms = extents[1:]
+            positions = [start for start, length, offset in roms]
+            if roms and roms[-1][0] + roms[-1][1] > self.disk_size:
+                positions = []
+                position = 0x2000000
+                for start, length, offset in roms:
+                    positions.append(position)
+                    position += length + (0x2000000 - length % 0x2000000) % 0x2000000
+            needed = max([0x2000000] + [position + rom[1] for position, rom in zip(positions, roms)])
+            if needed > self.disk_size:
+                raise Exception("Disk is too small (%d MB needed, %d MB available)" % (needed / 1024 / 1024, self.disk_size / 1024 / 1024))
+
+            imagefp.seek(extents[0][2])
+            reader = container.ContainerReader(imagefp)
+            header = bytearray(reader.read(0x200))
+            reader.close()
+            relocated = dict((rom[0], position) for position, rom in zip(positions, roms))
+            for i in range(0, int(0x100 / 0x8)):
+                start, size = struct.unpack("ii", header[i*8:i*8+8])
+                if start > 0 and size > 0:
+                    header[i*8:i*8+8] = struct.pack("ii", int(relocated[start * 0x200] / 0x200), size)
+
+            # invalidate card until everything is in place
+            self.write_at(0, bytearray([0xff]*0x200))
+            self.sync()
+            self.is_sky3ds_disk = False
+
+            tracker = Progress('import_image', sum(extent[1] for extent in extents), progress, silent=silent, cancel=cancel, target=image)
+
+            # (offset of container, position on sdcard), all chunks start at
+            # multiples of the chunk size; rom position headers stay invalid
+            # and are written at the very end
+            copies = [(extents[0][2], 0)] + [(rom[2], position) for position, rom in zip(positions, roms)]
+
+            written = 0
+            for offset, position in copies:
+                imagefp.seek(offset)
+                reader = container.ContainerReader(imagefp)
+                for chunk in pipeline.prefetch(iter(lambda: reader.read(self.tuning['write_chunk_size']), b'')):
+                    if position == 0:
+                        chunk = bytearray([0xff]*0x200) + chunk[0x200:]
+                    self.write_at(position, chunk)
+                    if self.tuning['fsync'] == 'chunk':
+                        self.sync()
+                    position += len(chunk)
+                    written += len(chunk)
+                    tracker.update(written)
+                reader.close()
+
+            self.sync()
+            with self.header_lock:
+                self.write_at(0, header)
+                self.sync()
+            tracker.finish()
+        finally:
+            imagefp.close()
+
+        self.check_if_sky3ds_disk()
+        self.update_rom_list()
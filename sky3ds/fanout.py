@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+import os
+import threading
+import logging
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from sky3ds import disk, metrics, source
+from sky3ds.progress import Progress
+
+class DeviceWriter(threading.Thread):
+    """Writes rom chunks to a single sdcard
+
+    Chunks are handed over through a bounded queue, so a slow sdcard can
+    fall behind the others only by that many chunks."""
+
+    def __init__(self, sky3ds_disk, rom_plan, window, progress=None):
+        # records to the operation of fanout_write_rom, like pipeline.prefetch
+        threading.Thread.__init__(self, target=metrics.bind(self.write_chunks))
+        self.daemon = True
+
+        self.disk = sky3ds_disk
+        self.rom_plan = rom_plan
+        self.chunks = queue.Queue(window)
+        self.progress = Progress('write_rom', rom_plan['rom_size'], progress, silent=True, target=sky3ds_disk.disk_path)
+
+        self.written = 0
+        self.error = None
+        self.failed = threading.Event()
+
+    def put(self, chunk):
+        """Hand over the next chunk (None after the last one)
+
+        Blocks while the queue is full. Returns False if this sdcard failed."""
+
+        while not self.failed.is_set():
+            try:
+                self.chunks.put(chunk, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def write_chunks(self):
+        try:
+            start = self.rom_plan['start_block'] * 0x200
+            while not self.failed.is_set():
+                try:
+                    chunk = self.chunks.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                if chunk is None:
+                    self.progress.update(self.written, 'commit')
+                    self.disk.commit_rom(self.rom_plan)
+                    self.progress.finish()
+                    break
+
+                self.disk.write_at(start + self.written, chunk)
+                if self.disk.tuning['fsync'] == 'chunk':
+                    self.disk.sync()
+                self.written += len(chunk)
+                self.progress.update(self.written, 'copy')
+        except Exception as e:
+            self.error = e
+            self.failed.set()
+
+    def abort(self, error):
+        self.error = error
+        self.failed.set()
+
+@metrics.instrument('fanout_write_rom')
+def fanout_write_rom(disk_paths, rom, use_header_bin=False, window=8, chunk_size=None, progress=None, cancel=None, rom_size=None):
+    """Write the same rom to several sdcards at once
+
+    The rom is read (and decompressed) only once, every chunk is handed to a
+    writer thread per sdcard. Each sdcard gets its own placement (see
+    Sky3DS_Disk.prepare_rom). A slow sdcard holds back the others only when
+    it is more than window chunks behind, and a failing sdcard doesn't stop
+    the others.
+
+    Keyword Arguments:
+    disk_paths -- list of sdcards
+    rom -- path to rom file (anything source.open_rom accepts)
+    use_header_bin -- see Sky3DS_Disk.write_rom
+    window -- number of chunks a sdcard may fall behind
+    chunk_size -- size of chunks read from the rom (default: the smallest
+                  write_chunk_size of the sdcards, see tuning.py)
+    progress -- function(ProgressEvent), event.target is the sdcard (never
+                called from more than one thread at a time)
+    cancel -- CancelToken, stops all writes (no sdcard gets the rom then)
+    rom_size -- see Sky3DS_Disk.write_rom
+
+    Returns a list of (disk_path, error) tuples, error is None on success"""
+
+    # the same sdcard twice would get the rom written twice to one place
+    real_paths = [os.path.realpath(disk_path) for disk_path in disk_paths]
+    for disk_path, real_path in zip(disk_paths, real_paths):
+        if real_paths.count(real_path) > 1:
+            raise Exception("%s is given more than once." % disk_path)
+
+    rom_source = source.open_rom(rom, size=rom_size)
+    try:
+        rom_source.check_size()
+    except:
+        rom_source.close()
+        raise
+
+    # writer threads report progress one at a time
+    if progress:
+        progress_lock = threading.Lock()
+        report_progress = progress
+        def progress(*args):
+            with progress_lock:
+                report_progress(*args)
+
+    writers = []
+    errors = {}
+    for disk_path in disk_paths:
+        try:
+            sky3ds_disk = disk.Sky3DS_Disk(disk_path)
+            rom_plan = sky3ds_disk.prepare_rom(rom_source, use_header_bin=use_header_bin)
+            writers.append(DeviceWriter(sky3ds_disk, rom_plan, window, progress))
+        except Exception as e:
+            errors[disk_path] = e
+
+    if chunk_size == None:
+        chunk_size = min([writer.disk.tuning['write_chunk_size'] for writer in writers] or [1024*1024*8])
+
+    for writer in writers:
+        writer.start()
+
+    try:
+        for chunk in rom_source.chunks(chunk_size):
+            if cancel:
+                cancel.check()
+            alive = [writer for writer in writers if writer.put(chunk)]
+            if not alive:
+                break
+        for writer in writers:
+            writer.put(None)
+    except Exception as e:
+        # reading the rom failed (or was cancelled), no sdcard gets a rom
+        # position header
+        for writer in writers:
+            writer.abort(e)
+    finally:
+        rom_source.close()
+
+    for writer in writers:
+        writer.join()
+        if writer.error:
+            logging.error("Writing to %s failed: %s" % (writer.disk.disk_path, writer.error))
+            errors[writer.disk.disk_path] = writer.error
+
+    return [(disk_path, errors.get(disk_path)) for disk_path in disk_paths]
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Synthetic roms, sdcard images and metadata for the tests and benchmarks"""
+import os
+import hashlib
+import struct
+
+def ncsd_header(size, product_code, card_type, media_id):
+    """First 0x4000 bytes of a rom with just enough in it for sky3ds.py
+
+    Keyword Arguments:
+    size -- rom size in bytes
+    product_code -- i.e. CTR-P-ABCE
+    card_type -- 1 (Card1) or 2 (Card2)
+    media_id -- title id as integer"""
+
+    header = bytearray([0xff] * 0x4000)
+    header[0x0:0x100] = bytearray(0x100)
+    header[0x100:0x104] = b'NCSD'
+    header[0x104:0x108] = struct.pack("i", int(size / 0x200))
+    header[0x108:0x110] = struct.pack("q", media_id)
+    header[0x188:0x190] = bytearray([0, 0, 0, 1, 0, card_type, 0, 0])
+    # Card2 savegames live in the second half of the rom
+    header[0x200:0x204] = struct.pack("i", int(size / 2 / 0x200) if card_type == 2 else -1)
+    header[0x1000:0x1008] = struct.pack("q", media_id)
+    header[0x1100:0x1104] = b'NCCH'
+    header[0x1150:0x1160] = product_code.encode('ascii') + bytearray(0x10 - len(product_code))
+    header[0x1188:0x1190] = bytearray(0x8)
+    header[0x1200:0x1240] = bytearray(range(0x40))
+    return header
+
+def isolate_data_dir(work_dir):
+    """Keep everything sky3ds stores in the user data dir in work_dir
+
+    For the tests, so they neither depend on nor change the catalog,
+    checkpoints, templates, titles and profiles of the machine they run on.
+    template.json starts out without templates. Returns a function that
+    restores the old paths (call it in tearDown)."""
+
+    from sky3ds import catalog, checkpoint, library, titles, tuning
+
+    paths = [(catalog, 'catalog_json'), (checkpoint, 'checkpoints_dir'), (library, 'library_json'), (titles, 'template_txt'), (titles, 'template_json'), (titles, 'titles_json'), (tuning, 'profiles_json')]
+    old_paths = [(module, name, getattr(module, name)) for module, name in paths]
+    for module, name in paths:
+        setattr(module, name, os.path.join(work_dir, os.path.basename(getattr(module, name))))
+
+    template_json_fp = open(titles.template_json, "w")
+    template_json_fp.write("[]")
+    template_json_fp.close()
+
+    def restore():
+        for module, name, path in old_paths:
+            setattr(module, name, path)
+    return restore
+
+def make_rom(path, size, product_code="CTR-P-ABCE", card_type=1, media_id=0x0004000000123400):
+    """Create a rom of size bytes
+
+    Everything after the header is left as a hole, so even 4GB roms take
+    no space (on filesystems that support sparse files) and read as zeros."""
+
+    romfp = open(path, "wb")
+    romfp.write(ncsd_header(size, product_code, card_type, media_id))
+    romfp.truncate(size)
+    romfp.close()
+
+def make_image(path, size):
+    """Create an empty (sparse) sdcard image"""
+    imagefp = open(path, "wb")
+    imagefp.truncate(size)
+    imagefp.close()
+
+def product_code(i):
+    """i-th synthetic product code (CTR-P-AAAA, CTR-P-AAAB, ...)"""
+    letters = ""
+    for j in range(4):
+        letters = chr(ord('A') + i % 26) + letters
+        i = int(i / 26)
+    return "CTR-P-%s" % letters
+
+def media_id(i):
+    """i-th synthetic media id, as the rom header has it (see gamecard.ncsd_header)"""
+    return "%016X" % (0x0004000000123400 + i * 0x100)
+
+def make_template_txt(path, count):
+    """Create a template.txt with count templates
+
+    Same layout as the one that comes with the sky3ds firmware: serial,
+    name, sha1 of the NCCH header and 0x200 bytes card data as hex."""
+
+    template_txt_fp = open(path, "w")
+    for i in range(count):
+        template_txt_fp.write("** : %s\r\n" % product_code(i))
+        template_txt_fp.write("Game %d\r\n" % i)
+        template_txt_fp.write("SHA1: %s\r\n" % hashlib.sha1(struct.pack("i", i)).hexdigest().upper())
+        card_data = hashlib.sha256(struct.pack("i", i)).digest() * 0x10
+        for line in range(0x20):
+            template_txt_fp.write(" ".join("%.2X" % byte for byte in bytearray(card_data[line * 0x10:line * 0x10 + 0x10])) + "\r\n")
+        template_txt_fp.write("\r\n")
+    template_txt_fp.close()
+
+def make_title_xml(count):
+    """3dsdb.com style release list with count releases"""
+
+    releases = []
+    for i in range(count):
+        code = product_code(i)
+        releases.append("""<release>
+<id>%d</id>
+<name>Game %d</name>
+<publisher>Publisher %d</publisher>
+<region>EUR</region>
+<languages>en,de,fr,es,it</languages>
+<group>Group</group>
+<imagesize>1024</imagesize>
+<serial>CTR-%s</serial>
+<titleid>%s</titleid>
+<imgcrc>%08X</imgcrc>
+<filename>%s</filename>
+<releasename>Game %d (EUR)</releasename>
+<trimmedsize>123456789</trimmedsize>
+<firmware>9.0.0-20</firmware>
+<type>1</type>
+<card>1</card>
+</release>""" % (i, i, i % 100, code[6:10], media_id(i), i, code, i))
+    return "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<releases>\n%s\n</releases>\n" % "\n".join(releases)
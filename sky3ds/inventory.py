@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import csv
+import json
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except:
+    ThreadPoolExecutor = None
+
+from sky3ds import catalog, devices, disk, titles
+
+def probe(disk_path, sky3ds_disk=None):
+    """Collect everything interesting about a single sdcard
+
+    Returns a dict with the disk size, rom listing (see catalog.card_listing)
+    and free space figures. Errors are returned in 'error' instead of being
+    raised, so one broken device doesn't spoil the whole inventory.
+
+    Keyword Arguments:
+    disk_path -- sdcard to probe
+    sky3ds_disk -- already opened Sky3DS_Disk for disk_path, otherwise
+                   disk_path is opened read-only"""
+
+    result = {
+        'disk_path': disk_path,
+        'is_sky3ds_disk': False,
+        'error': None,
+        }
+    try:
+        if not sky3ds_disk:
+            sky3ds_disk = disk.Sky3DS_Disk(disk_path, read_only=True)
+        result['disk_size'] = sky3ds_disk.disk_size
+        result['is_sky3ds_disk'] = sky3ds_disk.is_sky3ds_disk
+
+        if sky3ds_disk.is_sky3ds_disk:
+            card = catalog.card_listing(sky3ds_disk)
+            free = sum(512 * i[1] for i in card['free_blocks'])
+            largest_free = 512 * card['free_blocks'][0][1] if card['free_blocks'] else 0
+            result.update({
+                'fingerprint': card['fingerprint'],
+                'roms': card['roms'],
+                'free': free,
+                'largest_free': largest_free,
+                'free_extents': len(card['free_blocks']),
+                # 0 = all free space is in one piece
+                'fragmentation': 1 - float(largest_free) / free if free else 0.0,
+                })
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+def inventory(disk_paths=None, workers=16):
+    """Probe many sdcards concurrently
+
+    Keyword Arguments:
+    disk_paths -- list of devices, all devices (see devices.list_devices)
+                  if None
+    workers -- number of devices probed at the same time
+
+    Returns a list of probe results in the order of disk_paths"""
+
+    if disk_paths == None:
+        disk_paths = [device['disk_path'] for device in devices.list_devices()]
+
+    # load the title database once instead of in every thread
+    try:
+        titles.load_titles()
+    except:
+        pass
+
+    if ThreadPoolExecutor and len(disk_paths) > 1:
+        executor = ThreadPoolExecutor(min(workers, len(disk_paths)))
+        results = list(executor.map(probe, disk_paths))
+        executor.shutdown()
+        return results
+    return [probe(disk_path) for disk_path in disk_paths]
+
+def export_inventory(results, path):
+    """Export inventory to a .json or .csv file (one line per rom for csv)"""
+
+    if path.lower().endswith('.csv'):
+        outputfp = open(path, "w")
+        writer = csv.writer(outputfp)
+        writer.writerow(['disk_path', 'disk_size', 'free', 'largest_free', 'fragmentation', 'slot', 'product_code', 'title', 'size', 'error'])
+        for result in results:
+            device = [result['disk_path'], result.get('disk_size', ''), result.get('free', ''), result.get('largest_free', ''), "%.2f" % result['fragmentation'] if 'fragmentation' in result else '']
+            if not result.get('roms'):
+                writer.writerow(device + ['', '', '', '', result['error'] or ''])
+            for rom in result.get('roms', []):
+                writer.writerow(device + [rom['slot'], rom['product_code'], rom['title'], rom['size'], ''])
+        outputfp.close()
+    else:
+        outputfp = open(path, "w")
+        outputfp.write(json.dumps(results, indent=2))
+        outputfp.close()
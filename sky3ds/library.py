@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import os
+import json
+import logging
+from appdirs import user_data_dir
+
+try:
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+except:
+    ThreadPoolExecutor = None
+
+from sky3ds import gamecard, source, titles
+
+data_dir = user_data_dir('sky3ds', 'Aperture Laboratories')
+library_json = os.path.join(data_dir, 'library.json')
+
+rom_extensions = source.rom_extensions + ('.zip', '.gz', '.xz', '.bz2', '.s3z')
+
+def load_library():
+    """Load the rom library index, keyed by path"""
+    try:
+        library_json_fp = open(library_json)
+        library = json.load(library_json_fp)
+        library_json_fp.close()
+        return library
+    except:
+        return {}
+
+def save_library(library):
+    tmp_library_json = library_json + ".tmp"
+    library_json_fp = open(tmp_library_json, "w")
+    library_json_fp.write(json.dumps(library))
+    library_json_fp.close()
+    if os.name == 'nt' and os.path.exists(library_json):
+        os.remove(library_json)
+    os.rename(tmp_library_json, library_json)
+
+def file_identity(path):
+    stat = os.stat(path)
+    return [stat.st_ino, stat.st_size, int(stat.st_mtime)]
+
+def scan_rom(path):
+    """Read the header of a rom and collect everything worth knowing about it
+
+    Only the rom header is read (archives and compressed roms are
+    decompressed just as far as needed, see source.open_rom)."""
+
+    rom_source = source.open_rom(path)
+    try:
+        romfp = rom_source.header_fp()
+        rom_header = gamecard.ncsd_header(rom_source.header[:0x1200])
+        if not rom_header:
+            raise Exception("Not a 3DS rom")
+
+        return {
+            'name': os.path.basename(rom_source.name),
+            'serial': gamecard.ncsd_serial(romfp),
+            'sha1': gamecard.ncch_sha1sum(romfp),
+            'size': rom_source.size,
+            'card_type': rom_header['card_type'],
+            'product_code': rom_header['product_code'],
+            'media_id': rom_header['media_id'],
+            }
+    finally:
+        rom_source.close()
+
+def find_roms(library_dir):
+    for root, dirs, files in os.walk(library_dir):
+        for name in sorted(files):
+            if name.lower().endswith(rom_extensions):
+                yield os.path.realpath(os.path.join(root, name))
+
+def index_library(library_dir, workers=8, save_every=100):
+    """Index all roms in a directory tree
+
+    Files are only scanned again if their (inode, size, mtime) changed since
+    the last run. Headers are read in a thread pool and the index is saved
+    every save_every scanned files, so an interrupted run doesn't have to
+    start over. Roms that disappeared from library_dir are removed from the
+    index. Files that aren't roms are remembered as well, so they aren't
+    scanned again until they change.
+
+    Keyword Arguments:
+    library_dir -- directory containing roms
+    workers -- number of threads reading rom headers
+    save_every -- number of scanned files after which the index is saved
+
+    Returns (number of scanned files, number of failed files)"""
+
+    library = load_library()
+    library_dir = os.path.realpath(library_dir)
+
+    found = set()
+    changed = []
+    for path in find_roms(library_dir):
+        found.add(path)
+        try:
+            identity = file_identity(path)
+        except OSError:
+            continue
+        if not path in library or library[path]['identity'] != identity:
+            changed.append((path, identity))
+
+    for path in [i for i in library if i.startswith(library_dir + os.sep) and not i in found]:
+        del library[path]
+
+    def scan(path, identity):
+        try:
+            entry = scan_rom(path)
+            entry['identity'] = identity
+            return path, entry, None
+        except Exception as e:
+            return path, {'identity': identity, 'error': str(e)}, e
+
+    if ThreadPoolExecutor:
+        executor = ThreadPoolExecutor(workers)
+        results = as_completed([executor.submit(scan, path, identity) for path, identity in changed])
+        results = (result.result() for result in results)
+    else:
+        executor = None
+        results = (scan(path, identity) for path, identity in changed)
+
+    scanned = 0
+    failed = 0
+    try:
+        for path, entry, error in results:
+            if error:
+                logging.warning("Can't index %s: %s" % (path, error))
+                failed += 1
+            else:
+                scanned += 1
+            library[path] = entry
+            if (scanned + failed) % save_every == 0:
+                save_library(library)
+    finally:
+        if executor:
+            executor.shutdown()
+        save_library(library)
+
+    return (scanned, failed)
+
+def query(serial=None, title=None, has_template=None, max_size=None):
+    """Search the rom library
+
+    Titles and template availability are looked up when querying, so they are
+    always up to date with the title database and template.txt.
+
+    Keyword Arguments:
+    serial -- (part of) the serial / product-code
+    title -- (part of) the title, case insensitive
+    has_template -- only roms with (True) or without (False) template data
+    max_size -- only roms not bigger than this (i.e. the largest free space on a card)
+
+    Returns a list of entries sorted by title"""
+
+    results = []
+    for path, entry in load_library().items():
+        if 'error' in entry:
+            continue
+        if serial and not serial.upper() in entry['serial'].upper():
+            continue
+        if max_size != None and entry['size'] > max_size:
+            continue
+
+        entry = dict(entry, path=path)
+        rom_info = titles.rom_info(entry['product_code'], entry['media_id'])
+        entry['title'] = rom_info['name'] if rom_info else "???"
+        try:
+            entry['has_template'] = titles.get_template(entry['serial'], entry['sha1']) != None
+        except:
+            entry['has_template'] = False
+
+        if title and not title.lower() in entry['title'].lower():
+            continue
+        if has_template != None and entry['has_template'] != has_template:
+            continue
+        results.append(entry)
+
+    return sorted(results, key=lambda x: (x['title'], x['path']))
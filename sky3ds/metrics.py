@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import logging
+import threading
+
+# nothing is recorded until a sink is added (see add_sink), instrumented
+# code only checks this flag then
+enabled = False
+
+sinks = []
+
+# upper bounds (in seconds) of the fsync latency histogram buckets
+latency_buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf')]
+
+_local = threading.local()
+
+class _NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_null = _NullContext()
+
+class Operation:
+    """Everything recorded during one operation (write_rom, dump_rom, ...)
+
+    Phases are timed spans (header_scan, template_lookup, source_read,
+    device_read, device_write, fsync, header_commit, ...). They can be
+    nested, i.e. header_commit includes the fsync of the headers, so they
+    don't add up to the wall time of the operation."""
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.parent = None
+
+    def add_phase(self, phase, seconds):
+        with self.lock:
+            calls, total = self.phases.get(phase, (0, 0))
+            self.phases[phase] = (calls + 1, total + seconds)
+
+    def count(self, counter, value):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def observe(self, histogram, value):
+        with self.lock:
+            if not histogram in self.histograms:
+                self.histograms[histogram] = {'buckets': [0] * len(latency_buckets), 'sum': 0, 'count': 0}
+            entry = self.histograms[histogram]
+            for i, bound in enumerate(latency_buckets):
+                if value <= bound:
+                    entry['buckets'][i] += 1
+                    break
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def __enter__(self):
+        self.parent = current()
+        _local.operation = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.operation = self.parent
+        record = {
+            'operation': self.name,
+            'labels': self.labels,
+            'started': self.started,
+            'wall': time.time() - self.started,
+            'error': str(exc_value) if exc_value else None,
+            'phases': dict((phase, {'calls': calls, 'seconds': seconds}) for phase, (calls, seconds) in self.phases.items()),
+            'counters': self.counters,
+            'histograms': dict((name, {
+                'buckets': [[bound, count] for bound, count in zip(latency_buckets, histogram['buckets'])],
+                'sum': histogram['sum'],
+                'count': histogram['count'],
+                }) for name, histogram in self.histograms.items()),
+            }
+        for sink in sinks:
+            try:
+                sink.emit(record)
+            except Exception as e:
+                logging.warning("Couldn't write metrics: %s" % e)
+        return False
+
+class Span:
+    def __init__(self, operation, phase, histogram=None):
+        self.operation = operation
+        self.phase = phase
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.time() - self.started
+        self.operation.add_phase(self.phase, seconds)
+        if self.histogram:
+            self.operation.observe(self.histogram, seconds)
+        return False
+
+def current():
+    """Operation recorded in this thread (None if there is none)"""
+    return getattr(_local, 'operation', None)
+
+def operation(name, **labels):
+    """Record an operation, emitted to all sinks when it's done
+
+    Operations started during another operation (i.e. write_savegame from
+    write_savegames) become a phase of the outer one."""
+
+    if not enabled:
+        return _null
+    outer = current()
+    if outer:
+        return Span(outer, name)
+    return Operation(name, labels)
+
+def span(phase, histogram=None):
+    """Time a phase of the current operation
+
+    Keyword Arguments:
+    phase -- name of the phase
+    histogram -- also add the duration to this latency histogram"""
+
+    if not enabled:
+        return _null
+    outer = current()
+    if not outer:
+        return _null
+    return Span(outer, phase, histogram)
+
+def count(counter, value):
+    """Add value to a counter (i.e. bytes_read) of the current operation"""
+    if not enabled:
+        return
+    outer = current()
+    if outer:
+        outer.count(counter, value)
+
+def timed(iterable, phase):
+    """Iterate over iterable, the time spent waiting for items is a phase"""
+    if not enabled or not current():
+        return iterable
+    return _timed(iterable, phase, current())
+
+def _timed(iterable, phase, outer):
+    iterator = iter(iterable)
+    while True:
+        started = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            outer.add_phase(phase, time.time() - started)
+        yield item
+
+def bind(function):
+    """Make function record to the current operation in other threads too
+
+    Used for work handed to worker threads (see pipeline.py)."""
+
+    if not enabled or not current():
+        return function
+    outer = current()
+    def bound(*args, **kwargs):
+        parent = current()
+        _local.operation = outer
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.operation = parent
+    return bound
+
+def instrument(name):
+    """Decorator recording every call of a function as operation name
+
+    The disk_path of the first argument (if it has one) is added as label."""
+
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with operation(name, disk=getattr(args[0], 'disk_path', None) if args else None):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+def phase(name):
+    """Decorator timing every call of a function as phase of the current operation"""
+
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+def add_sink(sink):
+    """Send the records of all following operations to sink"""
+    global enabled
+    sinks.append(sink)
+    enabled = True
+
+def remove_sinks():
+    global enabled
+    enabled = False
+    del sinks[:]
+
+def open_sink(destination):
+    """Sink for the --stats switch
+
+    Keyword Arguments:
+    destination -- 'log', a *.prom file (Prometheus textfile) or any other
+                   file (json lines)"""
+
+    if destination == 'log':
+        return LogSink()
+    if destination.endswith('.prom'):
+        return PrometheusSink(destination)
+    return JsonLinesSink(destination)
+
+class LogSink:
+    """Logs a summary of every operation"""
+
+    def emit(self, record):
+        lines = ["%s took %.2f s%s" % (record['operation'], record['wall'], " (failed: %s)" % record['error'] if record['error'] else "")]
+        for phase, entry in sorted(record['phases'].items(), key=lambda x: -x[1]['seconds']):
+            lines.append("  %-16s %8.3f s %6d calls" % (phase, entry['seconds'], entry['calls']))
+        for counter, value in sorted(record['counters'].items()):
+            if counter.startswith('bytes_') and record['wall']:
+                lines.append("  %-16s %8.1f MB (%.1f MB/s)" % (counter, value / 1024.0 / 1024, value / record['wall'] / 1024 / 1024))
+            else:
+                lines.append("  %-16s %8d" % (counter, value))
+        for name, histogram in sorted(record['histograms'].items()):
+            lines.append("  %-16s %8.1f ms avg over %d calls" % (name, 1000 * histogram['sum'] / histogram['count'], histogram['count']))
+        logging.info("\n".join(lines))
+
+class JsonLinesSink:
+    """Appends every record as a line of json to a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        with self.lock:
+            jsonl_fp = open(self.path, "a")
+            jsonl_fp.write(json.dumps(record) + "\n")
+            jsonl_fp.close()
+
+class PrometheusSink:
+    """Keeps totals of all operations in a Prometheus textfile
+
+    The file is meant for the textfile collector of the node exporter. It's
+    rewritten (atomically) after every operation, totals start from zero in
+    every process."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.phases = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def emit(self, record):
+        with self.lock:
+            operation = record['operation']
+            calls, seconds = self.operations.get(operation, (0, 0))
+            self.operations[operation] = (calls + 1, seconds + record['wall'])
+            for phase, entry in record['phases'].items():
+                self.phases[(operation, phase)] = self.phases.get((operation, phase), 0) + entry['seconds']
+            for counter, value in record['counters'].items():
+                self.counters[(operation, counter)] = self.counters.get((operation, counter), 0) + value
+            for name, histogram in record['histograms'].items():
+                total = self.histograms.setdefault(name, {'buckets': [0] * len(latency_buckets), 'sum': 0, 'count': 0})
+                for i, (bound, count) in enumerate(histogram['buckets']):
+                    total['buckets'][i] += count
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+            self.write()
+
+    def write(self):
+        lines = ["# TYPE sky3ds_operations_total counter"]
+        lines += ['sky3ds_operations_total{operation="%s"} %d' % (operation, calls) for operation, (calls, seconds) in sorted(self.operations.items())]
+        lines += ["# TYPE sky3ds_operation_seconds_total counter"]
+        lines += ['sky3ds_operation_seconds_total{operation="%s"} %f' % (operation, seconds) for operation, (calls, seconds) in sorted(self.operations.items())]
+        lines += ["# TYPE sky3ds_phase_seconds_total counter"]
+        lines += ['sky3ds_phase_seconds_total{operation="%s",phase="%s"} %f' % (operation, phase, seconds) for (operation, phase), seconds in sorted(self.phases.items())]
+        lines += ["# TYPE sky3ds_bytes_total counter"]
+        lines += ['sky3ds_bytes_total{operation="%s",direction="%s"} %d' % (operation, counter[6:], value) for (operation, counter), value in sorted(self.counters.items()) if counter.startswith('bytes_')]
+        for name, histogram in sorted(self.histograms.items()):
+            lines += ["# TYPE sky3ds_%s histogram" % name]
+            cumulative = 0
+            for bound, count in zip(latency_buckets, histogram['buckets']):
+                cumulative += count
+                lines += ['sky3ds_%s_bucket{le="%s"} %d' % (name, "+Inf" if bound == float('inf') else bound, cumulative)]
+            lines += ["sky3ds_%s_sum %f" % (name, histogram['sum'])]
+            lines += ["sky3ds_%s_count %d" % (name, histogram['count'])]
+
+        tmp_path = self.path + ".tmp"
+        prom_fp = open(tmp_path, "w")
+        prom_fp.write("\n".join(lines) + "\n")
+        prom_fp.close()
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
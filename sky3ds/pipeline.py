@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import threading
+import collections
+
+from sky3ds import metrics
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except:
+    ThreadPoolExecutor = None
+
+def prefetch(iterable, depth=2):
+    """Iterate over iterable in a background thread
+
+    Items are produced by a worker thread while the caller is still busy with
+    the previous ones (i.e. decompressing/reading the next chunk of a rom
+    while the current one is written to sdcard). At most depth items are
+    buffered. Exceptions raised by the worker are re-raised in the caller.
+
+    Keyword Arguments:
+    iterable -- iterable producing the items
+    depth -- maximum number of items produced in advance"""
+
+    items = queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((True, done))
+        except Exception as e:
+            put((False, e))
+
+    thread = threading.Thread(target=metrics.bind(worker))
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            ok, item = items.get()
+            if not ok:
+                raise item
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def parallel_read(read_at, start, length, chunk_size=1024*1024, depth=4):
+    """Read a region in chunks with several reads in flight at once
+
+    Many USB sdcard readers only reach their full speed when more than one
+    request is outstanding. This keeps depth positional reads of adjacent
+    chunks running in a small thread pool and yields the chunks in order. At
+    most depth chunks are buffered, a new read is started as soon as the
+    oldest chunk has been handed out.
+
+    Keyword Arguments:
+    read_at -- function(offset, length) returning data, has to be thread safe
+    start -- start of region in bytes
+    length -- length of region in bytes
+    chunk_size -- size of a single read
+    depth -- number of reads in flight (1 = plain sequential reads)"""
+
+    end = start + length
+
+    if depth <= 1 or not ThreadPoolExecutor:
+        position = start
+        while position < end:
+            chunk = read_at(position, min(chunk_size, end - position))
+            if not chunk:
+                raise Exception("Unexpected end of disk at 0x%x" % position)
+            position += len(chunk)
+            yield chunk
+        return
+
+    read_at = metrics.bind(read_at)
+    executor = ThreadPoolExecutor(depth)
+    pending = collections.deque()
+    position = start
+    try:
+        while position < end or pending:
+            while position < end and len(pending) < depth:
+                size = min(chunk_size, end - position)
+                pending.append((position, size, executor.submit(read_at, position, size)))
+                position += size
+
+            offset, size, future = pending.popleft()
+            chunk = future.result()
+            if len(chunk) != size:
+                raise Exception("Unexpected end of disk at 0x%x" % (offset + len(chunk)))
+            yield chunk
+    finally:
+        for offset, size, future in pending:
+            future.cancel()
+        executor.shutdown()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+import sys
+import time
+import threading
+
+class Cancelled(Exception):
+    """Raised inside a long operation after its CancelToken was cancelled"""
+
+    def __init__(self):
+        Exception.__init__(self, "Cancelled")
+
+class CancelToken:
+    """Cancel a long operation, i.e. from a GUI button or another thread
+
+    The operation stops with Cancelled at its next chunk. Interrupted rom
+    writes and (uncompressed) dumps keep their checkpoint and can be resumed."""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def is_cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled()
+
+class ProgressEvent:
+    """State of a long operation, handed to progress listeners
+
+    operation -- i.e. 'write_rom' or 'dump_rom'
+    target -- rom, image or sdcard the operation works on
+    phase -- current step (i.e. 'copy', 'commit'), None if there is only one
+    done -- bytes done
+    total -- bytes to do (0 if unknown)
+    rate -- bytes per second since the last event
+    average_rate -- exponentially weighted moving average of rate
+    eta -- seconds left (None if unknown)
+    finished -- last event of the operation"""
+
+    def __init__(self, operation, target, phase, done, total, rate, average_rate, eta, finished):
+        self.operation = operation
+        self.target = target
+        self.phase = phase
+        self.done = done
+        self.total = total
+        self.rate = rate
+        self.average_rate = average_rate
+        self.eta = eta
+        self.finished = finished
+
+    def fraction(self):
+        """Done as a fraction of total (0 if total is unknown)"""
+        if not self.total:
+            return 0.0
+        return min(1.0, float(self.done) / self.total)
+
+class Progress:
+    """Turns progress updates of a long operation into ProgressEvents
+
+    update() is cheap enough to be called for every chunk: it checks the
+    cancel token and only builds an event for the listener when the last
+    one is at least 1 / max_rate seconds old (and always for the last one,
+    see finish)."""
+
+    def __init__(self, operation, total, listener=None, silent=False, cancel=None, target=None, done=0, max_rate=10, smoothing=0.3):
+        """Keyword Arguments:
+
+        operation -- name of the operation
+        total -- bytes to do
+        listener -- function(ProgressEvent), if there is none (and silent
+                    isn't set) a TextBar is shown
+        silent -- no TextBar
+        cancel -- CancelToken
+        target -- what the operation works on (see ProgressEvent)
+        done -- bytes that are already done (i.e. when resuming)
+        max_rate -- maximum number of events per second
+        smoothing -- weight of the current rate in average_rate"""
+
+        if not listener and not silent:
+            listener = TextBar()
+        self.listener = listener
+        self.operation = operation
+        self.total = total
+        self.cancel = cancel
+        self.target = target
+        self.phase = None
+        self.done = done
+        self.interval = 1.0 / max_rate if max_rate else 0
+        self.smoothing = smoothing
+
+        self.rate = None
+        self.average_rate = None
+        self.last_time = time.time()
+        self.last_done = done
+        self.last_event = 0
+
+    def update(self, done, phase=None):
+        """Report bytes done, raises Cancelled if the operation was cancelled"""
+
+        if self.cancel:
+            self.cancel.check()
+        self.done = done
+        if phase:
+            self.phase = phase
+        if not self.listener:
+            return
+
+        now = time.time()
+        if now - self.last_event >= self.interval:
+            self.emit(now, False)
+
+    def advance(self, length, phase=None):
+        self.update(self.done + length, phase)
+
+    def finish(self):
+        if self.listener:
+            self.emit(time.time(), True)
+
+    def emit(self, now, finished):
+        elapsed = now - self.last_time
+        if elapsed > 0:
+            self.rate = (self.done - self.last_done) / elapsed
+            if self.average_rate is None:
+                self.average_rate = self.rate
+            else:
+                self.average_rate = self.smoothing * self.rate + (1 - self.smoothing) * self.average_rate
+        self.last_time = now
+        self.last_done = self.done
+        self.last_event = now
+
+        eta = None
+        if self.total and self.average_rate:
+            eta = max(0, self.total - self.done) / self.average_rate
+        self.listener(ProgressEvent(self.operation, self.target, self.phase, self.done, self.total, self.rate, self.average_rate, 0 if finished else eta, finished))
+
+class TextBar:
+    """Progress listener drawing a progress bar on the terminal"""
+
+    def __init__(self, stream=None, width=40):
+        self.stream = stream or sys.stderr
+        self.width = width
+
+    def __call__(self, event):
+        fraction = event.fraction()
+        filled = int(fraction * self.width)
+        line = "%3d%% |%s%s| %d/%d MB" % (100 * fraction, "#" * filled, " " * (self.width - filled), event.done / 1024 / 1024, event.total / 1024 / 1024)
+        if event.average_rate:
+            line += " %7.1f MB/s" % (event.average_rate / 1024 / 1024)
+        if event.eta != None and not event.finished:
+            line += " ETA %d:%02d:%02d" % (event.eta / 3600, event.eta / 60 % 60, event.eta % 60)
+        self.stream.write("\r" + line.ljust(self.width + 50))
+        if event.finished:
+            self.stream.write("\n")
+        self.stream.flush()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# columns the filter of the gui searches in
+search_keys = ('product_code', 'title', 'card_type', 'save_crypto')
+
+class RomTable:
+    """Rows of the rom table of the gui, by slot
+
+    Slot, start and size are known as soon as the card is opened, the rest
+    is filled in (one rom at a time) while the headers are read or taken
+    from the catalog. Filtering and sorting only work on the rows in memory
+    and never touch the card."""
+
+    def __init__(self):
+        self.roms = {}
+        self.sort_key = 'slot'
+        self.sort_reverse = False
+
+    def fill(self, rom_list):
+        """Start over with the roms of a (new) rom list, see Sky3DS_Disk.rom_list"""
+        self.roms = {}
+        for rom in rom_list:
+            self.roms[rom[0]] = {
+                'slot': rom[0],
+                'start': rom[1],
+                'size': rom[2],
+                'card_type': "",
+                'product_code': "",
+                'title': "Loading...",
+                'save_crypto': "",
+                }
+
+    def update(self, rom):
+        """Fill in a rom listed by catalog.card_listing
+
+        Returns False if its slot isn't in the table (anymore)."""
+
+        if not rom['slot'] in self.roms:
+            return False
+        self.roms[rom['slot']].update(rom)
+        return True
+
+    def sort(self, key):
+        # sorting by the same column again reverses the order
+        if self.sort_key == key:
+            self.sort_reverse = not self.sort_reverse
+        else:
+            self.sort_key = key
+            self.sort_reverse = False
+
+    def rows(self, search=""):
+        """Rows to show, sorted and matching search (case insensitive)"""
+        search = search.strip().lower()
+        roms = sorted(self.roms.values(), key=lambda x: x[self.sort_key], reverse=self.sort_reverse)
+        return [rom for rom in roms if not search or any(search in rom[key].lower() for key in search_keys)]
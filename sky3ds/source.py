@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+import os
+import io
+import struct
+import logging
+import zipfile
+import gzip
+import bz2
+
+try:
+    import lzma
+except:
+    lzma = None
+
+from sky3ds import container, pipeline
+
+# everything needed to get serial, sha1, template data and 3dz headers
+header_length = 0x4000
+
+rom_extensions = ('.3ds', '.3dz', '.cci')
+
+class RomSource:
+    """A rom that is about to be written to sdcard
+
+    Roms can be plain files, compressed containers (see container.py), members
+    of zip archives or gzip/xz/bz2 compressed files. Only the first
+    header_length bytes are buffered, they are used for everything that needs
+    to seek inside the rom (serial, sha1, template and 3dz header detection).
+    The rom data itself is streamed with chunks().
+
+    Attributes:
+    name -- filename of the rom (inside the archive, without compression suffix)
+    size -- rom size in bytes
+    size_is_guess -- size was taken from the ncsd header (see check_size)
+    header -- the first header_length bytes of the rom"""
+
+    def __init__(self, name, fp, size):
+        self.name = name
+        self.fp = fp
+        self.header = fp.read(header_length)
+
+        self.size_is_guess = False
+        if size == None:
+            size = self.guess_size()
+        self.size = size
+
+    def guess_size(self):
+        """Get the size of a rom from a stream that doesn't store it
+
+        Decompressing the whole stream just to count its bytes would take as
+        long as writing the rom, so the size is taken from the ncsd header
+        (media size at 0x104, in 0x200 byte units)."""
+
+        if self.header[0x100:0x104] != b'NCSD':
+            raise Exception("Can't get the size of %s, please specify it" % self.name)
+        self.size_is_guess = True
+        return struct.unpack("<I", self.header[0x104:0x108])[0] * 0x200
+
+    def check_size(self):
+        """Make sure size is the real size before anything is written
+
+        Trimmed roms are smaller than their ncsd header says, so a guessed
+        size would only fail at the end of the stream, after most of the rom
+        was written to sdcard. The stream is read once to count its bytes
+        then."""
+
+        if self.size_is_guess:
+            logging.info("Size of %s isn't stored in the file, reading it once to get it (specify the size to skip this)." % self.name)
+            self.size = self.count_size()
+            self.size_is_guess = False
+
+    def count_size(self):
+        raise Exception("Can't get the size of %s, please specify it" % self.name)
+
+    def header_fp(self):
+        """File object for the buffered header (for gamecard.ncsd_serial & co)"""
+        return io.BytesIO(self.header)
+
+    def skip(self, length):
+        """Move the stream length bytes past the header (seek if possible, read otherwise)"""
+        try:
+            self.fp.seek(len(self.header) + length)
+            return
+        except:
+            pass
+        while length > 0:
+            data = self.fp.read(min(length, 1024*1024*8))
+            if not data:
+                raise Exception("Unexpected end of rom")
+            length -= len(data)
+
+    def _read_chunks(self, chunk_size, start):
+        read = start
+        pending = self.header[start:]
+        if start > len(self.header):
+            self.skip(start - len(self.header))
+        while read < self.size:
+            length = min(chunk_size, self.size - read)
+            chunk = pending[:length]
+            pending = pending[length:]
+            while len(chunk) < length:
+                data = self.fp.read(length - len(chunk))
+                if not data:
+                    raise Exception("Unexpected end of rom after %d of %d bytes" % (read + len(chunk), self.size))
+                chunk += data
+            read += length
+            yield chunk
+
+    def chunks(self, chunk_size=1024*1024*8, depth=2, start=0):
+        """Iterate over the rom data
+
+        Reading (and decompressing) is done in a background thread, so it
+        overlaps with writing to sdcard. This can only be called once.
+
+        Keyword Arguments:
+        chunk_size -- size of the chunks
+        depth -- number of chunks to read in advance
+        start -- start at this offset (to resume an interrupted write)"""
+
+        return pipeline.prefetch(self._read_chunks(chunk_size, start), depth)
+
+    def close(self):
+        self.fp.close()
+
+class FileRomSource(RomSource):
+    def __init__(self, path):
+        self.path = path
+        RomSource.__init__(self, path, open(path, "rb"), os.path.getsize(path))
+
+class ContainerRomSource(RomSource):
+    def __init__(self, path):
+        self.path = path
+        fp = container.open_file(path)
+        RomSource.__init__(self, container.strip_extension(path), fp, fp.size)
+
+class ZipRomSource(RomSource):
+    def __init__(self, path, member=None):
+        self.zipfp = zipfile.ZipFile(path)
+
+        if member == None:
+            members = [i.filename for i in self.zipfp.infolist() if i.filename.lower().endswith(rom_extensions)]
+            if len(members) != 1:
+                self.zipfp.close()
+                raise Exception("Found %d roms in %s, please specify one as %s:<rom>" % (len(members), path, path))
+            member = members[0]
+
+        try:
+            info = self.zipfp.getinfo(member)
+        except KeyError:
+            self.zipfp.close()
+            raise Exception("%s not found in %s" % (member, path))
+
+        RomSource.__init__(self, member, self.zipfp.open(info), info.file_size)
+
+    def close(self):
+        self.fp.close()
+        self.zipfp.close()
+
+class StreamRomSource(RomSource):
+    """gzip, xz and bz2 compressed roms"""
+
+    def __init__(self, path, size=None):
+        self.path = path
+        name, ext = os.path.splitext(path)
+        self.ext = ext.lower()
+        RomSource.__init__(self, name, self.open_stream(), size)
+
+    def open_stream(self):
+        if self.ext == '.gz':
+            return gzip.open(self.path, "rb")
+        elif self.ext == '.xz':
+            if not lzma:
+                raise Exception("xz compression is not supported on this system")
+            return lzma.open(self.path, "rb")
+        return bz2.BZ2File(self.path, "rb")
+
+    def guess_size(self):
+        size = self.stream_size()
+        if size == None:
+            size = RomSource.guess_size(self)
+        return size
+
+    def count_size(self):
+        fp = self.open_stream()
+        try:
+            size = 0
+            while True:
+                data = fp.read(1024*1024*8)
+                if not data:
+                    return size
+                size += len(data)
+        finally:
+            fp.close()
+
+    def stream_size(self):
+        """Read the uncompressed size from the compressed file, None if unknown"""
+
+        fp = open(self.path, "rb")
+        try:
+            if self.ext == '.gz':
+                # gzip stores the size modulo 2^32, the ncsd header knows
+                # roughly how big the rom is
+                fp.seek(-4, os.SEEK_END)
+                size = struct.unpack("<I", fp.read(4))[0]
+                ncsd_size = struct.unpack("<I", self.header[0x104:0x108])[0] * 0x200
+                while size + 2**32 <= ncsd_size:
+                    size += 2**32
+                return size
+            elif self.ext == '.xz':
+                return xz_size(fp)
+        except:
+            pass
+        finally:
+            fp.close()
+        return None
+
+def xz_size(fp):
+    """Get uncompressed size of a (single stream) xz file from its index"""
+
+    def varint(data, pos):
+        value = 0
+        shift = 0
+        while True:
+            byte = data[pos]
+            if not isinstance(byte, int):
+                byte = ord(byte)
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            pos += 1
+            if not byte & 0x80:
+                return value, pos
+
+    fp.seek(-12, os.SEEK_END)
+    footer = fp.read(12)
+    if footer[10:12] != b'YZ':
+        raise Exception("Invalid xz footer")
+    index_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+    fp.seek(-12 - index_size, os.SEEK_END)
+    index = bytearray(fp.read(index_size))
+    if index[0] != 0x00:
+        raise Exception("Invalid xz index")
+    records, pos = varint(index, 1)
+    size = 0
+    for i in range(records):
+        unpadded_size, pos = varint(index, pos)
+        uncompressed_size, pos = varint(index, pos)
+        size += uncompressed_size
+    return size
+
+def open_rom(path, size=None):
+    """Open a rom for writing it to sdcard
+
+    Accepts plain roms, compressed containers, zip archives (with a single
+    rom or as archive.zip:rom.3ds) and .gz/.xz/.bz2 compressed roms.
+
+    Keyword Arguments:
+    path -- path to rom
+    size -- rom size in bytes for .gz/.xz/.bz2 roms (default: taken from
+            the compressed file or the ncsd header)"""
+
+    member = None
+    if not os.path.exists(path) and ':' in path:
+        path, member = path.rsplit(':', 1)
+
+    # follow symlink
+    path = os.path.realpath(path)
+
+    if not os.path.exists(path):
+        raise Exception("Rom %s not found" % path)
+
+    if zipfile.is_zipfile(path):
+        return ZipRomSource(path, member)
+    elif container.is_container(path):
+        return ContainerRomSource(path)
+    elif os.path.splitext(path)[1].lower() in ('.gz', '.xz', '.bz2'):
+        return StreamRomSource(path, size)
+    return FileRomSource(path)
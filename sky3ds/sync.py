@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import os
+
+from sky3ds import catalog, library
+
+# sky3ds cards are managed in 32MB blocks (see Sky3DS_Disk.update_rom_list)
+block_size = 0x2000000
+max_roms = 31
+
+# Card1 savegame slot and rom position headers, see Sky3DS_Disk.delete_rom
+savegame_size = 0x100000
+position_header_size = 0x100
+
+def size_in_blocks(size):
+    return int((size + block_size - 1) / block_size)
+
+def resolve_targets(targets):
+    """Find the roms for a list of serials and/or rom paths
+
+    Paths are scanned directly, serials are looked up in the rom library (see
+    library.py), roms with template data are preferred.
+
+    Returns a list of library entries (with 'path'), one per product-code"""
+
+    roms = []
+    for target in targets:
+        if os.path.exists(target) or (':' in target and os.path.exists(target.rsplit(':', 1)[0])):
+            entry = library.scan_rom(target)
+            entry['path'] = target
+        else:
+            entries = [i for i in library.query(serial=target) if target.upper() in (i['serial'].upper(), i['product_code'].upper())]
+            if not entries:
+                raise Exception("%s not found in rom library (see --index-library)" % target)
+            entry = sorted(entries, key=lambda x: (not x['has_template'], x['path']))[0]
+
+        if not entry['product_code'] in [i['product_code'] for i in roms]:
+            roms.append(entry)
+    return roms
+
+def place(used, roms, total_blocks):
+    """Find positions for roms in the free space between used blocks
+
+    Like Sky3DS_Disk.write_rom this puts every rom into the smallest free
+    region that's big enough, biggest roms first.
+
+    Keyword Arguments:
+    used -- list of (start, length) of used regions in 32MB blocks
+    roms -- roms to place
+    total_blocks -- size of the card in 32MB blocks
+
+    Returns a list of (rom, start block) or None if they don't fit"""
+
+    used = sorted([(0, 1)] + list(used))
+    placements = []
+    for rom in sorted(roms, key=lambda x: x['size'], reverse=True):
+        free = []
+        position = 0
+        for start, length in used + [(total_blocks, 0)]:
+            if start > position:
+                free.append((position, start - position))
+            position = max(position, start + length)
+
+        length = size_in_blocks(rom['size'])
+        fitting = sorted([i for i in free if i[1] >= length], key=lambda x: x[1])
+        if not fitting:
+            return None
+
+        placements.append((rom, fitting[0][0]))
+        used = sorted(used + [(fitting[0][0], length)])
+    return placements
+
+def delete_cost(slot, rom_count):
+    """Bytes delete_rom writes to remove the rom in slot
+
+    The Card1 savegame slots from slot on are rewritten (the following
+    savegames move down by one slot), the slot after the last rom is
+    cleared and the rom position headers are rewritten.
+
+    Keyword Arguments:
+    slot -- slot of the rom at the time it's deleted
+    rom_count -- number of roms on the card at that time"""
+
+    return (rom_count - slot + 1) * savegame_size + position_header_size
+
+def plan_sync(disk, targets):
+    """Work out the cheapest way to get a set of roms on a card
+
+    Roms on the card that aren't in targets get deleted, roms that are on the
+    card already stay where they are (and keep their savegames). The
+    remaining roms are placed in free space, if they don't fit, the roms on
+    the card are moved together first (compaction).
+
+    Keyword Arguments:
+    disk -- Sky3DS_Disk
+    targets -- list of serials and/or rom paths
+
+    Returns a list of operations, each a dict with 'op' (delete, move or
+    write), 'product_code', 'size', 'bytes' (bytes that have to be written)
+    and 'start' (delete), 'from'/'to' (move) or 'path'/'to' (write)"""
+
+    disk.fail_on_non_sky3ds()
+
+    card = catalog.card_listing(disk)
+    wanted = resolve_targets(targets)
+    wanted_codes = [i['product_code'] for i in wanted]
+
+    plan = []
+    kept = []
+    deleted = []
+    for rom in card['roms']:
+        if rom['product_code'] in wanted_codes and not rom['product_code'] in [i['product_code'] for i in kept]:
+            kept.append(rom)
+        else:
+            deleted.append(rom)
+
+    # delete the last slot first, so fewer savegames have to be moved down
+    rom_count = len(card['roms'])
+    for rom in sorted(deleted, key=lambda x: x['slot'], reverse=True):
+        plan.append({'op': 'delete', 'product_code': rom['product_code'], 'start': rom['start'], 'size': rom['size'], 'bytes': delete_cost(rom['slot'], rom_count)})
+        rom_count -= 1
+
+    missing = [i for i in wanted if not i['product_code'] in [j['product_code'] for j in kept]]
+    if len(kept) + len(missing) > max_roms:
+        raise Exception("There can be a maximum of %d games on one card." % max_roms)
+
+    total_blocks = int(disk.disk_size / block_size)
+    used = [(int(i['start'] / block_size), size_in_blocks(i['size'])) for i in kept]
+    placements = place(used, missing, total_blocks)
+
+    if placements == None:
+        # compaction: move all roms to the start of the card, in their current order
+        position = 1
+        used = []
+        for rom in sorted(kept, key=lambda x: x['start']):
+            if rom['start'] != position * block_size:
+                plan.append({'op': 'move', 'product_code': rom['product_code'], 'from': rom['start'], 'to': position * block_size, 'size': rom['size'], 'bytes': rom['size']})
+            used.append((position, size_in_blocks(rom['size'])))
+            position += size_in_blocks(rom['size'])
+        placements = place(used, missing, total_blocks)
+
+    if placements == None:
+        needed = sum(size_in_blocks(i['size']) for i in wanted) * block_size
+        raise Exception("Roms don't fit on card (%d MB needed, %d MB available)" % (needed / 1024 / 1024, disk.disk_size / 1024 / 1024 - 32))
+
+    for rom, start in sorted(placements, key=lambda x: x[1]):
+        plan.append({'op': 'write', 'product_code': rom['product_code'], 'path': rom['path'], 'to': start * block_size, 'size': rom['size'], 'bytes': rom['size']})
+
+    return plan
+
+def slot_at(disk, start):
+    """Slot of the rom at start, slots change when roms get deleted"""
+    for rom in disk.rom_list:
+        if rom[1] == start:
+            return rom[0]
+    raise Exception("No rom at 0x%x, card changed since planning?" % start)
+
+def execute_sync(disk, plan, silent=False, use_header_bin=False, progress=None, cancel=None):
+    """Execute a plan from plan_sync
+
+    Keyword Arguments:
+    disk -- Sky3DS_Disk
+    plan -- list of operations from plan_sync
+    silent -- don't show progress bars while moving/writing roms
+    use_header_bin -- see Sky3DS_Disk.write_rom
+    progress -- function(ProgressEvent) instead of progress bars, called
+                for every move/write
+    cancel -- CancelToken, stops before the next operation (or during a
+              write)"""
+
+    for op in plan:
+        if cancel:
+            cancel.check()
+        if op['op'] == 'delete':
+            disk.delete_rom(slot_at(disk, op['start']))
+        elif op['op'] == 'move':
+            disk.move_rom(slot_at(disk, op['from']), int(op['to'] / 0x200), silent=silent, progress=progress)
+        elif op['op'] == 'write':
+            disk.write_rom(op['path'], silent=silent, progress=progress, use_header_bin=use_header_bin, start_block=int(op['to'] / 0x200), cancel=cancel)
@@ -0,0 +1,139 @@
+import unittest
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+class AsyncSky3DSDisk_Test(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.restore_data_dir = fixtures.isolate_data_dir(self.work_dir)
+
+        self.image = os.path.join(self.work_dir, "card.img")
+        fixtures.make_image(self.image, 0x10000000)
+        sky3ds_disk = Sky3DS_Disk(self.image)
+        sky3ds_disk.format()
+        sky3ds_disk.diskfp.close()
+
+        self.roms = []
+        for i in range(2):
+            rom = os.path.join(self.work_dir, "%d.3ds" % i)
+            fixtures.make_rom(rom, 0x2000000, fixtures.product_code(i), 1, int(fixtures.media_id(i), 16))
+            self.roms.append(rom)
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = ThreadPoolExecutor(4)
+        self.card = self.loop.run_until_complete(aio.AsyncSky3DSDisk.open(self.image, executor=self.executor))
+
+        # small, slow chunks, so there is time to cancel a write
+        self.card.disk.tuning['write_chunk_size'] = 0x100000
+        write_at = self.card.disk.write_at
+        def slow_write_at(offset, data):
+            time.sleep(0.01)
+            write_at(offset, data)
+        self.card.disk.write_at = slow_write_at
+
+    def tearDown(self):
+        self.card.disk.diskfp.close()
+        self.executor.shutdown()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.restore_data_dir()
+        shutil.rmtree(self.work_dir)
+
+    def run_until_complete(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def product_codes(self):
+        # as found on the card, not as remembered by self.card
+        sky3ds_disk = Sky3DS_Disk(self.image)
+        try:
+            return [rom['product_code'] for rom in catalog.card_listing(sky3ds_disk)['roms']]
+        finally:
+            sky3ds_disk.diskfp.close()
+
+    def test_write_rom(self):
+        async def write():
+            operation = self.card.write_rom(self.roms[0], silent=True)
+            events = [event async for event in operation]
+            await operation
+            return events
+        events = self.run_until_complete(write())
+
+        if not events or not events[-1].finished or events[-1].done != 0x2000000:
+            raise Exception("Wrong progress events")
+        if any(a.done > b.done for a, b in zip(events, events[1:])):
+            raise Exception("Progress events out of order")
+        if self.product_codes() != [fixtures.product_code(0)]:
+            raise Exception("Rom not written")
+
+    def test_cancel_before_start(self):
+        # the second write waits for the first one, it's cancelled before
+        # it starts and never touches the card
+        async def write():
+            first = self.card.write_rom(self.roms[0], silent=True)
+            second = self.card.write_rom(self.roms[1], silent=True)
+            second.cancel()
+            await first
+            try:
+                await second
+                raise Exception("Waiting write wasn't cancelled")
+            except Cancelled:
+                pass
+            if [event async for event in second]:
+                raise Exception("Cancelled write reported progress")
+        self.run_until_complete(write())
+
+        if self.product_codes() != [fixtures.product_code(0)]:
+            raise Exception("Cancelled rom written anyway")
+
+    def test_cancel_running(self):
+        async def write():
+            operation = self.card.write_rom(self.roms[0], silent=True)
+            async for event in operation:
+                if event.phase == 'copy' and event.done:
+                    operation.cancel()
+            try:
+                await operation
+                raise Exception("Running write wasn't cancelled")
+            except Cancelled:
+                pass
+        self.run_until_complete(write())
+
+        if self.card.rom_list or not os.listdir(checkpoint.checkpoints_dir):
+            raise Exception("Cancelled write not stopped at a checkpoint")
+
+        # the interrupted write can be resumed
+        self.run_until_complete(self.card.write_rom(self.roms[0], silent=True, resume=True))
+        if self.product_codes() != [fixtures.product_code(0)] or os.listdir(checkpoint.checkpoints_dir):
+            raise Exception("Cancelled write not resumed")
+
+    def test_wait_for(self):
+        async def write():
+            try:
+                await asyncio.wait_for(self.card.write_rom(self.roms[0], silent=True), 0.1)
+                raise Exception("Write didn't time out")
+            except asyncio.TimeoutError:
+                pass
+            # the card stays busy until the thread has stopped
+            await self.card.listing()
+        self.run_until_complete(write())
+
+        if self.card.rom_list or not os.listdir(checkpoint.checkpoints_dir):
+            raise Exception("Timed out write not stopped")
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append(".")
+    sys.path.append("./third_party/appdirs")
+    from sky3ds import aio, catalog, checkpoint, fixtures
+    from sky3ds.disk import Sky3DS_Disk
+    from sky3ds.progress import Cancelled
+    unittest.main()
+else:
+    from sky3ds import aio, catalog, checkpoint, fixtures
+    from sky3ds.disk import Sky3DS_Disk
+    from sky3ds.progress import Cancelled
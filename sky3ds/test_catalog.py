@@ -0,0 +1,92 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+class Catalog_Test(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.restore_data_dir = fixtures.isolate_data_dir(self.work_dir)
+
+        image = os.path.join(self.work_dir, "card.img")
+        fixtures.make_image(image, 0x10000000)
+        self.disk = Sky3DS_Disk(image)
+        self.disk.format()
+        self.write_rom(0)
+        self.write_rom(1)
+
+    def tearDown(self):
+        self.restore_data_dir()
+        self.disk.diskfp.close()
+        shutil.rmtree(self.work_dir)
+
+    def write_rom(self, i):
+        rom = os.path.join(self.work_dir, "%d.3ds" % i)
+        fixtures.make_rom(rom, 0x2000000, fixtures.product_code(i), 1, int(fixtures.media_id(i), 16))
+        self.disk.write_rom(rom, silent=True)
+
+    def test_cached_listing(self):
+        card = catalog.card_listing(self.disk)
+        if [rom['product_code'] for rom in card['roms']] != [fixtures.product_code(0), fixtures.product_code(1)]:
+            raise Exception("Wrong listing: %s" % card['roms'])
+        if list(catalog.load_catalog()) != [card['fingerprint']]:
+            raise Exception("Card not stored in catalog")
+
+        # known cards are listed without reading the rom headers
+        read_card = catalog.read_card
+        def failing_read_card(*args, **kwargs):
+            raise Exception("Card read again")
+        catalog.read_card = failing_read_card
+        try:
+            found = []
+            cached = catalog.card_listing(self.disk, on_rom=found.append)
+        finally:
+            catalog.read_card = read_card
+        if cached['roms'] != card['roms'] or found != card['roms']:
+            raise Exception("Cached listing differs")
+
+    def test_unchanged_card_not_written(self):
+        card = catalog.card_listing(self.disk)
+        mtime = os.path.getmtime(catalog.catalog_json)
+        os.utime(catalog.catalog_json, (mtime - 10, mtime - 10))
+
+        catalog.card_listing(self.disk, fingerprint=card['fingerprint'])
+        if os.path.getmtime(catalog.catalog_json) != mtime - 10:
+            raise Exception("Catalog written although nothing changed")
+
+    def test_replaces(self):
+        fingerprint = catalog.card_listing(self.disk)['fingerprint']
+
+        self.write_rom(2)
+        card = catalog.card_listing(self.disk, replaces=fingerprint)
+        if card['fingerprint'] == fingerprint or len(card['roms']) != 3:
+            raise Exception("Listing not updated after writing a rom")
+        if list(catalog.load_catalog()) != [card['fingerprint']]:
+            raise Exception("Replaced card is still in the catalog")
+
+        # restoring a savegame changes the unique id, so the card changes too
+        savegame = os.path.join(self.work_dir, "0.sav")
+        self.disk.dump_savegame(0, savegame)
+        savegamefp = open(savegame, "r+b")
+        savegamefp.seek(0x18)
+        savegamefp.write(bytearray([0x42] * 0x40))
+        savegamefp.close()
+        self.disk.write_savegame(savegame)
+        updated = catalog.card_listing(self.disk, replaces=card['fingerprint'])
+        if updated['fingerprint'] == card['fingerprint'] or not updated['roms'][0]['unique_id'].startswith("42 42"):
+            raise Exception("Listing not updated after restoring a savegame")
+
+        catalog.forget(updated['fingerprint'])
+        if catalog.load_catalog():
+            raise Exception("Card not removed from catalog")
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append(".")
+    sys.path.append("./third_party/appdirs")
+    from sky3ds import catalog, fixtures
+    from sky3ds.disk import Sky3DS_Disk
+    unittest.main()
+else:
+    from sky3ds import catalog, fixtures
+    from sky3ds.disk import Sky3DS_Disk
@@ -0,0 +1,64 @@
+import unittest
+import io
+import os
+
+class Container_Test(unittest.TestCase):
+    def roundtrip(self, codec):
+        data = bytearray(os.urandom(0x4000)) + bytearray([0xff]*0x30000) + bytearray(b'sky3ds'*0x1000)
+
+        outputfp = io.BytesIO()
+        outputfp.write(b'prefix')
+        writer = container.ContainerWriter(outputfp, codec, block_size=0x10000, threads=2)
+        writer.write(data[:0x1234])
+        writer.write(data[0x1234:])
+        writer.close()
+
+        outputfp.seek(len(b'prefix'))
+        reader = container.ContainerReader(outputfp)
+        if reader.size != len(data):
+            raise Exception("Container size is wrong")
+        if reader.read() != bytes(data):
+            raise Exception("Container data is wrong")
+
+        for offset in [0x0, 0xfff0, 0x10000, 0x20001, len(data) - 3]:
+            reader.seek(offset)
+            if reader.read(0x100) != bytes(data[offset:offset+0x100]):
+                raise Exception("Seeking inside container doesn't work")
+        reader.close()
+
+    def test_zlib(self):
+        self.roundtrip('zlib')
+
+    def test_bz2(self):
+        self.roundtrip('bz2')
+
+    def test_lzma(self):
+        if 'lzma' in container.codec_names():
+            self.roundtrip('lzma')
+
+    def test_ff_blocks_not_stored(self):
+        outputfp = io.BytesIO()
+        writer = container.ContainerWriter(outputfp, 'store', block_size=0x10000)
+        writer.write(bytearray([0xff]*0x100000))
+        writer.close()
+        if len(outputfp.getvalue()) > 0x1000:
+            raise Exception("Blocks filled with 0xff should not be stored")
+
+    def test_image_header(self):
+        extents = [(0, 0x2000000, 0x40), (0x6000000, 0x8000000, 0x1234)]
+
+        outputfp = io.BytesIO()
+        outputfp.write(bytearray([0x00]*0x2000))
+        container.write_image_header(outputfp, 0x40000000, extents)
+
+        disk_size, read_extents = container.read_image_header(outputfp)
+        if disk_size != 0x40000000 or read_extents != extents:
+            raise Exception("Card image header is wrong")
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append(".")
+    from sky3ds import container
+    unittest.main()
+else:
+    from sky3ds import container
@@ -0,0 +1,120 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+class Devices_Test(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old_dirs = (devices.sysfs_block, devices.dev_dir)
+        devices.sysfs_block = os.path.join(self.root, 'sys', 'block')
+        devices.dev_dir = os.path.join(self.root, 'dev')
+        os.makedirs(devices.sysfs_block)
+        os.makedirs(devices.dev_dir)
+        devices._cache.clear()
+
+    def tearDown(self):
+        devices.sysfs_block, devices.dev_dir = self.old_dirs
+        devices._cache.clear()
+        shutil.rmtree(self.root)
+
+    def add_device(self, name, sectors, removable=1, vendor='Generic', model='SD Reader', diskseq=1, magic=None):
+        device_dir = os.path.join(devices.sysfs_block, name)
+        attributes = {
+            'size': sectors,
+            'removable': removable,
+            'diskseq': diskseq,
+            'queue/logical_block_size': 512,
+            'queue/physical_block_size': 4096,
+            'device/vendor': vendor,
+            'device/model': model,
+            }
+        for attribute, value in attributes.items():
+            path = os.path.join(device_dir, attribute)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            attribute_fp = open(path, "w")
+            attribute_fp.write("%s\n" % value)
+            attribute_fp.close()
+
+        # the "block device"
+        device_fp = open(os.path.join(devices.dev_dir, name), "wb")
+        device_fp.write(bytearray([0xff] * 0x100) + (magic or b'\0\0\0\0'))
+        device_fp.close()
+
+    def test_list_devices(self):
+        self.add_device('sdb', 0x400000, magic=b'ROMS')
+        self.add_device('sda', 0x10000000, removable=0, vendor='ATA', model='Some SSD')
+        self.add_device('sdc', 0)
+        self.add_device('sdd', 0x400000, removable=0, magic=b'ROMS')
+        self.add_device('mmcblk0', 0x400000, removable=0)
+        self.add_device('loop0', 0x1000)
+
+        found = devices.list_devices()
+        if [device['name'] for device in found] != ['mmcblk0', 'sdb', 'sdd']:
+            raise Exception("Wrong devices found: %s" % [device['name'] for device in found])
+
+        sdb = found[1]
+        if sdb['disk_path'] != os.path.join(devices.dev_dir, 'sdb') or sdb['size'] != 0x400000 * 512:
+            raise Exception("Device path or size is wrong")
+        if not sdb['removable'] or sdb['model'] != 'SD Reader' or sdb['physical_block_size'] != 4096:
+            raise Exception("Device attributes are wrong")
+        if not sdb['is_sky3ds_disk'] or found[0]['is_sky3ds_disk']:
+            raise Exception("'ROMS'-String check doesn't work correctly")
+
+        if [device['name'] for device in devices.list_devices(include_empty=True)] != ['mmcblk0', 'sdb', 'sdc', 'sdd']:
+            raise Exception("Empty readers should be listed with include_empty")
+
+        if [device['name'] for device in devices.list_devices(include_fixed=True)] != ['mmcblk0', 'sda', 'sdb', 'sdd']:
+            raise Exception("Fixed disks should be listed with include_fixed")
+
+    def test_cache(self):
+        self.add_device('sdb', 0x400000)
+        if devices.list_devices()[0]['is_sky3ds_disk']:
+            raise Exception("Not a sky3ds disk yet")
+
+        # same card, still cached
+        self.add_device('sdb', 0x400000, magic=b'ROMS')
+        if devices.list_devices()[0]['is_sky3ds_disk']:
+            raise Exception("Device should have been taken from the cache")
+
+        # another card
+        self.add_device('sdb', 0x400000, diskseq=2, magic=b'ROMS')
+        if not devices.list_devices()[0]['is_sky3ds_disk']:
+            raise Exception("Media change wasn't noticed")
+
+        shutil.rmtree(os.path.join(devices.sysfs_block, 'sdb'))
+        if devices.list_devices() or devices._cache:
+            raise Exception("Removed device is still listed")
+
+    def test_poll(self):
+        changed, state = devices.poll()
+        changed, state = devices.poll(state)
+        if changed:
+            raise Exception("Nothing happened, but poll reports a change")
+
+        self.add_device('sdb', 0)
+        changed, state = devices.poll(state)
+        if not changed:
+            raise Exception("New reader wasn't noticed")
+
+        # card inserted
+        self.add_device('sdb', 0x400000, diskseq=2)
+        changed, state = devices.poll(state)
+        if not changed:
+            raise Exception("Inserted card wasn't noticed")
+
+    def test_block_device_size(self):
+        self.add_device('sdb', 0x400000)
+        device_fp = open(os.path.join(devices.dev_dir, 'sdb'), "rb")
+        if devices.block_device_size(device_fp.fileno()) != None:
+            raise Exception("Regular files have no block device size")
+        device_fp.close()
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append(".")
+    from sky3ds import devices
+    unittest.main()
+else:
+    from sky3ds import devices
@@ -1,4 +1,11 @@
 import unittest
+import io
+import os
+import bz2
+import struct
+import shutil
+import tempfile
+import threading
 
 class Sky3DS_Disk_Test(unittest.TestCase):
     disk = None
@@ -11,6 +18,14 @@ class Sky3DS_Disk_Test(unittest.TestCase):
         dummyfile.write(bytearray("yo", "ascii"))
         dummyfile.close()
 
+        self.work_dir = tempfile.mkdtemp()
+        self.restore_data_dir = fixtures.isolate_data_dir(self.work_dir)
+
+    @classmethod
+    def tearDownClass(self):
+        self.restore_data_dir()
+        shutil.rmtree(self.work_dir)
+
     @classmethod
     def test_0_open(self):
         self.disk = Sky3DS_Disk("test.img")
@@ -64,16 +79,314 @@ class Sky3DS_Disk_Test(unittest.TestCase):
         if not len(self.disk.rom_list) == 0:
             raise Exception("Rom not deleted correctly or slot detection broken")
 
+class WriteBatch_Test(unittest.TestCase):
+    def test_au_aligned_writes(self):
+        disk = Sky3DS_Disk("writebatch.img", diskfp=io.BytesIO(bytearray([0xff]*0x4000000)), disk_size=0x4000000)
+        au_size = disk.tuning['au_size']
+
+        writes = []
+        write_at = disk.write_at
+        def logged_write_at(offset, data):
+            writes.append((offset, len(data)))
+            write_at(offset, data)
+        disk.write_at = logged_write_at
+
+        batch = WriteBatch(disk)
+        batch.write(0x100000, bytearray([0x00]*0x200))
+        batch.write(0x200000, b'savegame')
+        batch.write(0x2001400, b'card data')
+        batch.flush()
+        disk.sync()
+
+        if [i for i in writes if i[0] % au_size or i[1] % au_size]:
+            raise Exception("Writes are not aligned to allocation units")
+        if len(writes) != 2:
+            raise Exception("Writes to the same allocation unit are not merged")
+        if disk.read_at(0x0, 0x10) != b'\xff'*0x10 or disk.read_at(0x100000, 0x201) != b'\x00'*0x200 + b'\xff' or disk.read_at(0x200000, 0x8) != b'savegame' or disk.read_at(0x2001400, 0x9) != b'card data':
+            raise Exception("Data not written correctly")
+
+    def test_max_size(self):
+        disk = Sky3DS_Disk("writebatch.img", diskfp=io.BytesIO(bytearray([0xff]*0x4000000)), disk_size=0x4000000)
+
+        batch = WriteBatch(disk, max_size=0x180000)
+        batch.write(0x100000, bytearray([0x00]*0x100000))
+        if disk.read_at(0x100000, 0x1) != b'\xff':
+            raise Exception("Write not queued")
+        batch.write(0x200000, bytearray([0x00]*0x100000))
+        if batch.writes or disk.read_at(0x100000, 0x200000) != b'\x00'*0x200000:
+            raise Exception("Batch not flushed at max_size")
+
+class WriteSavegames_Test(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.restore_data_dir = fixtures.isolate_data_dir(self.work_dir)
+        image = os.path.join(self.work_dir, "card.img")
+        fixtures.make_image(image, 0x10000000)
+        self.disk = Sky3DS_Disk(image)
+        self.disk.format()
+        for i, card_type in enumerate([1, 2]):
+            rom = os.path.join(self.work_dir, "%d.3ds" % i)
+            fixtures.make_rom(rom, 0x2000000, fixtures.product_code(i), card_type, int(fixtures.media_id(i), 16))
+            self.disk.write_rom(rom, silent=True)
+
+    def tearDown(self):
+        self.restore_data_dir()
+        self.disk.diskfp.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_restore_directory(self):
+        card1_save = 0x100000
+        card2_save = self.disk.rom_list[1][1] + 0x1000000
+        self.disk.write_at(card1_save, b'\x01' * 0x100000)
+        self.disk.write_at(card2_save, b'\x02' * 0xa00000)
+
+        # backup directory with new unique ids and a savegame of a game that isn't on the card
+        backup_dir = os.path.join(self.work_dir, "saves")
+        os.mkdir(backup_dir)
+        for slot in range(2):
+            savegame = os.path.join(backup_dir, "%d.sav" % slot)
+            self.disk.dump_savegame(slot, savegame)
+            savegamefp = open(savegame, "r+b")
+            savegamefp.seek(0x18)
+            savegamefp.write(bytearray([0x10 + slot] * 0x40))
+            savegamefp.close()
+        savegamefp = open(os.path.join(backup_dir, "9.sav"), "wb")
+        savegamefp.write(b'CTR_SAVE' + fixtures.product_code(9).encode('ascii') + bytearray(0x46) + bytearray(0x100000))
+        savegamefp.close()
+
+        self.disk.write_at(card1_save, b'\xff' * 0x100000)
+        self.disk.write_at(card2_save, b'\xff' * 0xa00000)
+
+        writes = []
+        write_at = self.disk.write_at
+        def logged_write_at(offset, data):
+            writes.append((offset, len(data)))
+            write_at(offset, data)
+        self.disk.write_at = logged_write_at
+
+        results = dict((os.path.basename(savefile), result) for savefile, result in self.disk.write_savegames(backup_dir))
+        if results != {'0.sav': "OK", '1.sav': "OK", '9.sav': "Game not on disk"}:
+            raise Exception("Wrong results: %s" % results)
+
+        if self.disk.read_at(card1_save, 0x100000) != b'\x01' * 0x100000 or self.disk.read_at(card2_save, 0xa00000) != b'\x02' * 0xa00000:
+            raise Exception("Savegame data not restored")
+        for slot in range(2):
+            card_data = bytearray(self.disk.read_at(self.disk.rom_list[slot][1] + 0x1400, 0x200))
+            if card_data[0x40:0x80] != bytearray([0x10 + slot] * 0x40):
+                raise Exception("Unique id not restored")
+            crc16 = titles.crc16(card_data[:-2])
+            if card_data[-2:] != bytearray([(crc16 & 0xFF00) >> 8, crc16 & 0x00FF]):
+                raise Exception("Crc of the sky3ds header not updated")
+
+        # sky3ds headers are only written once all savegame data is there
+        def touches(write, offset):
+            return write[0] <= offset < write[0] + write[1]
+        last_data = max(i for i, write in enumerate(writes) if touches(write, card1_save) or touches(write, card2_save))
+        first_header = min(i for i, write in enumerate(writes) if touches(write, self.disk.rom_list[0][1] + 0x1400) or touches(write, self.disk.rom_list[1][1] + 0x1400))
+        if first_header < last_data:
+            raise Exception("Unique ids written before the savegame data")
+
+class Resume_Test(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.restore_data_dir = fixtures.isolate_data_dir(self.work_dir)
+
+        image = os.path.join(self.work_dir, "card.img")
+        fixtures.make_image(image, 0x20000000)
+        self.disk = Sky3DS_Disk(image)
+        self.disk.format()
+        self.disk.tuning['write_chunk_size'] = 0x400000
+
+        # rom with something else than zeros in every chunk
+        self.rom = os.path.join(self.work_dir, "rom.3ds")
+        fixtures.make_rom(self.rom, 0x8000000, fixtures.product_code(0), 1, int(fixtures.media_id(0), 16))
+        romfp = open(self.rom, "r+b")
+        for offset in range(0x400000, 0x8000000, 0x100000):
+            romfp.seek(offset)
+            romfp.write(struct.pack("<I", offset) * 4)
+        romfp.close()
+
+    def tearDown(self):
+        self.restore_data_dir()
+        self.disk.diskfp.close()
+        shutil.rmtree(self.work_dir)
+
+    def cancelled_write(self, chunks=20):
+        """Write the rom and cancel it after chunks chunks (the checkpoint is saved when cancelled)"""
+        cancel = CancelToken()
+        count = [0]
+        write_at = self.disk.write_at
+        def cancelling_write_at(offset, data):
+            write_at(offset, data)
+            if len(data) == 0x400000:
+                count[0] += 1
+                if count[0] == chunks:
+                    cancel.cancel()
+        self.disk.write_at = cancelling_write_at
+        try:
+            self.disk.write_rom(self.rom, silent=True, cancel=cancel)
+            raise Exception("Write wasn't cancelled")
+        except Cancelled:
+            pass
+        finally:
+            del self.disk.write_at
+        if self.disk.rom_list:
+            raise Exception("Cancelled rom is visible")
+
+    def resumed_write(self):
+        """Resume the write, returns offset of the first rom data written (relative to the rom)"""
+        writes = []
+        write_at = self.disk.write_at
+        def logged_write_at(offset, data):
+            if len(data) == 0x400000:
+                writes.append(offset)
+            write_at(offset, data)
+        self.disk.write_at = logged_write_at
+        try:
+            self.disk.write_rom(self.rom, silent=True, resume=True)
+        finally:
+            del self.disk.write_at
+
+        start = [rom for rom in self.disk.rom_list if self.disk.ncsd_header(rom[0])['product_code'] == fixtures.product_code(0)][0][1]
+        # (except for the sky3ds header at 0x1400)
+        romfp = open(self.rom, "rb")
+        rom_data = romfp.read()
+        romfp.close()
+        if self.disk.read_at(start, 0x1400) != rom_data[:0x1400] or self.disk.read_at(start + 0x1600, 0x8000000 - 0x1600) != rom_data[0x1600:]:
+            raise Exception("Rom not written correctly")
+        if os.listdir(checkpoint.checkpoints_dir):
+            raise Exception("Checkpoint not removed")
+        return writes[0] - start
+
+    def test_resume(self):
+        self.cancelled_write()
+        if self.resumed_write() != 0x5000000:
+            raise Exception("Write didn't resume at the last checkpoint")
+
+    def test_verify_mismatch(self):
+        self.cancelled_write()
+        # last checkpointed chunk got lost on sdcard
+        self.disk.write_at(0x2000000 + 0x4c00000, bytearray([0xff] * 0x400000))
+        if self.resumed_write() != 0:
+            raise Exception("Write resumed although the sdcard doesn't match the checkpoint")
+
+    def test_changed_source(self):
+        self.cancelled_write()
+        os.utime(self.rom, (0, 0))
+        if self.resumed_write() != 0:
+            raise Exception("Write resumed although the rom changed")
+
+    def test_changed_card(self):
+        self.cancelled_write()
+        other_rom = os.path.join(self.work_dir, "other.3ds")
+        fixtures.make_rom(other_rom, 0x2000000, fixtures.product_code(1), 1, int(fixtures.media_id(1), 16))
+        self.disk.write_rom(other_rom, silent=True)
+        if self.resumed_write() != 0:
+            raise Exception("Write resumed although the card changed")
+
+class CompressedRom_Test(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.restore_data_dir = fixtures.isolate_data_dir(self.work_dir)
+        image = os.path.join(self.work_dir, "card.img")
+        fixtures.make_image(image, 0x10000000)
+        self.disk = Sky3DS_Disk(image)
+        self.disk.format()
+
+        # trimmed: the ncsd header says 0x4000000 bytes
+        rom = os.path.join(self.work_dir, "0.3ds")
+        fixtures.make_rom(rom, 0x4000000, fixtures.product_code(0), 1, int(fixtures.media_id(0), 16))
+        romfp = open(rom, "r+b")
+        romfp.truncate(0x2800000)
+        romfp.close()
+        romfp = open(rom, "rb")
+        self.rom = rom + ".bz2"
+        bz2fp = bz2.BZ2File(self.rom, "wb")
+        bz2fp.write(romfp.read())
+        bz2fp.close()
+        romfp.close()
+
+    def tearDown(self):
+        self.restore_data_dir()
+        self.disk.diskfp.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_trimmed_rom(self):
+        self.disk.write_rom(self.rom, silent=True)
+        if [rom[2] for rom in self.disk.rom_list] != [0x2800000]:
+            raise Exception("Size of trimmed rom not counted before writing")
+
+    def test_rom_size(self):
+        # a given size is used as it is, the rom isn't read twice
+        count_size = source.StreamRomSource.count_size
+        def failing_count_size(self):
+            raise Exception("Rom size counted although it was given")
+        source.StreamRomSource.count_size = failing_count_size
+        try:
+            self.disk.write_rom(self.rom, silent=True, rom_size=0x2800000)
+        finally:
+            source.StreamRomSource.count_size = count_size
+        if [rom[2] for rom in self.disk.rom_list] != [0x2800000]:
+            raise Exception("Given rom size not used")
+
+class Dump_Test(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.restore_data_dir = fixtures.isolate_data_dir(self.work_dir)
+        image = os.path.join(self.work_dir, "card.img")
+        fixtures.make_image(image, 0x20000000)
+        self.disk = Sky3DS_Disk(image)
+        self.disk.format()
+        self.rom = os.path.join(self.work_dir, "0.3ds")
+        fixtures.make_rom(self.rom, 0x8000000, fixtures.product_code(0), 1, int(fixtures.media_id(0), 16))
+        self.disk.write_rom(self.rom, silent=True)
+        self.output = os.path.join(self.work_dir, "dump.3ds")
+
+    def tearDown(self):
+        self.restore_data_dir()
+        self.disk.diskfp.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_fsync_at_checkpoints(self):
+        fsync = os.fsync
+        fsyncs = []
+        def logged_fsync(fd):
+            fsyncs.append(fd)
+            fsync(fd)
+        os.fsync = logged_fsync
+        try:
+            self.disk.dump_rom(0, self.output, silent=True, chunk_size=0x100000)
+        finally:
+            os.fsync = fsync
+        # one per checkpoint (every 64MB) and one at the end
+        if len(fsyncs) != 3:
+            raise Exception("%d fsyncs for a 128MB dump" % len(fsyncs))
+
+    def test_cancelled_compressed_dump(self):
+        threads = threading.active_count()
+        cancel = CancelToken()
+        try:
+            self.disk.dump_rom(0, self.output, progress=lambda event: cancel.cancel(), compression='zlib', chunk_size=0x100000, cancel=cancel)
+            raise Exception("Dump wasn't cancelled")
+        except Cancelled:
+            pass
+        if threading.active_count() != threads:
+            raise Exception("Compression threads still running after a cancelled dump")
+        if container.is_container(self.output):
+            raise Exception("Cancelled dump looks like a complete container")
+
 if __name__ == '__main__':
     import filecmp
     import sys
     sys.path.append(".")
     sys.path.append("./third_party/appdirs")
-    sys.path.append("./third_party/progressbar")
-    from sky3ds.disk import Sky3DS_Disk
+    from sky3ds.disk import Sky3DS_Disk, WriteBatch
+    from sky3ds.progress import CancelToken, Cancelled
+    from sky3ds import checkpoint, container, fixtures, source, titles
     unittest.main()
 else:
-    from sky3ds.disk import Sky3DS_Disk
     import filecmp
-    import sys
+    from sky3ds.disk import Sky3DS_Disk, WriteBatch
+    from sky3ds.progress import CancelToken, Cancelled
+    from sky3ds import checkpoint, container, fixtures, source, titles
 
@@ -0,0 +1,83 @@
+import unittest
+import os
+import gzip
+import shutil
+import tempfile
+
+class Library_Test(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.restore_data_dir = fixtures.isolate_data_dir(self.work_dir)
+
+        self.library_dir = os.path.join(self.work_dir, "roms")
+        os.makedirs(os.path.join(self.library_dir, "sub"))
+        fixtures.make_rom(os.path.join(self.library_dir, "0.3ds"), 0x2000000, fixtures.product_code(0), 1, int(fixtures.media_id(0), 16))
+        fixtures.make_rom(os.path.join(self.library_dir, "sub", "1.3ds"), 0x8000000, fixtures.product_code(1), 2, int(fixtures.media_id(1), 16))
+
+        # compressed rom, the size comes from the ncsd header
+        fixtures.make_rom(os.path.join(self.work_dir, "2.3ds"), 0x4000000, fixtures.product_code(2), 1, int(fixtures.media_id(2), 16))
+        romfp = open(os.path.join(self.work_dir, "2.3ds"), "rb")
+        gzipfp = gzip.open(os.path.join(self.library_dir, "2.3ds.gz"), "wb")
+        gzipfp.write(romfp.read())
+        gzipfp.close()
+        romfp.close()
+
+        # not a rom, not a rom extension
+        junkfp = open(os.path.join(self.library_dir, "junk.3ds"), "wb")
+        junkfp.write(b'junk')
+        junkfp.close()
+        junkfp = open(os.path.join(self.library_dir, "readme.txt"), "wb")
+        junkfp.close()
+
+    def tearDown(self):
+        self.restore_data_dir()
+        shutil.rmtree(self.work_dir)
+
+    def test_index(self):
+        if library.index_library(self.library_dir, workers=4) != (3, 1):
+            raise Exception("Wrong number of scanned/failed files")
+
+        entries = sorted(library.query(), key=lambda x: x['product_code'])
+        if [(os.path.basename(i['path']), i['product_code'], i['size']) for i in entries] != [
+                ("0.3ds", fixtures.product_code(0), 0x2000000),
+                ("1.3ds", fixtures.product_code(1), 0x8000000),
+                ("2.3ds.gz", fixtures.product_code(2), 0x4000000)]:
+            raise Exception("Wrong library entries: %s" % entries)
+        if entries[1]['card_type'] != 'Card2' or entries[1]['media_id'] != fixtures.media_id(1):
+            raise Exception("Rom header not read correctly")
+
+        if [i['product_code'] for i in library.query(serial=fixtures.product_code(1)[6:])] != [fixtures.product_code(1)]:
+            raise Exception("Query by serial doesn't work")
+        if sorted(i['product_code'] for i in library.query(max_size=0x4000000)) != [fixtures.product_code(0), fixtures.product_code(2)]:
+            raise Exception("Query by size doesn't work")
+
+    def test_reindex(self):
+        library.index_library(self.library_dir)
+
+        # unchanged files (including the one that isn't a rom) aren't read again
+        scan_rom = library.scan_rom
+        def failing_scan_rom(path):
+            raise Exception("%s scanned again" % path)
+        library.scan_rom = failing_scan_rom
+        try:
+            if library.index_library(self.library_dir) != (0, 0):
+                raise Exception("Unchanged files scanned again")
+        finally:
+            library.scan_rom = scan_rom
+
+        os.remove(os.path.join(self.library_dir, "0.3ds"))
+        fixtures.make_rom(os.path.join(self.library_dir, "sub", "1.3ds"), 0x8000000, fixtures.product_code(3), 2, int(fixtures.media_id(3), 16))
+        os.utime(os.path.join(self.library_dir, "sub", "1.3ds"), (0, 0))
+        if library.index_library(self.library_dir) != (1, 0):
+            raise Exception("Changed rom not scanned again")
+        if sorted(i['product_code'] for i in library.query()) != [fixtures.product_code(2), fixtures.product_code(3)]:
+            raise Exception("Removed or changed rom not updated in library")
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append(".")
+    sys.path.append("./third_party/appdirs")
+    from sky3ds import fixtures, library
+    unittest.main()
+else:
+    from sky3ds import fixtures, library
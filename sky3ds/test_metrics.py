@@ -0,0 +1,146 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+class RecordingSink:
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class Metrics_Test(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.restore_data_dir = fixtures.isolate_data_dir(self.work_dir)
+        self.sink = RecordingSink()
+        metrics.add_sink(self.sink)
+
+    def tearDown(self):
+        metrics.remove_sinks()
+        self.restore_data_dir()
+        shutil.rmtree(self.work_dir)
+
+    def test_disabled(self):
+        metrics.remove_sinks()
+        with metrics.operation('test') as operation:
+            metrics.count('bytes_read', 1)
+        if metrics.current() or operation is not metrics._null or self.sink.records:
+            raise Exception("Recorded without a sink")
+
+    def test_operation(self):
+        with metrics.operation('outer', disk='card.img'):
+            with metrics.span('fsync', 'fsync_seconds'):
+                pass
+            with metrics.operation('inner'):
+                metrics.count('bytes_read', 0x200)
+            metrics.count('bytes_read', 0x200)
+            for item in metrics.timed([1, 2, 3], 'source_read'):
+                pass
+        try:
+            with metrics.operation('failing'):
+                raise Exception("Write error")
+        except Exception:
+            pass
+
+        if [record['operation'] for record in self.sink.records] != ['outer', 'failing']:
+            raise Exception("Wrong operations recorded: %s" % self.sink.records)
+        record = self.sink.records[0]
+        if record['labels'] != {'disk': 'card.img'} or record['error'] != None:
+            raise Exception("Wrong labels or error")
+        if sorted(record['phases']) != ['fsync', 'inner', 'source_read'] or record['phases']['source_read']['calls'] != 4:
+            raise Exception("Wrong phases: %s" % record['phases'])
+        if record['counters'] != {'bytes_read': 0x400}:
+            raise Exception("Nested counters not added to outer operation")
+        if record['histograms']['fsync_seconds']['count'] != 1 or record['histograms']['fsync_seconds']['buckets'][0] != [0.001, 1]:
+            raise Exception("Wrong histogram: %s" % record['histograms'])
+        if self.sink.records[1]['error'] != "Write error":
+            raise Exception("Error not recorded")
+        if metrics.current():
+            raise Exception("Operation still current")
+
+    def test_bind(self):
+        # counted in the threads of parallel_read and prefetch
+        def read_at(offset, length):
+            metrics.count('bytes_read', length)
+            return b'\0' * length
+        with metrics.operation('threaded'):
+            list(pipeline.prefetch(pipeline.parallel_read(read_at, 0, 0x10000, chunk_size=0x1000)))
+        if self.sink.records[0]['counters'] != {'bytes_read': 0x10000}:
+            raise Exception("Counters of worker threads not recorded")
+
+    def test_disk(self):
+        image = os.path.join(self.work_dir, "card.img")
+        rom = os.path.join(self.work_dir, "0.3ds")
+        fixtures.make_image(image, 0x10000000)
+        fixtures.make_rom(rom, 0x2000000, fixtures.product_code(0), 1, int(fixtures.media_id(0), 16))
+        sky3ds_disk = Sky3DS_Disk(image)
+        try:
+            sky3ds_disk.format()
+            del self.sink.records[:]
+            sky3ds_disk.write_rom(rom, silent=True)
+        finally:
+            sky3ds_disk.diskfp.close()
+
+        record = [record for record in self.sink.records if record['operation'] == 'write_rom'][0]
+        if record['labels'] != {'disk': image}:
+            raise Exception("Disk path not recorded")
+        for phase in ['source_read', 'device_write', 'header_commit', 'fsync']:
+            if not phase in record['phases']:
+                raise Exception("Phase %s not recorded" % phase)
+        if record['counters'].get('bytes_written', 0) < 0x2000000:
+            raise Exception("Written bytes not counted")
+
+    def test_sinks(self):
+        record = {
+            'operation': 'write_rom',
+            'labels': {'disk': 'card.img'},
+            'started': 0,
+            'wall': 2.0,
+            'error': None,
+            'phases': {'fsync': {'calls': 1, 'seconds': 0.5}},
+            'counters': {'bytes_written': 0x200000},
+            'histograms': {'fsync_seconds': {'buckets': [[bound, 1 if bound == 0.5 else 0] for bound in metrics.latency_buckets], 'sum': 0.5, 'count': 1}},
+            }
+
+        jsonl = os.path.join(self.work_dir, "stats.jsonl")
+        sink = metrics.open_sink(jsonl)
+        sink.emit(record)
+        sink.emit(record)
+        jsonl_fp = open(jsonl)
+        lines = jsonl_fp.readlines()
+        jsonl_fp.close()
+        if len(lines) != 2 or json.loads(lines[1]) != record:
+            raise Exception("Wrong json lines")
+
+        prom = os.path.join(self.work_dir, "stats.prom")
+        sink = metrics.open_sink(prom)
+        sink.emit(record)
+        sink.emit(record)
+        prom_fp = open(prom)
+        lines = prom_fp.read().splitlines()
+        prom_fp.close()
+        for line in [
+                'sky3ds_operations_total{operation="write_rom"} 2',
+                'sky3ds_bytes_total{operation="write_rom",direction="written"} 4194304',
+                'sky3ds_fsync_seconds_bucket{le="0.1"} 0',
+                'sky3ds_fsync_seconds_bucket{le="0.5"} 2',
+                'sky3ds_fsync_seconds_bucket{le="+Inf"} 2',
+                'sky3ds_fsync_seconds_count 2']:
+            if not line in lines:
+                raise Exception("%s missing in Prometheus textfile" % line)
+        if os.path.exists(prom + ".tmp"):
+            raise Exception("Temporary file left behind")
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append(".")
+    sys.path.append("./third_party/appdirs")
+    from sky3ds import fixtures, metrics, pipeline
+    from sky3ds.disk import Sky3DS_Disk
+    unittest.main()
+else:
+    from sky3ds import fixtures, metrics, pipeline
+    from sky3ds.disk import Sky3DS_Disk
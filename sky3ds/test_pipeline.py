@@ -0,0 +1,100 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+
+class Pipeline_Test(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.image = os.path.join(self.work_dir, "card.img")
+        fixtures.make_rom(self.image, 0x1000000, fixtures.product_code(0), 1, int(fixtures.media_id(0), 16))
+        self.imagefp = open(self.image, "rb")
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.imagefp.close()
+        shutil.rmtree(self.work_dir)
+
+    def read_at(self, offset, length):
+        with self.lock:
+            self.imagefp.seek(offset)
+            return self.imagefp.read(length)
+
+    def test_parallel_read(self):
+        expected = self.read_at(0x1234, 0xf00000)
+        for depth in [1, 4]:
+            chunks = list(pipeline.parallel_read(self.read_at, 0x1234, 0xf00000, chunk_size=0x100000, depth=depth))
+            if len(chunks) != 15 or b''.join(chunks) != expected:
+                raise Exception("Chunks out of order or incomplete with depth %d" % depth)
+
+    def test_parallel_read_past_end(self):
+        for depth in [1, 4]:
+            try:
+                list(pipeline.parallel_read(self.read_at, 0x800000, 0x1000000, chunk_size=0x100000, depth=depth))
+                raise Exception("Reading past the end of the disk didn't fail")
+            except Exception as e:
+                if not str(e).startswith("Unexpected end of disk at 0x1000000"):
+                    raise
+
+    def test_parallel_read_depth(self):
+        # never more than depth reads in flight
+        in_flight = [0, 0]
+        def read_at(offset, length):
+            with self.lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            try:
+                return b'\0' * length
+            finally:
+                with self.lock:
+                    in_flight[0] -= 1
+        reader = pipeline.parallel_read(read_at, 0, 0x100000, chunk_size=0x1000, depth=3)
+        for chunk in reader:
+            pass
+        if in_flight[1] > 3:
+            raise Exception("%d reads in flight" % in_flight[1])
+
+    def test_prefetch(self):
+        chunks = list(pipeline.prefetch(pipeline.parallel_read(self.read_at, 0, 0x1000000, chunk_size=0x100000)))
+        if b''.join(chunks) != self.read_at(0, 0x1000000):
+            raise Exception("Prefetched chunks out of order or incomplete")
+
+        def failing():
+            yield b'first'
+            raise Exception("Read error")
+        items = pipeline.prefetch(failing())
+        if next(items) != b'first':
+            raise Exception("Wrong first item")
+        try:
+            next(items)
+            raise Exception("Worker error not re-raised")
+        except Exception as e:
+            if str(e) != "Read error":
+                raise
+
+    def test_prefetch_depth(self):
+        # the worker stops producing once depth items are buffered, and is
+        # stopped when the caller gives up early
+        produced = []
+        def producer():
+            for i in range(100):
+                produced.append(i)
+                yield i
+        items = pipeline.prefetch(producer(), depth=2)
+        if next(items) != 0:
+            raise Exception("Wrong first item")
+        threading.Event().wait(0.3)
+        if len(produced) > 4:
+            raise Exception("%d items produced in advance" % len(produced))
+        items.close()
+        if len(produced) > 4:
+            raise Exception("Worker not stopped after close")
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append(".")
+    from sky3ds import fixtures, pipeline
+    unittest.main()
+else:
+    from sky3ds import fixtures, pipeline
@@ -0,0 +1,78 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+class RomTable_Test(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.restore_data_dir = fixtures.isolate_data_dir(self.work_dir)
+
+        image = os.path.join(self.work_dir, "card.img")
+        fixtures.make_image(image, 0x10000000)
+        self.disk = Sky3DS_Disk(image)
+        self.disk.format()
+        for i, card_type in [(0, 1), (1, 2), (2, 1)]:
+            rom = os.path.join(self.work_dir, "%d.3ds" % i)
+            fixtures.make_rom(rom, 0x2000000, fixtures.product_code(2 - i), card_type, int(fixtures.media_id(i), 16))
+            self.disk.write_rom(rom, silent=True)
+
+        self.table = RomTable()
+        self.table.fill(self.disk.rom_list)
+
+    def tearDown(self):
+        self.restore_data_dir()
+        self.disk.diskfp.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_incremental(self):
+        # all slots are shown right away, before any header is read
+        if [(rom['slot'], rom['title']) for rom in self.table.rows()] != [(0, "Loading..."), (1, "Loading..."), (2, "Loading...")]:
+            raise Exception("Rows not filled from the rom list")
+
+        updates = []
+        def on_rom(rom):
+            updates.append(self.table.update(rom))
+            if [rom['product_code'] != "" for rom in self.table.rows()] != [i < len(updates) for i in range(3)]:
+                raise Exception("Rows not updated one rom at a time")
+        catalog.card_listing(self.disk, on_rom=on_rom)
+        if updates != [True] * 3 or [rom['card_type'] for rom in self.table.rows()] != ['Card1', 'Card2', 'Card1']:
+            raise Exception("Rows not filled in from the listing")
+
+        # a listing for a rom list that changed in the meantime
+        self.table.fill(self.disk.rom_list[:2])
+        if self.table.update(dict(slot=2, title="gone")) or len(self.table.rows()) != 2:
+            raise Exception("Row of a removed rom added")
+
+    def test_filter_sort(self):
+        catalog.card_listing(self.disk, on_rom=self.table.update)
+
+        if [rom['slot'] for rom in self.table.rows(" card2 ")] != [1]:
+            raise Exception("Filter by card type doesn't work")
+        if [rom['slot'] for rom in self.table.rows(fixtures.product_code(0).lower())] != [2]:
+            raise Exception("Filter by product code doesn't work")
+        if self.table.rows("nothing like this"):
+            raise Exception("Filter doesn't hide rows")
+
+        self.table.sort('product_code')
+        if [rom['slot'] for rom in self.table.rows()] != [2, 1, 0]:
+            raise Exception("Sort by product code doesn't work")
+        self.table.sort('product_code')
+        if [rom['slot'] for rom in self.table.rows()] != [0, 1, 2]:
+            raise Exception("Sorting again doesn't reverse the order")
+        self.table.sort('card_type')
+        if self.table.sort_reverse or [rom['slot'] for rom in self.table.rows("card1")] != [0, 2]:
+            raise Exception("Filter and sort don't work together")
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append(".")
+    sys.path.append("./third_party/appdirs")
+    from sky3ds import catalog, fixtures
+    from sky3ds.disk import Sky3DS_Disk
+    from sky3ds.romtable import RomTable
+    unittest.main()
+else:
+    from sky3ds import catalog, fixtures
+    from sky3ds.disk import Sky3DS_Disk
+    from sky3ds.romtable import RomTable
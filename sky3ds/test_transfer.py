@@ -0,0 +1,79 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+class Clone_Test(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.restore_data_dir = fixtures.isolate_data_dir(self.work_dir)
+
+        self.src_disk = self.make_card("src.img", [0, 1])
+        self.dst_disk = self.make_card("dst.img", [2, 3, 4])
+
+    def tearDown(self):
+        self.restore_data_dir()
+        self.src_disk.diskfp.close()
+        self.dst_disk.diskfp.close()
+        shutil.rmtree(self.work_dir)
+
+    def make_card(self, name, roms):
+        image = os.path.join(self.work_dir, name)
+        fixtures.make_image(image, 0x10000000)
+        sky3ds_disk = Sky3DS_Disk(image)
+        sky3ds_disk.format()
+        for i in roms:
+            rom = os.path.join(self.work_dir, "%d.3ds" % i)
+            fixtures.make_rom(rom, 0x2000000, fixtures.product_code(i), 1, int(fixtures.media_id(i), 16))
+            sky3ds_disk.write_rom(rom, silent=True)
+        return sky3ds_disk
+
+    def test_cancelled_clone(self):
+        fingerprint = catalog.card_listing(self.dst_disk)['fingerprint']
+
+        # cancel after a few chunks of the savegame region
+        cancel = CancelToken()
+        write_at = self.dst_disk.write_at
+        writes = []
+        def cancelling_write_at(offset, data):
+            writes.append(offset)
+            if len(writes) == 3:
+                cancel.cancel()
+            write_at(offset, data)
+        self.dst_disk.write_at = cancelling_write_at
+
+        try:
+            transfer.clone(self.src_disk, self.dst_disk, silent=True, cancel=cancel)
+            raise Exception("Clone wasn't cancelled")
+        except Cancelled:
+            pass
+        del self.dst_disk.write_at
+
+        if writes[0] != 0:
+            raise Exception("Destination wasn't invalidated before copying")
+        if Sky3DS_Disk(self.dst_disk.disk_path).is_sky3ds_disk:
+            raise Exception("Destination still looks like a valid card after a cancelled clone")
+        if fingerprint in catalog.load_catalog():
+            raise Exception("Overwritten card is still in the catalog")
+
+        transfer.clone(self.src_disk, self.dst_disk, silent=True)
+        dst_disk = Sky3DS_Disk(self.dst_disk.disk_path)
+        if dst_disk.rom_list != self.src_disk.rom_list:
+            raise Exception("Roms not cloned")
+        if [rom['product_code'] for rom in catalog.card_listing(dst_disk)['roms']] != [fixtures.product_code(0), fixtures.product_code(1)]:
+            raise Exception("Listing of the clone is wrong")
+        if dst_disk.read_at(0x100000, 0x1f00000) != self.src_disk.read_at(0x100000, 0x1f00000):
+            raise Exception("Card1 savegames not cloned")
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append(".")
+    sys.path.append("./third_party/appdirs")
+    from sky3ds import catalog, fixtures, transfer
+    from sky3ds.disk import Sky3DS_Disk
+    from sky3ds.progress import CancelToken, Cancelled
+    unittest.main()
+else:
+    from sky3ds import catalog, fixtures, transfer
+    from sky3ds.disk import Sky3DS_Disk
+    from sky3ds.progress import CancelToken, Cancelled
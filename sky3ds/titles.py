@@ -4,15 +4,10 @@ import os
 import json
 import sys
 import logging
-from xml.dom import minidom
+import marshal
 from appdirs import user_data_dir
 import re
 
-if sys.version_info.major == 3:
-    import urllib.request
-else:
-    import urllib2
-
 data_dir = user_data_dir('sky3ds', 'Aperture Laboratories')
 template_txt = os.path.join(data_dir, 'template.txt')
 template_json = os.path.join(data_dir, 'template.json')
@@ -28,12 +23,90 @@ def crc16(data):
 
     return int(crc & 0xFFFF)
 
-def get_template(serial, sha1):
-    template_json_fp = open(template_json)
-    templates = json.load(template_json_fp)
-    template_json_fp.close()
+_cache = {}
+
+# marshal data is only readable by the python version that wrote it
+compiled_version = (1, sys.version_info[0], sys.version_info[1])
+
+def _load_compiled(path, stamp):
+    """Data from the compiled cache next to a json file, None if it's stale"""
+    try:
+        compiled_fp = open(path + ".cache", "rb")
+        version, compiled_stamp, data = marshal.load(compiled_fp)
+        compiled_fp.close()
+    except:
+        return None
+    if version != compiled_version or tuple(compiled_stamp) != stamp:
+        return None
+    return data
 
-    return next((template for template in templates if template["sha1"] == sha1 and template["serial"] == serial), None)
+def _save_compiled(path, stamp, data):
+    tmp_path = path + ".cache.tmp"
+    try:
+        compiled_fp = open(tmp_path, "wb")
+        marshal.dump((compiled_version, stamp, data), compiled_fp)
+        compiled_fp.close()
+        if os.name == 'nt' and os.path.exists(path + ".cache"):
+            os.remove(path + ".cache")
+        os.rename(tmp_path, path + ".cache")
+    except:
+        pass
+
+def _load_json_cached(path, convert=None):
+    """Load a json file, cached until the file changes
+
+    Parsing big json files (and building indexes from them) takes most of the
+    startup time of a command, so the converted data is also stored in a
+    compiled (marshal) cache file next to the json file. Both caches are
+    checked against mtime and size of the json file.
+
+    Keyword Arguments:
+    path -- json file
+    convert -- function applied to the loaded data before caching it"""
+
+    stamp = (os.path.getmtime(path), os.path.getsize(path))
+    if not path in _cache or _cache[path][0] != stamp:
+        data = _load_compiled(path, stamp)
+        if data == None:
+            json_fp = open(path)
+            data = json.load(json_fp)
+            json_fp.close()
+            if convert:
+                data = convert(data)
+            _save_compiled(path, stamp, data)
+        _cache[path] = (stamp, data)
+    return _cache[path][1]
+
+def _template_index(templates):
+    index = {}
+    for template in templates:
+        index.setdefault((template["serial"], template["sha1"]), template)
+    return index
+
+def template_outdated():
+    """True if template.txt changed since it was converted to template.json"""
+    if not os.path.exists(template_txt):
+        return False
+    if not os.path.exists(template_json):
+        return True
+    return os.path.getmtime(template_txt) > os.path.getmtime(template_json)
+
+def load_templates():
+    """Templates from template.json, keyed by (serial, sha1)
+
+    template.txt is converted to template.json first if it has changed."""
+
+    if template_outdated():
+        logging.info("Found updated template.txt. Converting...")
+        convert_template_to_json()
+    return _load_json_cached(template_json, _template_index)
+
+def load_titles():
+    """Releases from titles.json, keyed by product-code and media-id"""
+    return _load_json_cached(titles_json)
+
+def get_template(serial, sha1):
+    return load_templates().get((serial, sha1))
 
 def convert_template_to_json():
     template_txt_fp = open(template_txt)
@@ -53,14 +126,16 @@ def convert_template_to_json():
     template_json_fp.write(json.dumps(out_templates))
     template_json_fp.close()
 
-def update_title_db():
-    source = "http://3dsdb.com/xml.php"
-    user_agent = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/535.19 (KHTML, like Gecko) Ubuntu/12.04 Chromium/18.0.1025.168 Chrome/18.0.1025.168 Safari/535.19'
+def parse_title_db(xml_data):
+    """Parse the 3dsdb.com release list
 
-    if sys.version_info.major == 3:
-        xml_data = urllib.request.urlopen(urllib.request.Request(source, headers={'User-Agent': user_agent})).read().decode('latin-1')
-    else:
-        xml_data = urllib2.urlopen(urllib2.Request(source, headers={'User-Agent': user_agent})).read().decode('latin-1')
+    Keyword Arguments:
+    xml_data -- xml as (unicode) string
+
+    Returns the releases keyed by product-code and media-id and the number
+    of releases that couldn't be parsed"""
+
+    from xml.dom import minidom
 
     xml_data = re.sub(r'<>[0-9]</>', '', xml_data)
 
@@ -90,7 +165,21 @@ def update_title_db():
             }})
         except:
             error += 1
-            pass
+
+    return (releases, error)
+
+def update_title_db():
+    source = "http://3dsdb.com/xml.php"
+    user_agent = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/535.19 (KHTML, like Gecko) Ubuntu/12.04 Chromium/18.0.1025.168 Chrome/18.0.1025.168 Safari/535.19'
+
+    if sys.version_info.major == 3:
+        import urllib.request
+        xml_data = urllib.request.urlopen(urllib.request.Request(source, headers={'User-Agent': user_agent})).read().decode('latin-1')
+    else:
+        import urllib2
+        xml_data = urllib2.urlopen(urllib2.Request(source, headers={'User-Agent': user_agent})).read().decode('latin-1')
+
+    releases, error = parse_title_db(xml_data)
 
     titles_json_fp = open(titles_json, "w")
     titles_json_fp.write(json.dumps(releases))
@@ -99,9 +188,7 @@ def update_title_db():
 
 def rom_info(product_code, media_id):
     try:
-        titles_json_fp = open(titles_json)
-        releases = json.load(titles_json_fp)
-        titles_json_fp.close()
+        releases = load_titles()
         product_code = product_code[0:3] + "-" + product_code[6:10]
 
         selector = "%s-%s" % (product_code, media_id)
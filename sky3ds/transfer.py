@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import os
+import struct
+
+from sky3ds import catalog, metrics, pipeline
+from sky3ds.progress import Progress
+
+def copy_extent(src_disk, src_start, dst_disk, dst_start, length, progress=None, progress_offset=0, queue_depth=None):
+    """Copy data from one sdcard to another
+
+    Reading from the source is done in a background thread (with several
+    reads in flight, see Sky3DS_Disk.read_extent), so it overlaps with
+    writing to the destination.
+
+    Keyword Arguments:
+    src_disk -- source Sky3DS_Disk
+    src_start -- start of data on source in bytes
+    dst_disk -- destination Sky3DS_Disk
+    dst_start -- start of data on destination in bytes
+    length -- number of bytes to copy
+    progress -- Progress (updated with the number of copied bytes)
+    progress_offset -- added to the number of copied bytes for progress
+    queue_depth -- number of reads in flight on the source (default: from
+                   device profile)"""
+
+    if queue_depth == None:
+        queue_depth = src_disk.tuning['queue_depth']
+
+    written = 0
+    for chunk in pipeline.prefetch(src_disk.read_extent(src_start, length, dst_disk.tuning['write_chunk_size'], queue_depth)):
+        dst_disk.write_at(dst_start + written, chunk)
+        written += len(chunk)
+        if progress:
+            progress.update(progress_offset + written)
+    dst_disk.sync()
+
+@metrics.instrument('clone')
+def clone(src_disk, dst_disk, repack=False, silent=False, progress=None, queue_depth=None, cancel=None):
+    """Copy everything from one sdcard to another
+
+    Only the used parts of the source are copied: the rom position headers,
+    the Card1 savegame region and the roms. If repack is set, the roms are
+    written one after another to the destination (in their current order),
+    otherwise they keep their positions.
+    The rom position headers and magic string of the destination are wiped
+    before anything is copied (and its catalog entry is dropped), the new
+    ones are written last, so the destination only becomes a valid card
+    again when everything has been copied.
+
+    Keyword Arguments:
+    src_disk -- source Sky3DS_Disk
+    dst_disk -- destination Sky3DS_Disk (will be overwritten!)
+    repack -- store roms without gaps on the destination
+    silent -- don't show a progress bar
+    progress -- function(ProgressEvent) instead of a progress bar
+    queue_depth -- number of reads in flight on the source
+    cancel -- CancelToken, stops the clone (the destination isn't a valid
+              card then)"""
+
+    src_disk.fail_on_non_sky3ds()
+
+    if os.path.realpath(src_disk.disk_path) == os.path.realpath(dst_disk.disk_path):
+        raise Exception("Source and destination are the same disk")
+
+    # work out where the roms go
+    positions = []
+    position = 0x2000000
+    for rom in sorted(src_disk.rom_list, key=lambda x: x[1]):
+        if repack:
+            positions.append((rom, position))
+            position += rom[2] + (0x2000000 - rom[2] % 0x2000000) % 0x2000000
+        else:
+            positions.append((rom, rom[1]))
+            position = max(position, rom[1] + rom[2])
+
+    if position > dst_disk.disk_size:
+        raise Exception("Destination is too small (%d MB needed, %d MB available)%s" % (position / 1024 / 1024, dst_disk.disk_size / 1024 / 1024, "" if repack else ", try repacking"))
+
+    # invalidate destination until everything is in place
+    with dst_disk.header_lock:
+        fingerprint = dst_disk.fingerprint() if dst_disk.is_sky3ds_disk else None
+        dst_disk.write_at(0, bytearray([0xff]*0x200))
+        dst_disk.sync()
+        dst_disk.is_sky3ds_disk = False
+    if fingerprint:
+        catalog.forget(fingerprint)
+
+    total = 0x1f00000 + sum(rom[2] for rom in src_disk.rom_list)
+    progress = Progress('clone', total, progress, silent=silent, cancel=cancel, target=dst_disk.disk_path)
+
+    # Card1 savegames
+    copy_extent(src_disk, 0x100000, dst_disk, 0x100000, 0x1f00000, progress, 0, queue_depth)
+    written = 0x1f00000
+
+    # roms
+    for rom, start in positions:
+        copy_extent(src_disk, rom[1], dst_disk, start, rom[2], progress, written, queue_depth)
+        written += rom[2]
+
+    # rom position headers (in slot order) + magic string
+    header = bytearray(src_disk.read_at(0, 0x200))
+    for rom, start in positions:
+        header[rom[0] * 0x8:rom[0] * 0x8 + 0x8] = struct.pack("ii", int(start / 0x200), int(rom[2] / 0x200))
+    with dst_disk.header_lock:
+        dst_disk.write_at(0, header)
+        dst_disk.sync()
+
+    progress.finish()
+
+    dst_disk.check_if_sky3ds_disk()
+    dst_disk.update_rom_list()
+
+@metrics.instrument('transfer_slot')
+def transfer_slot(src_disk, slot, dst_disk, delete_source=False, silent=False, progress=None, queue_depth=None, cancel=None):
+    """Copy a single rom and its savegame from one sdcard to another
+
+    The rom (including its sky3ds header and Card2 savegame) is copied
+    directly to a free block on the destination, the Card1 savegame to the
+    savegame slot of the new rom.
+
+    Keyword Arguments:
+    src_disk -- source Sky3DS_Disk
+    slot -- rom position header slot on source
+    dst_disk -- destination Sky3DS_Disk
+    delete_source -- remove the rom from the source afterwards (move)
+    silent -- don't show a progress bar
+    progress -- function(ProgressEvent) instead of a progress bar
+    queue_depth -- number of reads in flight on the source
+    cancel -- CancelToken, stops the transfer before the rom shows up on the
+              destination"""
+
+    src_disk.fail_on_non_sky3ds()
+    dst_disk.fail_on_non_sky3ds()
+
+    if slot >= len(src_disk.rom_list):
+        raise Exception("Slot not found")
+
+    rom = src_disk.rom_list[slot]
+    rom_blocks = int(rom[2] / 0x200)
+    start_block = dst_disk.find_free_space(rom_blocks)
+    free_slot = dst_disk.find_free_slot()
+
+    progress = Progress('transfer_slot', rom[2] + 0x100000, progress, silent=silent, cancel=cancel, target=dst_disk.disk_path)
+
+    copy_extent(src_disk, rom[1], dst_disk, start_block * 0x200, rom[2], progress, 0, queue_depth)
+
+    # Card1 savegame (Card2 savegames are part of the rom)
+    copy_extent(src_disk, 0x100000 * (slot + 1), dst_disk, 0x100000 * (free_slot + 1), 0x100000, progress, rom[2], queue_depth)
+
+    # make rom visible on destination
+    with dst_disk.header_lock:
+        dst_disk.write_at(free_slot * 0x8, struct.pack("ii", start_block, rom_blocks))
+        dst_disk.sync()
+
+    progress.finish()
+
+    dst_disk.update_rom_list()
+
+    if delete_source:
+        src_disk.delete_rom(slot)
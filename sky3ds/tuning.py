@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+from appdirs import user_data_dir
+
+data_dir = user_data_dir('sky3ds', 'Aperture Laboratories')
+profiles_json = os.path.join(data_dir, 'profiles.json')
+
+# used for sdcard readers that haven't been profiled (see profile_device)
+defaults = {
+    'read_chunk_size': 1024*1024,
+    'queue_depth': 4,
+    'write_chunk_size': 1024*1024*8,
+    # 'chunk' = fsync after every chunk, 'end' = only once at the end
+    'fsync': 'chunk',
+    # allocation unit of the sdcard (see disk.WriteBatch), 4MB is what most
+    # SDHC cards use
+    'au_size': 0x400000,
+    }
+
+read_chunk_sizes = [0x10000, 0x40000, 0x100000, 0x400000]
+queue_depths = [1, 2, 4, 8]
+write_chunk_sizes = [0x100000, 0x400000, 0x800000, 0x1000000]
+
+def load_profiles():
+    """Load all device profiles, keyed by device_identity"""
+    try:
+        profiles_json_fp = open(profiles_json)
+        profiles = json.load(profiles_json_fp)
+        profiles_json_fp.close()
+        return profiles
+    except:
+        return {}
+
+def save_profiles(profiles):
+    # profiles_json may be moved out of data_dir (see fixtures.isolate_data_dir)
+    profiles_dir = os.path.dirname(profiles_json)
+    if not os.path.exists(profiles_dir):
+        os.makedirs(profiles_dir)
+    tmp_profiles_json = profiles_json + ".tmp"
+    profiles_json_fp = open(tmp_profiles_json, "w")
+    profiles_json_fp.write(json.dumps(profiles, indent=2))
+    profiles_json_fp.close()
+    if os.name == 'nt' and os.path.exists(profiles_json):
+        os.remove(profiles_json)
+    os.rename(tmp_profiles_json, profiles_json)
+
+def device_identity(disk_path):
+    """Identify the sdcard reader behind a device
+
+    On Linux this is vendor, model and revision of the reader from sysfs, so
+    the profile follows the reader (and not the device name, which changes
+    from time to time). Everywhere else (and for image files) it's just the
+    path."""
+
+    disk_path = os.path.realpath(disk_path)
+    device_dir = os.path.join('/sys/block', os.path.basename(disk_path), 'device')
+
+    identity = []
+    for attribute in ['vendor', 'model', 'rev']:
+        try:
+            identity.append(open(os.path.join(device_dir, attribute)).read().strip())
+        except:
+            pass
+    if disk_path.startswith('/dev/') and [i for i in identity if i]:
+        return ' '.join(identity)
+    return disk_path
+
+def detect_au_size(disk_path):
+    """Allocation unit size of a sdcard
+
+    Only sdcards in built-in readers (mmcblk devices on Linux) report it, USB
+    readers don't pass it through.
+
+    Returns the AU size in bytes or None"""
+
+    device_dir = os.path.join('/sys/block', os.path.basename(os.path.realpath(disk_path)), 'device')
+    try:
+        au_size = int(open(os.path.join(device_dir, 'preferred_erase_size')).read())
+    except:
+        return None
+    # has to be a power of two between 512 bytes and 64MB
+    if au_size < 0x200 or au_size > 0x4000000 or au_size & (au_size - 1):
+        return None
+    return au_size
+
+def tuning_for(disk_path):
+    """Chunk sizes, queue depth, fsync policy and AU size for a sdcard
+
+    Returns the values from the device profile of the reader, or the
+    defaults if it hasn't been profiled. The AU size is read from the
+    sdcard if possible, an au_size in the device profile (which can be
+    added by hand for USB readers) overrides it. Write chunks are always
+    whole AUs."""
+
+    tuning = dict(defaults)
+    au_size = detect_au_size(disk_path)
+    if au_size:
+        tuning['au_size'] = au_size
+
+    profile = load_profiles().get(device_identity(disk_path))
+    if profile:
+        tuning.update(profile['tuning'])
+
+    au_size = tuning['au_size']
+    tuning['write_chunk_size'] = max(1, int((tuning['write_chunk_size'] + au_size - 1) / au_size)) * au_size
+    return tuning
+
+def drop_cache(disk, start, length):
+    """Ask the OS to forget cached data, so reads actually hit the sdcard"""
+    try:
+        os.posix_fadvise(disk.fileno, start, length, os.POSIX_FADV_DONTNEED)
+    except:
+        pass
+
+def measure_read(disk, start, length, chunk_size, queue_depth):
+    drop_cache(disk, start, length)
+    started = time.time()
+    for chunk in disk.read_extent(start, length, chunk_size, queue_depth):
+        pass
+    return length / (time.time() - started)
+
+def measure_write(disk, start, length, chunk_size):
+    """Write throughput and average fsync latency
+
+    The data that is already there is read and written back unchanged, so
+    nothing on the sdcard changes (the area is free space anyway)."""
+
+    data = disk.read_at(start, length)
+    write_time = 0
+    fsync_time = 0
+    for offset in range(0, length, chunk_size):
+        started = time.time()
+        disk.write_at(start + offset, data[offset:offset + chunk_size])
+        synced = time.time()
+        disk.sync()
+        write_time += synced - started
+        fsync_time += time.time() - synced
+    chunks = int((length + chunk_size - 1) / chunk_size)
+    return length / (write_time + fsync_time), fsync_time / chunks
+
+def best(results, key):
+    """Pick the smallest settings within 5% of the fastest ones"""
+    fastest = max(result[key] for result in results)
+    return [result for result in results if result[key] >= fastest * 0.95][0]
+
+def profile_device(disk, length=0x4000000, progress=None):
+    """Measure a sdcard reader and store a profile for it
+
+    Sequential reads are measured for all combinations of read_chunk_sizes
+    and queue_depths, plus unaligned reads (shifted by one sector) with the
+    best combination. Writes (with fsync after every chunk) are measured for
+    write_chunk_sizes. Everything happens in the largest free block of the
+    card, and writes only put back the data that was read before.
+
+    The fastest settings are stored as profile of the reader (see
+    device_identity) and used by all bulk operations on sdcards in the same
+    reader from then on (see tuning_for).
+
+    Keyword Arguments:
+    disk -- Sky3DS_Disk
+    length -- bytes read/written per measurement (less if there isn't
+              enough free space)
+    progress -- function(description) called before every measurement
+
+    Returns the profile"""
+
+    disk.fail_on_non_sky3ds()
+
+    if not disk.free_blocks:
+        raise Exception("No free space on disk, can't profile device.")
+    start = disk.free_blocks[0][0] * 0x200
+    length = min(length, disk.free_blocks[0][1] * 0x200 - 0x200)
+
+    def report(description):
+        if progress:
+            progress(description)
+
+    reads = []
+    for chunk_size in read_chunk_sizes:
+        for queue_depth in queue_depths:
+            report("read %d KB chunks, queue depth %d" % (chunk_size / 1024, queue_depth))
+            reads.append({
+                'chunk_size': chunk_size,
+                'queue_depth': queue_depth,
+                'aligned': True,
+                'throughput': measure_read(disk, start, length, chunk_size, queue_depth),
+                })
+    best_read = best(reads, 'throughput')
+
+    report("unaligned read %d KB chunks, queue depth %d" % (best_read['chunk_size'] / 1024, best_read['queue_depth']))
+    reads.append(dict(best_read, aligned=False, throughput=measure_read(disk, start + 0x200, length, best_read['chunk_size'], best_read['queue_depth'])))
+
+    writes = []
+    for chunk_size in write_chunk_sizes:
+        report("write %d KB chunks" % (chunk_size / 1024))
+        throughput, fsync_latency = measure_write(disk, start, length, chunk_size)
+        writes.append({
+            'chunk_size': chunk_size,
+            'throughput': throughput,
+            'fsync_latency': fsync_latency,
+            })
+    best_write = best(writes, 'throughput')
+
+    # syncing after every chunk keeps progress bars honest, but not if it
+    # costs more than a fifth of the time
+    chunk_time = best_write['chunk_size'] / best_write['throughput']
+    fsync = 'chunk' if best_write['fsync_latency'] < chunk_time * 0.2 else 'end'
+
+    profile = {
+        'identity': device_identity(disk.disk_path),
+        'disk_path': disk.disk_path,
+        'profiled': time.time(),
+        'reads': reads,
+        'writes': writes,
+        'tuning': {
+            'read_chunk_size': best_read['chunk_size'],
+            'queue_depth': best_read['queue_depth'],
+            'write_chunk_size': best_write['chunk_size'],
+            'fsync': fsync,
+            },
+        }
+
+    profiles = load_profiles()
+    profiles[profile['identity']] = profile
+    save_profiles(profiles)
+
+    return profile